@@ -4,8 +4,6 @@ from jax import numpy as jp
 from brax.envs.base import PipelineEnv, State
 from brax.io import mjcf as mjcf_brax
 from brax import math as brax_math
-from dm_control.locomotion.walkers import rescale
-from dm_control import mjcf as mjcf_dm
 
 from jax.numpy import inf, ndarray
 import mujoco
@@ -13,9 +11,21 @@ from mujoco import mjx
 
 import numpy as np
 
+import contextlib
+import json
 import os
-
-from preprocessing.mjx_preprocess import ReferenceClip
+from typing import Any, Callable, Dict, NamedTuple, Optional
+
+import model_cache
+from observation_layout import ObservationLayout
+from pose_index import (
+    PoseIndex,
+    build_pose_index,
+    pose_descriptor,
+    pose_index_nbytes,
+    query_pose_index,
+)
+from preprocessing.mjx_preprocess import ReferenceClip, compact_reference_clip
 
 _XML_PATH = "./models/rodent.xml"
 _MOCAP_HZ = 50
@@ -83,6 +93,84 @@ _END_EFF_NAMES = [
     "skull",
 ]
 
+# Contact policies for the contact_policy option, see model_cache.ContactPairs.
+# Body names select the collision geoms attached directly to that body.
+_CONTACT_POLICIES = {
+    # Only the foot and hand geoms touch the floor (no toes, fingers or self
+    # collisions)
+    "floor_vs_end_effectors": [(["floor"], _END_EFF_NAMES)],
+}
+
+# What step reports besides the health flags, which every level keeps so NaN
+# terminations are always counted: "off" nothing else; "summary" the active
+# reward terms, the control costs and the termination flags; "full" also the
+# zero-weight terms and the tracking distances in info
+_METRICS_LEVELS = ("off", "summary", "full")
+
+# RodentTracking arguments that a physics config file may set
+_PHYSICS_CONFIG_KEYS = (
+    "solver",
+    "iterations",
+    "ls_iterations",
+    "physics_steps_per_control_step",
+    "jacobian",
+    "cone",
+)
+
+
+def load_physics_config(path: str) -> Dict[str, Any]:
+    """Loads physics settings (e.g. written by benchmarks/physics_autotune.py)
+    as RodentTracking keyword arguments."""
+    with open(path, "r") as f:
+        config = json.load(f)
+    unknown = set(config) - set(_PHYSICS_CONFIG_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown physics config keys: {sorted(unknown)}")
+    return config
+
+
+class RewardTerm(NamedTuple):
+    """A tracking reward term: weight * exp(-scale * sum(feature[idxs] ** 2)).
+
+    `feature` names an entry of the dict built by
+    RodentTracking._get_tracking_features; `idxs` optionally selects a subset
+    of its leading axis (e.g. the end effector bodies).
+    """
+
+    name: str
+    weight: float
+    scale: float
+    feature: str
+    idxs: Optional[jp.ndarray] = None
+
+
+class ResetBank(NamedTuple):
+    """Reset states pre-initialized for sampled (clip, start frame) pairs.
+
+    Only qpos and the body positions read by the reset observation are kept per
+    entry; the other mjx.Data fields come from one shared template state (that
+    of the first entry). Until the first pipeline_step recomputes them, a state
+    drawn from the bank therefore carries the template's xquat, xmat, cinert,
+    contacts and other derived fields, which reset does not read.
+    """
+
+    clip_idx: jp.ndarray
+    start_frame: jp.ndarray
+    qpos: jp.ndarray
+    xpos: jp.ndarray
+    clip_log_count: jp.ndarray  # log of the number of entries of the entry's clip
+
+
+class EnvBuffers(NamedTuple):
+    """The device arrays of a tracking env that compiled code takes as
+    arguments (see RodentTracking.with_buffers) instead of capturing them as
+    constants. Entries that were not built are None."""
+
+    reference_clips: ReferenceClip
+    reset_bank: Optional[ResetBank] = None
+    reset_template: Optional[mjx.Data] = None
+    pose_index: Optional[PoseIndex] = None
+
 
 def _bounded_quat_dist(source: np.ndarray, target: np.ndarray) -> np.ndarray:
     """Computes a quaternion distance limiting the difference to a max of pi/2.
@@ -107,9 +195,61 @@ def _bounded_quat_dist(source: np.ndarray, target: np.ndarray) -> np.ndarray:
     return 0.5 * jp.arccos(dist)[..., np.newaxis]
 
 
+def _quat_mul_matrix(q: jp.ndarray) -> jp.ndarray:
+    """4x4 matrix L(q) such that brax_math.quat_mul(q, p) == L(q) @ p."""
+    w, x, y, z = q
+    return jp.array(
+        [
+            [w, -x, -y, -z],
+            [x, w, -z, y],
+            [y, z, w, -x],
+            [z, -y, x, w],
+        ]
+    )
+
+
+def _slerp(q0: jp.ndarray, q1: jp.ndarray, alpha: jp.ndarray) -> jp.ndarray:
+    """Spherical interpolation of quaternions (..., 4) along the shortest arc,
+    falling back to normalized lerp for nearly equal quaternions."""
+    dot = jp.sum(q0 * q1, axis=-1, keepdims=True)
+    q1 = jp.where(dot < 0, -q1, q1)
+    dot = jp.abs(dot)
+    nearly_equal = dot > 0.9995
+    theta = jp.arccos(jp.where(nearly_equal, 0.0, jp.minimum(dot, 1.0)))
+    sin_theta = jp.where(nearly_equal, 1.0, jp.sin(theta))
+    w0 = jp.where(nearly_equal, 1 - alpha, jp.sin((1 - alpha) * theta) / sin_theta)
+    w1 = jp.where(nearly_equal, alpha, jp.sin(alpha * theta) / sin_theta)
+    q = w0 * q0 + w1 * q1
+    return q / jp.linalg.norm(q, axis=-1, keepdims=True)
+
+
+# Fields of ReferenceClip interpolated with slerp rather than lerp
+_QUATERNION_FIELDS = ("quaternion", "body_quaternions")
+
+
+def _interpolate_clip(
+    lo: ReferenceClip, hi: ReferenceClip, alpha: jp.ndarray
+) -> ReferenceClip:
+    """Interpolates two gathered windows by `alpha` (one weight per frame)."""
+    interpolated = {}
+    for attr, x0 in lo.__dict__.items():
+        if x0 is None:
+            continue
+        x1 = getattr(hi, attr)
+        a = alpha.reshape(alpha.shape + (1,) * (x0.ndim - alpha.ndim))
+        if attr in _QUATERNION_FIELDS:
+            interpolated[attr] = _slerp(x0, x1, a)
+        else:
+            interpolated[attr] = x0 + a * (x1 - x0)
+    return lo.replace(**interpolated)
+
+
 class RodentTracking(PipelineEnv):
     """Single clip rodent tracking"""
 
+    # Whether build_reset_bank can pre-initialize this env's states
+    _supports_reset_bank = True
+
     def __init__(
         self,
         reference_clip,
@@ -132,23 +272,42 @@ class RodentTracking(PipelineEnv):
         solver="cg",
         iterations: int = 6,
         ls_iterations: int = 6,
+        compact_reference_clips: bool = False,
+        reference_dtype=None,
+        health_check_fields=("qpos", "qvel"),
+        max_start_frame: Optional[int] = 44,
+        model_cache_dir: Optional[str] = model_cache.CACHE_DIR,
+        contact_policy: Optional[str] = None,
+        jacobian="dense",
+        cone="pyramidal",
+        interpolate_reference: bool = False,
+        metrics_level: str = "full",
+        physics_metrics: bool = False,
         **kwargs,
     ):
-        root = mjcf_dm.from_path(_XML_PATH)
-
-        # Convert to torque actuators
-        if torque_actuators:
-            for actuator in root.find_all("actuator"):
-                actuator.gainprm = [actuator.forcerange[1]]
-                del actuator.biastype
-                del actuator.biasprm
-
-        rescale.rescale_subtree(
-            root,
-            0.9,
+        if metrics_level not in _METRICS_LEVELS:
+            raise ValueError(
+                f"metrics_level ({metrics_level}) must be one of {_METRICS_LEVELS}"
+            )
+        mj_model, index_tables = model_cache.load_model(
+            _XML_PATH,
             0.9,
+            torque_actuators,
+            index_names={
+                "joint_idxs": ("joint", _JOINT_NAMES),
+                "body_idxs": ("body", _BODY_NAMES),
+                "endeff_idxs": ("body", _END_EFF_NAMES),
+                "torso_idx": ("body", ["torso"]),
+            },
+            cache_dir=model_cache_dir,
+            contact_pairs=(
+                None if contact_policy is None else _CONTACT_POLICIES[contact_policy]
+            ),
+        )
+        print(
+            f"collision pairs ({contact_policy or 'default'}): "
+            f"{model_cache.count_collision_pairs(mj_model)}"
         )
-        mj_model = mjcf_dm.Physics.from_mjcf_model(root).model.ptr
         mj_model.opt.solver = {
             "cg": mujoco.mjtSolver.mjSOL_CG,
             "newton": mujoco.mjtSolver.mjSOL_NEWTON,
@@ -156,7 +315,14 @@ class RodentTracking(PipelineEnv):
         mj_model.opt.iterations = iterations
         mj_model.opt.ls_iterations = ls_iterations
 
-        mj_model.opt.jacobian = 0
+        mj_model.opt.jacobian = {
+            "dense": mujoco.mjtJacobian.mjJAC_DENSE,
+            "sparse": mujoco.mjtJacobian.mjJAC_SPARSE,
+        }[jacobian.lower()]
+        mj_model.opt.cone = {
+            "pyramidal": mujoco.mjtCone.mjCONE_PYRAMIDAL,
+            "elliptic": mujoco.mjtCone.mjCONE_ELLIPTIC,
+        }[cone.lower()]
 
         sys = mjcf_brax.load_model(mj_model)
 
@@ -168,42 +334,56 @@ class RodentTracking(PipelineEnv):
         )
 
         super().__init__(sys, **kwargs)
-        if max_physics_steps_per_control_step % physics_steps_per_control_step != 0:
+
+        # Initial pose and sizes of a single walker
+        self._walker_mj_model = mj_model
+        self._walker_qpos0 = jp.array(sys.qpos0)
+        self._walker_nv = sys.nv
+
+        # With interpolate_reference, info["cur_frame"] is a fractional frame
+        # advanced by the mocap frames per control step, so any control rate
+        # works; otherwise the control rate must divide the mocap rate.
+        self._interpolate_reference = interpolate_reference
+        self._metrics_level = metrics_level
+        # Contact, constraint and solver statistics, at any metrics_level
+        self._physics_metrics = physics_metrics
+        self._frames_per_control_step = self.dt * _MOCAP_HZ
+        if (
+            not interpolate_reference
+            and max_physics_steps_per_control_step % physics_steps_per_control_step
+            != 0
+        ):
             raise ValueError(
                 f"physics_steps_per_control_step ({physics_steps_per_control_step}) must be a factor of ({max_physics_steps_per_control_step})"
             )
 
-        self._steps_for_cur_frame = (
-            max_physics_steps_per_control_step / physics_steps_per_control_step
-        )
+        self._steps_for_cur_frame = 1.0 / self._frames_per_control_step
+        if not interpolate_reference:
+            self._steps_for_cur_frame = (
+                max_physics_steps_per_control_step / physics_steps_per_control_step
+            )
         print(f"self._steps_for_cur_frame: {self._steps_for_cur_frame}")
 
-        self._torso_idx = mujoco.mj_name2id(
-            mj_model, mujoco.mju_str2Type("body"), "torso"
-        )
+        self._torso_idx = int(index_tables["torso_idx"][0])
+        self._joint_idxs = jp.array(index_tables["joint_idxs"])
+        self._body_idxs = jp.array(index_tables["body_idxs"])
+        self._endeff_idxs = jp.array(index_tables["endeff_idxs"])
 
-        self._joint_idxs = jp.array(
+        # Static layout of the observation built by _get_obs, used to
+        # initialize and route the intention network
+        self.observation_layout = ObservationLayout.from_sizes(
             [
-                mujoco.mj_name2id(mj_model, mujoco.mju_str2Type("joint"), joint)
-                for joint in _JOINT_NAMES
-            ]
-        )
-
-        self._body_idxs = jp.array(
+                ("track_pos", ref_len * 3),
+                ("quat", ref_len * 4),
+                ("joints", ref_len * len(_JOINT_NAMES)),
+                ("body_pos", ref_len * len(_BODY_NAMES) * 3),
+            ],
             [
-                mujoco.mj_name2id(mj_model, mujoco.mju_str2Type("body"), body)
-                for body in _BODY_NAMES
-            ]
+                ("qpos", self.sys.nq),
+                ("qvel", self.sys.nv),
+            ],
         )
 
-        self._endeff_idxs = jp.array(
-            [
-                mujoco.mj_name2id(mj_model, mujoco.mju_str2Type("body"), body)
-                for body in _END_EFF_NAMES
-            ]
-        )
-
-        self._reference_clip = reference_clip
         self._bad_pose_dist = bad_pose_dist
         self._too_far_dist = too_far_dist
         self._bad_quat_dist = bad_quat_dist
@@ -218,149 +398,458 @@ class RodentTracking(PipelineEnv):
         self._ctrl_diff_cost_weight = ctrl_diff_cost_weight
         self._healthy_z_range = healthy_z_range
         self._reset_noise_scale = reset_noise_scale
+        self._max_start_frame = max_start_frame
+
+        # Bodies whose offsets to the reference are computed each step (tracked
+        # and end effector bodies), and where each set sits within them
+        self._feature_body_idxs = np.unique(
+            np.concatenate([self._body_idxs, self._endeff_idxs])
+        )
+        self._feature_tracked_idxs = jp.searchsorted(
+            self._feature_body_idxs, self._body_idxs
+        )
+        self._feature_endeff_idxs = jp.searchsorted(
+            self._feature_body_idxs, self._endeff_idxs
+        )
+
+        # Compacted clips store exactly the feature bodies, in the same order
+        self._compact_reference_clips = compact_reference_clips
+        self._reference_dtype = reference_dtype
+        if compact_reference_clips:
+            self._ref_body_subset = self._feature_body_idxs
+            self._ref_feature_body_idxs = jp.arange(len(self._feature_body_idxs))
+        else:
+            self._ref_body_subset = None
+            self._ref_feature_body_idxs = jp.array(self._feature_body_idxs)
+
+        # Zero-weight terms are dropped here, so they are never traced
+        self._reward_terms = tuple(
+            term
+            for term in (
+                RewardTerm("pos", pos_reward_weight, 400.0, "position"),
+                RewardTerm("quat", quat_reward_weight, 4.0, "quaternion"),
+                RewardTerm("joint", joint_reward_weight, 0.25, "joints"),
+                RewardTerm("angvel", angvel_reward_weight, 0.5, "angular_velocity"),
+                RewardTerm(
+                    "bodypos",
+                    bodypos_reward_weight,
+                    8.0,
+                    "body_positions",
+                    self._feature_tracked_idxs,
+                ),
+                RewardTerm(
+                    "endeff",
+                    endeff_reward_weight,
+                    500.0,
+                    "body_positions",
+                    self._feature_endeff_idxs,
+                ),
+            )
+            if term.weight != 0
+        )
+
+        # Numerical health guard: mjx.Data fields scanned for NaN/Inf, one
+        # counter per field ("all" scans the full state, for debugging)
+        if health_check_fields == "all":
+            self._health_check_fields = None
+            self._health_metric_names = ["nonfinite_data"]
+        else:
+            self._health_check_fields = tuple(health_check_fields)
+            self._health_metric_names = [
+                f"nonfinite_{field}" for field in self._health_check_fields
+            ]
+
+        self._reference_clip = self._prepare_reference_clip(reference_clip)
+
+        # Built on demand by build_reset_bank
+        self._reset_bank = None
+        self._reset_template = None
+        # Bound by bind_clip_logits while an adaptive clip sampler is in use
+        self._clip_logits = None
+        # Built on demand by build_pose_index
+        self._pose_index = None
 
     def reset(self, rng) -> State:
         """Resets the environment to an initial state."""
+        if self._reset_bank is not None:
+            return self.reset_from_bank(rng)
+
         _, start_rng, rng = jax.random.split(rng, 3)
+        info = self._sample_reset_info(start_rng)
+
+        return self.reset_from_clip(rng, info, noise=True)
 
-        start_frame = jax.random.randint(start_rng, (), 0, 44)
+    def _sample_reset_info(self, rng):
+        """Info of a reset at a random start frame."""
+        start_frame = self._sample_start_frame(rng, self._get_clip_length({}))
+        return self._reset_info(0, start_frame)
 
+    def _reset_info(self, clip_idx, start_frame):
+        """Info of a reset at `start_frame`; single clip envs ignore clip_idx."""
         info = {
             "cur_frame": start_frame,
             "steps_taken_cur_frame": 0,
-            "summed_pos_distance": 0.0,
-            "quat_distance": 0.0,
-            "joint_distance": 0.0,
-            "prev_ctrl": jp.zeros((self.sys.nv,)),
+            "prev_ctrl": jp.zeros((self.action_size,)),
         }
+        return self._with_distance_info(info)
+
+    def _with_distance_info(self, info):
+        """Adds the tracking distances step writes at metrics_level "full"."""
+        if self._metrics_level == "full":
+            info.update(summed_pos_distance=0.0, quat_distance=0.0, joint_distance=0.0)
+        return info
+
+    @property
+    def reset_bank(self) -> Optional[ResetBank]:
+        """The reset bank reset draws from, if built."""
+        return self._reset_bank
+
+    def build_reset_bank(self, rng, bank_size: int = 1024):
+        """Pre-initializes reset states for `bank_size` random (clip, start
+        frame) pairs.
+
+        pipeline_init runs once per pair here; afterwards reset draws an entry
+        and only adds noise. Every clip gets at least one entry, the others
+        are drawn uniformly. Call again to resample the pairs (e.g. after
+        changing the clip library).
+        """
+        if not self._supports_reset_bank:
+            raise ValueError(f"{type(self).__name__} does not support reset banks")
+        n_clips = self.n_clips
+        if bank_size < n_clips:
+            raise ValueError(
+                f"bank_size ({bank_size}) must be at least the number of clips "
+                f"({n_clips})"
+            )
+        clip_rng, start_rng, rng = jax.random.split(rng, 3)
+        clip_idx = jp.concatenate(
+            [
+                jp.arange(n_clips),
+                jax.random.randint(clip_rng, (bank_size - n_clips,), 0, n_clips),
+            ]
+        )
 
-        return self.reset_from_clip(rng, info, noise=True)
+        def sample_info(clip_idx, rng):
+            clip_length = self._get_clip_length({"clip_idx": clip_idx})
+            return self._reset_info(
+                clip_idx, self._sample_start_frame(rng, clip_length)
+            )
+
+        infos = jax.vmap(sample_info)(
+            clip_idx, jax.random.split(start_rng, bank_size)
+        )
+
+        def init(info):
+            qpos, qvel, _ = self._reference_qpos_qvel(rng, info, noise=False)
+            return self.pipeline_init(qpos, qvel)
+
+        # One pair at a time, so only a single full mjx.Data is live
+        data = jax.jit(lambda infos: jax.lax.map(init, infos))(infos)
+        self._reset_template = jax.tree.map(lambda x: x[0], data)
+        clip_count = jp.bincount(clip_idx, length=n_clips)
+        self._reset_bank = ResetBank(
+            clip_idx=clip_idx,
+            start_frame=infos["cur_frame"],
+            qpos=data.qpos,
+            xpos=data.xpos,
+            clip_log_count=jp.log(clip_count[clip_idx]),
+        )
+        print(
+            f"Reset bank: {bank_size} states, "
+            f"{sum(x.nbytes for x in self._reset_bank) / 1e6:.2f} MB"
+        )
+
+    def reset_from_bank(self, rng, noise=True) -> State:
+        """Reset to a random entry of the reset bank, without pipeline_init.
+
+        With clip logits bound, clips are drawn with the bound probabilities:
+        each entry is weighted by its clip's probability over the number of
+        entries of that clip.
+        The derived fields of the returned pipeline state other than xpos are
+        the template's (see ResetBank).
+        """
+        _, idx_rng, noise_rng = jax.random.split(rng, 3)
+        if self._clip_logits is None:
+            idx = jax.random.randint(idx_rng, (), 0, self._reset_bank.qpos.shape[0])
+        else:
+            idx = jax.random.categorical(
+                idx_rng,
+                self._clip_logits[self._reset_bank.clip_idx]
+                - self._reset_bank.clip_log_count,
+            )
+        entry = jax.tree.map(lambda x: x[idx], self._reset_bank)
+
+        info = self._reset_info(entry.clip_idx, entry.start_frame)
+        if self._interpolate_reference:
+            info["cur_frame"] = jp.asarray(info["cur_frame"], jp.float32)
+        reference_window = self._get_reference_window(info)
+
+        qpos, qvel = self._add_reset_noise(noise_rng, entry.qpos, noise)
+        data = self._reset_template.replace(
+            qpos=qpos, qvel=qvel, q=qpos, qd=qvel, xpos=entry.xpos
+        )
+        obs, metrics, info = self._reset_tracking(data, info, reference_window)
+        metrics.update({name: jp.zeros(()) for name in self._physics_metric_names()})
+
+        reward, done = jp.zeros(2)
+        return State(data, obs, reward, done, metrics, info)
 
     def reset_from_clip(self, rng, info, noise=True) -> State:
         """Reset based on a reference clip."""
-        _, rng1, rng2 = jax.random.split(rng, 3)
+        qpos, qvel, reference_window = self._reference_qpos_qvel(rng, info, noise)
+        data = self.pipeline_init(qpos, qvel)
+        obs, metrics, info = self._reset_tracking(data, info, reference_window)
+        metrics.update({name: jp.zeros(()) for name in self._physics_metric_names()})
 
-        # Get reference clip and select the start frame
-        reference_frame = jax.tree.map(
-            lambda x: x[info["cur_frame"]], self._get_reference_clip(info)
+        reward, done = jp.zeros(2)
+        return State(data, obs, reward, done, metrics, info)
+
+    @property
+    def n_clips(self) -> int:
+        """Number of clips in the library."""
+        return 1
+
+    @property
+    def pose_index(self) -> Optional[PoseIndex]:
+        """The nearest-reference-pose index, if built."""
+        return self._pose_index
+
+    def build_pose_index(
+        self, n_cells: Optional[int] = None, n_dims: int = 16, n_iters: int = 10
+    ):
+        """Indexes the pose of every valid start frame of the clip library.
+
+        See pose_index. Call again after changing the clip library.
+        """
+        clips, clip_lengths = self._clip_library()
+        descriptors = pose_descriptor(
+            clips.position.astype(jp.float32),
+            clips.quaternion.astype(jp.float32),
+            clips.body_positions[..., self._ref_feature_body_idxs, :].astype(
+                jp.float32
+            ),
+        )
+        num_starts = np.maximum(clip_lengths - self._ref_len, 1)
+        clip_idx, frames = np.nonzero(
+            np.arange(descriptors.shape[1])[None] < num_starts[:, None]
+        )
+        self._pose_index = build_pose_index(
+            np.asarray(descriptors)[clip_idx, frames],
+            clip_idx,
+            frames,
+            n_cells=n_cells,
+            n_dims=n_dims,
+            n_iters=n_iters,
+        )
+        print(
+            f"Pose index: {len(clip_idx)} frames in "
+            f"{self._pose_index.centroids.shape[0]} cells, "
+            f"{pose_index_nbytes(self._pose_index) / 1e6:.2f} MB"
         )
 
-        low, hi = -self._reset_noise_scale, self._reset_noise_scale
+    def nearest_reference_frame(self, data, n_probe: int = 4, clip_idx=None):
+        """Indexed (clip, frame) whose pose is closest to the rodent's in
+        `data` (qpos and xpos), optionally within clip `clip_idx`. Under jit,
+        wrap the caller with with_buffers so the index is an argument.
+
+        Returns the clip index, frame and squared distance of the match (inf
+        if `clip_idx` has no frame in the probed cells). vmap for a batch.
+        """
+        descriptor = pose_descriptor(
+            data.qpos[:3], data.qpos[3:7], data.xpos[self._feature_body_idxs]
+        )
+        return query_pose_index(self._pose_index, descriptor, n_probe, clip_idx)
+
+    def pose_reset_info(self, data, n_probe: int = 4):
+        """Reset info starting at the reference frame closest to the pose in
+        `data`, e.g. to seed an episode or restart after a fall; pass it to
+        reset_from_clip."""
+        clip_idx, frame, _ = self.nearest_reference_frame(data, n_probe)
+        info = self._reset_info(clip_idx, frame)
+        if self._interpolate_reference:
+            info["cur_frame"] = jp.asarray(info["cur_frame"], jp.float32)
+        return info
+
+    def resync_cur_frame(self, state: State, n_probe: int = 4) -> State:
+        """Moves info["cur_frame"] to the frame of the current clip closest to
+        the rodent's pose, e.g. when it lags behind the reference. Kept as is if
+        no frame of the clip is found. The observation follows on the next
+        step."""
+        info = dict(state.info)
+        _, frame, dist = self.nearest_reference_frame(
+            state.pipeline_state, n_probe, info.get("clip_idx", 0)
+        )
+        found = jp.isfinite(dist)
+        info["cur_frame"] = jp.where(
+            found, frame, info["cur_frame"]
+        ).astype(info["cur_frame"].dtype)
+        info["steps_taken_cur_frame"] = jp.where(
+            found, 0, info["steps_taken_cur_frame"]
+        )
+        return state.replace(info=info)
+
+    def _clip_library(self):
+        """The clips stacked along a leading clip axis, and their lengths."""
+        clip = self.reference_clips
+        return jax.tree.map(lambda x: x[None], clip), np.array(
+            [clip.position.shape[0]]
+        )
+
+    def _reference_qpos_qvel(self, rng, info, noise=True):
+        """Initial walker qpos/qvel at the start frame of the reference, with
+        optional uniform noise. Also returns the gathered reference window."""
+        _, rng1, rng2 = jax.random.split(rng, 3)
+
+        if self._interpolate_reference:
+            info["cur_frame"] = jp.asarray(info["cur_frame"], jp.float32)
+
+        # Gather the start frame and the look-ahead trajectory
+        reference_window = self._get_reference_window(info)
+        reference_frame = jax.tree.map(lambda x: x[0], reference_window)
 
         # Add pos
-        qpos_with_pos = jp.array(self.sys.qpos0).at[:3].set(reference_frame.position)
+        qpos_with_pos = self._walker_qpos0.at[:3].set(reference_frame.position)
 
         # Add quat
         new_qpos = qpos_with_pos.at[3:7].set(reference_frame.quaternion)
 
-        # Add noise
-        qpos = new_qpos + jp.where(
+        qpos, qvel = self._add_reset_noise(rng1, new_qpos, noise)
+        return qpos, qvel, reference_window
+
+    def _add_reset_noise(self, rng, qpos, noise=True):
+        """Adds uniform reset noise to `qpos` and samples a noisy qvel."""
+        low, hi = -self._reset_noise_scale, self._reset_noise_scale
+        nq, nv = self._walker_qpos0.shape[0], self._walker_nv
+
+        qpos = qpos + jp.where(
             noise,
-            jax.random.uniform(rng1, (self.sys.nq,), minval=low, maxval=hi),
-            jp.zeros((self.sys.nq,)),
+            jax.random.uniform(rng, (nq,), minval=low, maxval=hi),
+            jp.zeros((nq,)),
         )
 
         qvel = jp.where(
             noise,
-            jax.random.uniform(rng1, (self.sys.nv,), minval=low, maxval=hi),
-            jp.zeros((self.sys.nv,)),
+            jax.random.uniform(rng, (nv,), minval=low, maxval=hi),
+            jp.zeros((nv,)),
         )
+        return qpos, qvel
 
-        data = self.pipeline_init(qpos, qvel)
-
-        reference_obs, proprioceptive_obs = self._get_obs(data, info)
+    def _reset_tracking(self, data, info, reference_window):
+        """Observation and zeroed metrics of a freshly reset walker."""
+        features = self._get_tracking_features(data, reference_window)
+        reference_obs, proprioceptive_obs = self._get_obs(data, features)
 
-        # Used to intialize our intention network
-        info["reference_obs_size"] = reference_obs.shape[-1]
+        info["truncation"] = 0.0
 
         obs = jp.concatenate([reference_obs, proprioceptive_obs])
 
-        reward, done, zero = jp.zeros(3)
-        metrics = {
-            "pos_reward": zero,
-            "quat_reward": zero,
-            "joint_reward": zero,
-            "angvel_reward": zero,
-            "bodypos_reward": zero,
-            "endeff_reward": zero,
-            "reward_ctrlcost": zero,
-            "ctrl_diff_cost": zero,
-            "too_far": zero,
-            "bad_pose": zero,
-            "bad_quat": zero,
-            "fall": zero,
-        }
-
-        return State(data, obs, reward, done, metrics, info)
+        metrics = {name: jp.zeros(()) for name in self._metric_names()}
+        return obs, metrics, info
+
+    def _metric_names(self):
+        """Names of the metrics step reports at the current metrics_level."""
+        if self._metrics_level == "off":
+            return list(self._health_metric_names)
+        if self._metrics_level == "summary":
+            return [f"{term.name}_reward" for term in self._reward_terms] + [
+                "reward_ctrlcost",
+                "ctrl_diff_cost",
+                "too_far",
+                "bad_pose",
+                "bad_quat",
+                "fall",
+                *self._health_metric_names,
+            ]
+        return [
+            "pos_reward",
+            "quat_reward",
+            "joint_reward",
+            "angvel_reward",
+            "bodypos_reward",
+            "endeff_reward",
+            "reward_ctrlcost",
+            "ctrl_diff_cost",
+            "too_far",
+            "bad_pose",
+            "bad_quat",
+            "fall",
+            *self._health_metric_names,
+        ]
+
+    @contextlib.contextmanager
+    def bind_metrics_level(self, metrics_level: str):
+        """Temporarily steps at `metrics_level`, e.g. while tracing a
+        diagnostic rollout of an env built for lean training."""
+        stored = self._metrics_level
+        self._metrics_level = metrics_level
+        try:
+            yield
+        finally:
+            self._metrics_level = stored
+
+    def with_metrics_level(self, metrics_level: str, fn: Callable) -> Callable:
+        """Wraps `fn` so it is traced at `metrics_level`."""
+
+        def wrapped(*args, **kwargs):
+            with self.bind_metrics_level(metrics_level):
+                return fn(*args, **kwargs)
+
+        return wrapped
 
     def step(self, state: State, action: jp.ndarray) -> State:
         """Runs one timestep of the environment's dynamics."""
         data0 = state.pipeline_state
         data = self.pipeline_step(data0, action)
 
-        # Logic for moving to next frame to track to maintain timesteps alignment
-        # TODO: Update this to just refer to model.timestep
-        info = state.info.copy()
-        info["steps_taken_cur_frame"] += 1
-        info["cur_frame"] += jp.where(
-            info["steps_taken_cur_frame"] == self._steps_for_cur_frame, 1, 0
-        )
-        info["steps_taken_cur_frame"] *= jp.where(
-            info["steps_taken_cur_frame"] == self._steps_for_cur_frame, 0, 1
-        )
-
-        # Gets reference clip and indexes to current frame
-        reference_clip = jax.tree.map(
-            lambda x: x[info["cur_frame"]], self._get_reference_clip(info)
+        obs, reward, done, metrics, info = self._tracking_step(
+            data, state.info.copy(), action
         )
+        state.metrics.update(**metrics, **self._get_physics_metrics(data))
 
-        pos_distance = data.qpos[:3] - reference_clip.position
-        pos_reward = self._pos_reward_weight * jp.exp(-400 * jp.sum(pos_distance**2))
-
-        quat_distance = jp.sum(
-            _bounded_quat_dist(data.qpos[3:7], reference_clip.quaternion) ** 2
+        return state.replace(
+            pipeline_state=data, obs=obs, reward=reward, done=done, info=info
         )
-        quat_reward = self._quat_reward_weight * jp.exp(-4.0 * quat_distance)
 
-        joint_distance = jp.sum((data.qpos[7:] - reference_clip.joints) ** 2)
-        joint_reward = self._joint_reward_weight * jp.exp(-0.25 * joint_distance)
-        info["joint_distance"] = joint_distance
+    def _tracking_step(self, data, info, action):
+        """Advances the reference and computes obs, reward, done and metrics
+        for one walker after the physics step. `data` only needs qpos, qvel and
+        xpos (plus the health-checked fields)."""
+        # Logic for moving to next frame to track to maintain timesteps alignment
+        # TODO: Update this to just refer to model.timestep
+        if self._interpolate_reference:
+            info["cur_frame"] += self._frames_per_control_step
+        else:
+            info["steps_taken_cur_frame"] += 1
+            info["cur_frame"] += jp.where(
+                info["steps_taken_cur_frame"] == self._steps_for_cur_frame, 1, 0
+            )
+            info["steps_taken_cur_frame"] *= jp.where(
+                info["steps_taken_cur_frame"] == self._steps_for_cur_frame, 0, 1
+            )
 
-        angvel_reward = self._angvel_reward_weight * jp.exp(
-            -0.5 * jp.sum((data.qvel[3:6] - reference_clip.angular_velocity) ** 2)
-        )
+        # Gathers the current frame and the look-ahead trajectory in one pass,
+        # and computes every difference to it once for rewards and obs
+        reference_window = self._get_reference_window(info)
+        features = self._get_tracking_features(data, reference_window)
 
-        bodypos_reward = self._bodypos_reward_weight * jp.exp(
-            -8.0
-            * jp.sum(
-                (
-                    data.xpos[self._body_idxs]
-                    - reference_clip.body_positions[self._body_idxs]
-                ).flatten()
-                ** 2
-            )
-        )
+        rewards = self._get_tracking_rewards(features)
 
-        endeff_reward = self._endeff_reward_weight * jp.exp(
-            -500
-            * jp.sum(
-                (
-                    data.xpos[self._endeff_idxs]
-                    - reference_clip.body_positions[self._endeff_idxs]
-                ).flatten()
-                ** 2
-            )
-        )
+        quat_distance = jp.sum(features["quaternion"] ** 2)
+        joint_distance = jp.sum(features["joints"] ** 2)
 
         min_z, max_z = self._healthy_z_range
         is_healthy = jp.where(data.xpos[self._torso_idx][2] < min_z, 0.0, 1.0)
         is_healthy = jp.where(data.xpos[self._torso_idx][2] > max_z, 0.0, is_healthy)
         fall = 1.0 - is_healthy
 
-        summed_pos_distance = jp.sum((pos_distance * jp.array([1.0, 1.0, 0.2])) ** 2)
+        summed_pos_distance = jp.sum(
+            (features["position"] * jp.array([1.0, 1.0, 0.2])) ** 2
+        )
         too_far = jp.where(summed_pos_distance > self._too_far_dist, 1.0, 0.0)
-        info["summed_pos_distance"] = summed_pos_distance
-        info["quat_distance"] = quat_distance
+        if self._metrics_level == "full":
+            info["summed_pos_distance"] = summed_pos_distance
+            info["quat_distance"] = quat_distance
+            info["joint_distance"] = joint_distance
         bad_pose = jp.where(joint_distance > self._bad_pose_dist, 1.0, 0.0)
         bad_quat = jp.where(quat_distance > self._bad_quat_dist, 1.0, 0.0)
         ctrl_cost = self._ctrl_cost_weight * jp.sum(jp.square(action))
@@ -368,18 +857,9 @@ class RodentTracking(PipelineEnv):
             jp.square(info["prev_ctrl"] - action)
         )
         info["prev_ctrl"] = action
-        reference_obs, proprioceptive_obs = self._get_obs(data, info)
+        reference_obs, proprioceptive_obs = self._get_obs(data, features)
         obs = jp.concatenate([reference_obs, proprioceptive_obs])
-        reward = (
-            joint_reward
-            + pos_reward
-            + quat_reward
-            + angvel_reward
-            + bodypos_reward
-            + endeff_reward
-            - ctrl_cost
-            - ctrl_diff_cost
-        )
+        reward = sum(rewards.values()) - ctrl_cost - ctrl_diff_cost
 
         # Raise done flag if terminating
         done = jp.max(jp.array([fall, too_far, bad_pose, bad_quat]))
@@ -388,80 +868,355 @@ class RodentTracking(PipelineEnv):
         reward = jp.nan_to_num(reward)
         obs = jp.nan_to_num(obs)
 
-        from jax.flatten_util import ravel_pytree
-
-        flattened_vals, _ = ravel_pytree(data)
-        num_nans = jp.sum(jp.isnan(flattened_vals))
-        nan = jp.where(num_nans > 0, 1.0, 0.0)
+        health_metrics = self._get_health_metrics(data)
+        nan = jp.max(jp.array(list(health_metrics.values())))
         done = jp.max(jp.array([nan, done]))
 
-        state.metrics.update(
-            pos_reward=pos_reward,
-            quat_reward=quat_reward,
-            joint_reward=joint_reward,
-            angvel_reward=angvel_reward,
-            bodypos_reward=bodypos_reward,
-            endeff_reward=endeff_reward,
+        # Truncate once the look-ahead window would run past the clip end
+        reference_ended = jp.where(
+            info["cur_frame"] + self._ref_len >= self._get_clip_length(info), 1.0, 0.0
+        )
+        info["truncation"] = reference_ended * (1.0 - done)
+        done = jp.max(jp.array([reference_ended, done]))
+
+        metrics = dict(
+            **rewards,
             reward_ctrlcost=-ctrl_cost,
             ctrl_diff_cost=ctrl_diff_cost,
             too_far=too_far,
             bad_pose=bad_pose,
             bad_quat=bad_quat,
             fall=fall,
+            **health_metrics,
         )
+        metrics = {name: metrics[name] for name in self._metric_names()}
+        return obs, reward, done, metrics, info
+
+    def _get_health_metrics(self, data: mjx.Data) -> Dict[str, jp.ndarray]:
+        """Flags (1.0) each checked field of `data` that holds a NaN or Inf.
+
+        Each leaf is reduced in place, so the state is never flattened into one
+        buffer. Summed over an episode by the episode wrapper, the flags count
+        NaN/Inf events per field. The check runs on every step: skipping it on
+        most steps with lax.cond saves nothing under vmap, where the cond
+        becomes a select that evaluates both branches, so the cost is kept
+        down by checking few fields instead.
+        """
+        if self._health_check_fields is None:
+            checked = {"nonfinite_data": data}
+        else:
+            checked = {
+                f"nonfinite_{field}": getattr(data, field)
+                for field in self._health_check_fields
+            }
+
+        return {
+            name: jp.any(
+                jp.array(
+                    [
+                        jp.any(~jp.isfinite(x))
+                        for x in jax.tree.leaves(value)
+                        if jp.issubdtype(x.dtype, jp.inexact)
+                    ]
+                    + [False]
+                )
+            ).astype(jp.float32)
+            for name, value in checked.items()
+        }
 
-        return state.replace(
-            pipeline_state=data, obs=obs, reward=reward, done=done, info=info
+    def _physics_metric_names(self):
+        """Names of the metrics _get_physics_metrics reports."""
+        if not self._physics_metrics:
+            return []
+        return [
+            "physics_contacts",
+            "physics_penetration",
+            "physics_constraints",
+            "physics_solver_iterations",
+        ]
+
+    def _get_physics_metrics(self, data: mjx.Data) -> Dict[str, jp.ndarray]:
+        """Contact, constraint and solver statistics of the last physics
+        substep, if physics_metrics is set.
+
+        physics_contacts counts the contacts within their margin and
+        physics_penetration is the deepest of them (m). physics_constraints
+        counts the constraint rows with a nonzero Jacobian, out of the nefc rows
+        MJX always allocates, and physics_solver_iterations is the iteration
+        count of the constraint solver; MJX does not expose its residual.
+        Summed over an episode by the episode wrapper; the evaluator also
+        reports them per step.
+        """
+        if not self._physics_metrics:
+            return {}
+        contact = data.contact
+        active = contact.dist < contact.includemargin
+        return {
+            "physics_contacts": jp.sum(active).astype(jp.float32),
+            "physics_penetration": jp.max(
+                jp.where(active, -contact.dist, 0.0), initial=0.0
+            ),
+            "physics_constraints": jp.sum(jp.any(data.efc_J != 0, axis=-1)).astype(
+                jp.float32
+            ),
+            "physics_solver_iterations": jp.asarray(
+                data.solver_niter, jp.float32
+            ),
+        }
+
+    def _get_tracking_features(
+        self, data: mjx.Data, reference_window: ReferenceClip
+    ) -> Dict[str, jp.ndarray]:
+        """Differences between the rodent and the reference window.
+
+        Each difference is computed once over the whole window: row 0 (the
+        tracked frame) feeds the rewards and terminations, rows 1: feed the
+        observation. Keys without a `traj_` prefix refer to the tracked frame.
+        """
+        pos = reference_window.position - data.qpos[:3]
+        joints = reference_window.joints - data.qpos[7:]
+        body_pos = (
+            reference_window.body_positions[:, self._ref_feature_body_idxs]
+            - data.xpos[self._feature_body_idxs]
         )
 
+        features = {
+            "position": pos[0],
+            "quaternion": _bounded_quat_dist(
+                data.qpos[3:7], reference_window.quaternion[0]
+            ),
+            "joints": joints[0],
+            "body_positions": body_pos[0],
+            "traj_position": pos[1:],
+            "traj_quaternion": reference_window.quaternion[1:],
+            "traj_joints": joints[1:],
+            "traj_body_positions": body_pos[1:, self._feature_tracked_idxs],
+        }
+        if any(term.feature == "angular_velocity" for term in self._reward_terms):
+            features["angular_velocity"] = (
+                data.qvel[3:6] - reference_window.angular_velocity[0]
+            )
+        return features
+
+    def _get_tracking_rewards(
+        self, features: Dict[str, jp.ndarray]
+    ) -> Dict[str, jp.ndarray]:
+        """Evaluates the reward term table; dropped terms are reported as 0."""
+        rewards = {
+            f"{name}_reward": jp.zeros(())
+            for name in ["pos", "quat", "joint", "angvel", "bodypos", "endeff"]
+        }
+        for term in self._reward_terms:
+            feature = features[term.feature]
+            if term.idxs is not None:
+                feature = feature[term.idxs]
+            rewards[f"{term.name}_reward"] = term.weight * jp.exp(
+                -term.scale * jp.sum(feature**2)
+            )
+        return rewards
+
+    def _required_reference_fields(self):
+        """ReferenceClip fields read by reset, step and _get_obs."""
+        fields = ["position", "quaternion", "joints", "body_positions"]
+        if any(term.feature == "angular_velocity" for term in self._reward_terms):
+            fields.append("angular_velocity")
+        return fields
+
+    def _prepare_reference_clip(self, reference_clip):
+        """Compacts the reference clip(s) if requested, keeping only the fields
+        and bodies this env reads, stored as `reference_dtype`."""
+        if reference_clip is None or not self._compact_reference_clips:
+            return reference_clip
+
+        reference_clip, saved = compact_reference_clip(
+            reference_clip,
+            self._required_reference_fields(),
+            body_idxs=self._ref_body_subset,
+            dtype=self._reference_dtype,
+        )
+        print(f"Compacted reference clips, saved {saved / 1e6:.2f} MB")
+        return reference_clip
+
+    @property
+    def reference_clips(self) -> ReferenceClip:
+        """The reference clip (library) read by reset and step."""
+        return self._reference_clip
+
+    @reference_clips.setter
+    def reference_clips(self, reference_clips: ReferenceClip):
+        self._reference_clip = reference_clips
+
+    @contextlib.contextmanager
+    def bind_reference_clips(self, reference_clips: ReferenceClip):
+        """Temporarily reads the reference clips from `reference_clips`.
+
+        Used while tracing, so the library enters jitted code as an argument
+        instead of being captured from `self` as a constant.
+        """
+        stored = self.reference_clips
+        self.reference_clips = reference_clips
+        try:
+            yield
+        finally:
+            self.reference_clips = stored
+
+    def with_reference_clips(self, fn: Callable) -> Callable:
+        """Wraps `fn` so it takes the reference clips as its first argument.
+
+        Jitting (or pmapping) the returned function makes the clip library a
+        runtime device buffer rather than an HLO constant, so compile time and
+        executable size do not grow with the number of clips, and every jitted
+        function can share one copy of the library on each device.
+        """
+
+        def wrapped(reference_clips, *args, **kwargs):
+            with self.bind_reference_clips(reference_clips):
+                return fn(*args, **kwargs)
+
+        return wrapped
+
+    @property
+    def buffers(self) -> EnvBuffers:
+        """The clip library, reset bank, pose index and other built device
+        arrays; pass them to functions wrapped by with_buffers."""
+        return EnvBuffers(
+            reference_clips=self.reference_clips,
+            reset_bank=self._reset_bank,
+            reset_template=self._reset_template,
+            pose_index=self._pose_index,
+        )
+
+    @contextlib.contextmanager
+    def bind_buffers(self, buffers: EnvBuffers):
+        """Temporarily reads the clip library, reset bank and other built
+        arrays from `buffers`, like bind_reference_clips."""
+        stored = self.buffers
+        self.reference_clips = buffers.reference_clips
+        self._reset_bank = buffers.reset_bank
+        self._reset_template = buffers.reset_template
+        self._pose_index = buffers.pose_index
+        try:
+            yield
+        finally:
+            self.reference_clips = stored.reference_clips
+            self._reset_bank = stored.reset_bank
+            self._reset_template = stored.reset_template
+            self._pose_index = stored.pose_index
+
+    def with_buffers(self, fn: Callable) -> Callable:
+        """Wraps `fn` so it takes env.buffers as its first argument.
+
+        Like with_reference_clips, for envs that also hold a reset bank or a
+        pose index: the bank, its template mjx.Data and the index become
+        runtime device buffers too.
+        """
+
+        def wrapped(buffers, *args, **kwargs):
+            with self.bind_buffers(buffers):
+                return fn(*args, **kwargs)
+
+        return wrapped
+
+    @contextlib.contextmanager
+    def bind_clip_logits(self, clip_logits: jp.ndarray):
+        """Temporarily draws the clips of resets from `clip_logits` (one
+        log-weight per clip) instead of uniformly; see clip_sampler."""
+        stored = self._clip_logits
+        self._clip_logits = clip_logits
+        try:
+            yield
+        finally:
+            self._clip_logits = stored
+
     def _get_reference_clip(self, info) -> ReferenceClip:
         """Returns reference clip; to be overridden in child classes"""
         return self._reference_clip
 
-    def _get_reference_trajectory(self, info) -> ReferenceClip:
-        """Slices ReferenceClip into the observation trajectory"""
+    def _get_clip_length(self, info):
+        """Number of valid frames in the current clip"""
+        return self._reference_clip.position.shape[0]
 
-        # Get the relevant slice of the reference clip
-        def f(x):
-            if len(x.shape) != 1:
-                return jax.lax.dynamic_slice_in_dim(
-                    x,
-                    info["cur_frame"] + 1,
-                    self._ref_len,
-                )
-            return jp.array([])
+    def _get_max_clip_length(self) -> int:
+        """Length of the longest clip"""
+        return self._reference_clip.position.shape[0]
 
-        return jax.tree_util.tree.map(f, self._get_reference_clip(info))
-
-    def _get_obs(self, data: mjx.Data, info) -> jp.ndarray:
-        """Observes rodent body position, velocities, and angles."""
+    @property
+    def max_episode_length(self) -> int:
+        """Control steps from frame 0 until the longest clip's reference ends."""
+        return int(
+            (self._get_max_clip_length() - self._ref_len) * self._steps_for_cur_frame
+        )
 
-        ref_traj = self._get_reference_trajectory(info)
+    def _sample_start_frame(self, rng, clip_length) -> jp.ndarray:
+        """Samples a start frame whose look-ahead window lies inside the clip,
+        below `max_start_frame` if set."""
+        num_starts = jp.maximum(clip_length - self._ref_len, 1)
+        if self._max_start_frame is not None:
+            num_starts = jp.minimum(num_starts, self._max_start_frame)
+        return jax.random.randint(rng, (), 0, num_starts)
+
+    def _get_window_frames(self, info, clip_length: int) -> jp.ndarray:
+        """Frame indices of the current frame followed by the `ref_len` look-ahead
+        frames, clamped to the last frame of the clip."""
+        frames = info["cur_frame"] + jp.arange(self._ref_len + 1)
+        return jp.minimum(frames, clip_length - 1)
+
+    def _gather_frames(self, info, frames: jp.ndarray) -> ReferenceClip:
+        """Gathers `frames` of the current clip, upcast to float32."""
+        clip = self._get_reference_clip(info)
+        return jax.tree.map(lambda x: x[frames].astype(jp.float32), clip)
+
+    def _get_reference_window(self, info) -> ReferenceClip:
+        """Gathers the current frame and the `ref_len` look-ahead frames.
+
+        Index 0 of every field is the frame being tracked; indices 1: are the
+        observation trajectory. Only these `ref_len + 1` frames are read, the
+        rest of the clip is never copied. With interpolate_reference, the
+        frames are at fractional times and are interpolated between their two
+        neighbouring mocap frames.
+        """
+        clip_length = self._get_clip_length(info)
+        if not self._interpolate_reference:
+            return self._gather_frames(
+                info, self._get_window_frames(info, clip_length)
+            )
 
-        track_pos_local = jax.vmap(
-            lambda a, b: brax_math.rotate(a, b), in_axes=(0, None)
-        )(
-            ref_traj.position - data.qpos[:3],
-            data.qpos[3:7],
-        ).flatten()
+        times = info["cur_frame"] + jp.arange(self._ref_len + 1)
+        frames = jp.floor(times).astype(jp.int32)
+        alpha = times - frames
+        lo = self._gather_frames(info, jp.minimum(frames, clip_length - 1))
+        hi = self._gather_frames(info, jp.minimum(frames + 1, clip_length - 1))
+        return _interpolate_clip(lo, hi, alpha)
 
-        quat_dist = jax.vmap(
-            lambda a, b: brax_math.relative_quat(a, b), in_axes=(0, None)
-        )(
-            ref_traj.quaternion,
-            data.qpos[3:7],
-        ).flatten()
+    def _get_reference_trajectory(self, info) -> ReferenceClip:
+        """Slices ReferenceClip into the observation trajectory"""
+        return jax.tree.map(lambda x: x[1:], self._get_reference_window(info))
 
-        joint_dist = (ref_traj.joints - data.qpos[7:])[:, self._joint_idxs].flatten()
+    def _get_obs(
+        self, data: mjx.Data, features: Dict[str, jp.ndarray]
+    ) -> jp.ndarray:
+        """Observes rodent body position, velocities, and angles."""
 
-        body_pos_dist_local = jax.vmap(
-            lambda a, b: jax.vmap(brax_math.rotate, in_axes=(0, None))(a, b),
-            in_axes=(0, None),
-        )(
-            (ref_traj.body_positions - data.xpos)[:, self._body_idxs],
-            data.qpos[3:7],
+        # Root rotation built once and applied to the track position and every
+        # body offset of the window in a single contraction
+        root_quat = data.qpos[3:7]
+        root_rot = brax_math.quat_to_3x3(root_quat)
+        offsets = jp.concatenate(
+            [features["traj_position"][:, None], features["traj_body_positions"]],
+            axis=1,
+        )
+        offsets_local = offsets @ root_rot.T
+        track_pos_local = offsets_local[:, 0].flatten()
+        body_pos_dist_local = offsets_local[:, 1:].flatten()
+
+        # relative_quat(ref, root) == root * inv(ref), linear in inv(ref)
+        quat_dist = (
+            brax_math.quat_inv(features["traj_quaternion"])
+            @ _quat_mul_matrix(root_quat).T
         ).flatten()
 
+        joint_dist = features["traj_joints"][:, self._joint_idxs].flatten()
+
         reference_obs = jp.concatenate(
             [
                 track_pos_local,
@@ -503,6 +1258,18 @@ class RodentMultiClipTracking(RodentTracking):
         solver="cg",
         iterations: int = 6,
         ls_iterations: int = 6,
+        compact_reference_clips: bool = False,
+        reference_dtype=None,
+        health_check_fields=("qpos", "qvel"),
+        max_start_frame: Optional[int] = 44,
+        model_cache_dir: Optional[str] = model_cache.CACHE_DIR,
+        contact_policy: Optional[str] = None,
+        jacobian="dense",
+        cone="pyramidal",
+        interpolate_reference: bool = False,
+        clip_lengths=None,
+        metrics_level: str = "full",
+        physics_metrics: bool = False,
         **kwargs,
     ):
         super().__init__(
@@ -526,31 +1293,353 @@ class RodentMultiClipTracking(RodentTracking):
             solver,
             iterations,
             ls_iterations,
+            compact_reference_clips,
+            reference_dtype,
+            health_check_fields,
+            max_start_frame,
+            model_cache_dir,
+            contact_policy,
+            jacobian,
+            cone,
+            interpolate_reference,
+            metrics_level=metrics_level,
+            physics_metrics=physics_metrics,
             **kwargs,
         )
 
-        self._reference_clips = reference_clip
+        self._reference_clips = self._prepare_reference_clip(reference_clip)
         self._n_clips = reference_clip.position.shape[0]
 
-    def reset(self, rng) -> State:
-        """Resets the environment to an initial state."""
-        _, start_rng, clip_rng, rng = jax.random.split(rng, 4)
+        # Clips are padded to a common length; clip_lengths holds the number of
+        # valid frames in each (see pad_reference_clips)
+        if clip_lengths is None:
+            clip_lengths = [reference_clip.position.shape[1]] * self._n_clips
+        self._clip_lengths = jp.asarray(clip_lengths, dtype=jp.int32)
+
+    @property
+    def reference_clips(self) -> ReferenceClip:
+        """The stacked clip library, indexed by info["clip_idx"]."""
+        return self._reference_clips
+
+    @reference_clips.setter
+    def reference_clips(self, reference_clips: ReferenceClip):
+        self._reference_clips = reference_clips
+
+    @property
+    def n_clips(self) -> int:
+        """Number of clips in the library."""
+        return self._n_clips
+
+    def _sample_clip_idx(self, rng, shape=()) -> jp.ndarray:
+        """Draws clips uniformly, or from the bound clip logits."""
+        if self._clip_logits is None:
+            return jax.random.randint(rng, shape, 0, self._n_clips)
+        return jax.random.categorical(rng, self._clip_logits, shape=shape)
+
+    def _sample_reset_info(self, rng):
+        """Info of a reset at a random clip and start frame."""
+        start_rng, clip_rng = jax.random.split(rng)
+
+        clip_idx = self._sample_clip_idx(clip_rng)
+        start_frame = self._sample_start_frame(
+            start_rng, self._get_clip_length({"clip_idx": clip_idx})
+        )
+        return self._reset_info(clip_idx, start_frame)
 
-        start_frame = jax.random.randint(start_rng, (), 0, 44)
-        clip_idx = jax.random.randint(clip_rng, (), 0, self._n_clips)
+    def _reset_info(self, clip_idx, start_frame):
+        """Info of a reset at `start_frame` of clip `clip_idx`."""
         info = {
             "clip_idx": clip_idx,
             "cur_frame": start_frame,
             "steps_taken_cur_frame": 0,
-            "summed_pos_distance": 0.0,
-            "quat_distance": 0.0,
-            "joint_distance": 0.0,
-            "prev_ctrl": jp.zeros((self.sys.nu,)),
+            "prev_ctrl": jp.zeros((self.action_size,)),
         }
+        return self._with_distance_info(info)
 
-        return self.reset_from_clip(rng, info, noise=True)
+    def _clip_library(self):
+        """The stacked clip library and the number of valid frames per clip."""
+        return self.reference_clips, np.asarray(self._clip_lengths)
+
+    def _get_clip_length(self, info):
+        """Number of valid frames in clip info["clip_idx"]"""
+        return self._clip_lengths[info["clip_idx"]]
+
+    def _get_max_clip_length(self) -> int:
+        """Length of the longest clip in the library"""
+        return int(jp.max(self._clip_lengths))
 
     def _get_reference_clip(self, info) -> ReferenceClip:
         """Gets clip based on info["clip_idx"]"""
 
         return jax.tree.map(lambda x: x[info["clip_idx"]], self._reference_clips)
+
+    def _gather_frames(self, info, frames: jp.ndarray) -> ReferenceClip:
+        """Gathers (clip_idx, frame) straight from the stacked clips, one 2-D
+        gather per field instead of copying the whole clip first."""
+        return jax.tree.map(
+            lambda x: x[info["clip_idx"], frames].astype(jp.float32),
+            self._reference_clips,
+        )
+
+
+class _AgentData(NamedTuple):
+    """Per-agent view of the shared mjx.Data read by the tracking helpers."""
+
+    qpos: jp.ndarray
+    qvel: jp.ndarray
+    xpos: jp.ndarray
+
+
+class RodentMultiAgentTracking(RodentMultiClipTracking):
+    """`n_agents` independent rodents in one MJX world, each tracking its own
+    clip of the library.
+
+    The agents share the floor, the solver and the per-world overhead, and
+    only collide with the floor. Observations, rewards, dones, metrics and
+    info entries carry a leading agent axis; `step` takes a batch of
+    (n_agents, action_size) actions. Episodes end per agent, but reset
+    re-initializes the whole world. The auto-reset wrappers of custom_wrappers
+    expect one done flag per env, so custom_wrappers.wrap rejects this env.
+    Reset banks hold single-walker states and are not supported either.
+    """
+
+    _supports_reset_bank = False
+
+    def __init__(
+        self,
+        reference_clip,
+        n_agents: int = 2,
+        torque_actuators: bool = False,
+        ref_len: int = 5,
+        too_far_dist=0.1,
+        bad_pose_dist=jp.inf,
+        bad_quat_dist=jp.inf,
+        ctrl_cost_weight=0.01,
+        ctrl_diff_cost_weight=0.01,
+        pos_reward_weight=1,
+        quat_reward_weight=1,
+        joint_reward_weight=1,
+        angvel_reward_weight=1,
+        bodypos_reward_weight=1,
+        endeff_reward_weight=1,
+        healthy_z_range=(0.03, 0.5),
+        physics_steps_per_control_step=10,
+        reset_noise_scale=0.001,
+        solver="cg",
+        iterations: int = 6,
+        ls_iterations: int = 6,
+        compact_reference_clips: bool = False,
+        reference_dtype=None,
+        health_check_fields=("qpos", "qvel"),
+        max_start_frame: Optional[int] = 44,
+        model_cache_dir: Optional[str] = model_cache.CACHE_DIR,
+        contact_policy: Optional[str] = None,
+        jacobian="dense",
+        cone="pyramidal",
+        interpolate_reference: bool = False,
+        clip_lengths=None,
+        metrics_level: str = "full",
+        physics_metrics: bool = False,
+        **kwargs,
+    ):
+        if health_check_fields != "all" and not set(health_check_fields) <= set(
+            _AgentData._fields
+        ):
+            raise ValueError(
+                f"health_check_fields ({health_check_fields}) must be 'all' or "
+                f"a subset of {_AgentData._fields} with multiple agents"
+            )
+        super().__init__(
+            reference_clip,
+            torque_actuators,
+            ref_len,
+            too_far_dist,
+            bad_pose_dist,
+            bad_quat_dist,
+            ctrl_cost_weight,
+            ctrl_diff_cost_weight,
+            pos_reward_weight,
+            quat_reward_weight,
+            joint_reward_weight,
+            angvel_reward_weight,
+            bodypos_reward_weight,
+            endeff_reward_weight,
+            healthy_z_range,
+            physics_steps_per_control_step,
+            reset_noise_scale,
+            solver,
+            iterations,
+            ls_iterations,
+            compact_reference_clips,
+            reference_dtype,
+            health_check_fields,
+            max_start_frame,
+            model_cache_dir,
+            contact_policy,
+            jacobian,
+            cone,
+            interpolate_reference,
+            clip_lengths,
+            metrics_level=metrics_level,
+            physics_metrics=physics_metrics,
+            **kwargs,
+        )
+
+        # The single-walker system sizes the per-agent obs, clips and actions
+        self.walker_sys = self.sys
+        walker_model = self._walker_mj_model
+        self._n_agents = n_agents
+
+        prefixes = [model_cache.walker_prefix(k) for k in range(n_agents)]
+        body_names = [
+            mujoco.mj_id2name(walker_model, mujoco.mjtObj.mjOBJ_BODY, i)
+            for i in range(1, walker_model.nbody)
+        ]
+        actuator_names = [
+            mujoco.mj_id2name(walker_model, mujoco.mjtObj.mjOBJ_ACTUATOR, i)
+            for i in range(walker_model.nu)
+        ]
+        contact_pairs = None
+        if contact_policy is not None:
+            contact_pairs = [
+                tuple(
+                    [
+                        name if name == "floor" else p + name
+                        for p in prefixes
+                        for name in names
+                    ]
+                    for names in pair
+                )
+                for pair in _CONTACT_POLICIES[contact_policy]
+            ]
+        mj_model, index_tables = model_cache.load_model(
+            _XML_PATH,
+            0.9,
+            torque_actuators,
+            index_names={
+                "agent_body_idxs": (
+                    "body",
+                    [p + name for p in prefixes for name in body_names],
+                ),
+                "agent_act_idxs": (
+                    "actuator",
+                    [p + name for p in prefixes for name in actuator_names],
+                ),
+            },
+            cache_dir=model_cache_dir,
+            contact_pairs=contact_pairs,
+            n_walkers=n_agents,
+        )
+        print(
+            f"collision pairs ({contact_policy or 'default'}, {n_agents} agents): "
+            f"{model_cache.count_collision_pairs(mj_model)}"
+        )
+        for field in ["solver", "iterations", "ls_iterations", "jacobian", "cone"]:
+            setattr(mj_model.opt, field, getattr(walker_model.opt, field))
+
+        PipelineEnv.__init__(
+            self,
+            mjcf_brax.load_model(mj_model),
+            backend="mjx",
+            n_frames=self._n_frames,
+            debug=self._debug,
+        )
+
+        # World indices of each agent's qpos, qvel, bodies (world body first)
+        # and actuators, laid out like the single-walker model. An agent's
+        # joints follow its root free joint, which sits on the walker body or
+        # on the attachment frame above it.
+        agent_bodies = index_tables["agent_body_idxs"].reshape(n_agents, -1)
+        root_bodies = np.where(
+            mj_model.body_jntnum[agent_bodies[:, 0]] > 0,
+            agent_bodies[:, 0],
+            mj_model.body_parentid[agent_bodies[:, 0]],
+        )
+        root_joints = mj_model.body_jntadr[root_bodies]
+        self._agent_qpos_idxs = jp.array(
+            mj_model.jnt_qposadr[root_joints][:, None] + np.arange(walker_model.nq)
+        )
+        self._agent_qvel_idxs = jp.array(
+            mj_model.jnt_dofadr[root_joints][:, None] + np.arange(walker_model.nv)
+        )
+        self._agent_body_idxs = jp.array(
+            np.concatenate(
+                [np.zeros((n_agents, 1), agent_bodies.dtype), agent_bodies], axis=1
+            )
+        )
+        self._agent_act_idxs = jp.array(
+            index_tables["agent_act_idxs"].reshape(n_agents, -1)
+        )
+
+    @property
+    def n_agents(self) -> int:
+        return self._n_agents
+
+    @property
+    def action_size(self) -> int:
+        """Actions per agent; step takes (n_agents, action_size)."""
+        return self.walker_sys.nu
+
+    def reset(self, rng) -> State:
+        """Resets the environment to an initial state."""
+        _, start_rng, clip_rng, rng = jax.random.split(rng, 4)
+
+        clip_idx = self._sample_clip_idx(clip_rng, (self._n_agents,))
+        start_frame = jax.vmap(self._sample_start_frame)(
+            jax.random.split(start_rng, self._n_agents), self._clip_lengths[clip_idx]
+        )
+        info = jax.vmap(self._reset_info)(clip_idx, start_frame)
+
+        return self.reset_from_clip(rng, info, noise=True)
+
+    def reset_from_clip(self, rng, info, noise=True) -> State:
+        """Reset every agent based on its reference clip."""
+        if self._interpolate_reference:
+            info["cur_frame"] = jp.asarray(info["cur_frame"], jp.float32)
+
+        qpos, qvel, reference_window = jax.vmap(
+            self._reference_qpos_qvel, in_axes=(0, 0, None)
+        )(jax.random.split(rng, self._n_agents), info, noise)
+        data = self.pipeline_init(
+            jp.array(self.sys.qpos0).at[self._agent_qpos_idxs].set(qpos),
+            jp.zeros(self.sys.nv).at[self._agent_qvel_idxs].set(qvel),
+        )
+        obs, metrics, info = jax.vmap(self._reset_tracking)(
+            self._agent_data(data), info, reference_window
+        )
+        metrics.update(
+            {
+                name: jp.zeros(self._n_agents)
+                for name in self._physics_metric_names()
+            }
+        )
+
+        reward, done = jp.zeros((2, self._n_agents))
+        return State(data, obs, reward, done, metrics, info)
+
+    def step(self, state: State, action: jp.ndarray) -> State:
+        """Steps the world with a (n_agents, action_size) batch of actions."""
+        ctrl = jp.zeros(self.sys.nu).at[self._agent_act_idxs].set(action)
+        data = self.pipeline_step(state.pipeline_state, ctrl)
+
+        obs, reward, done, metrics, info = jax.vmap(self._tracking_step)(
+            self._agent_data(data), state.info.copy(), action
+        )
+        # The world's physics statistics are reported for every agent
+        physics_metrics = jax.tree.map(
+            lambda x: jp.broadcast_to(x, (self._n_agents,)),
+            self._get_physics_metrics(data),
+        )
+        state.metrics.update(**metrics, **physics_metrics)
+
+        return state.replace(
+            pipeline_state=data, obs=obs, reward=reward, done=done, info=info
+        )
+
+    def _agent_data(self, data: mjx.Data) -> _AgentData:
+        """Gathers each agent's qpos, qvel and xpos, stacked along axis 0."""
+        return _AgentData(
+            qpos=data.qpos[self._agent_qpos_idxs],
+            qvel=data.qvel[self._agent_qvel_idxs],
+            xpos=data.xpos[self._agent_body_idxs],
+        )
@@ -0,0 +1,69 @@
+"""Env state bytes per env and step time of stored vs lean auto-resets.
+
+Wraps RodentMultiClipTracking with custom_wrappers.wrap in both auto-reset
+modes and times a jitted batched step on CPU over a rollout with random
+actions and short episodes, so that envs finish (and are reset) throughout.
+Also reports how often some env was done, i.e. how often the lean mode had
+to rebuild first states, and how many envs were done per step.
+"""
+
+import time
+
+import jax
+import numpy as np
+from absl import app
+from absl import flags
+
+import custom_wrappers
+from benchmarks.common import make_env, synthetic_library, wrapped_fns
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer("num_envs", 64, "envs stepped in parallel")
+flags.DEFINE_integer("n_clips", 4, "clips in the synthetic library")
+flags.DEFINE_integer("episode_length", 20, "env steps before an episode times out")
+flags.DEFINE_float("action_scale", 1.0, "bound of the random actions")
+flags.DEFINE_integer("n", 100, "number of timed steps per mode")
+
+
+def main(argv):
+    del argv
+    env = make_env(synthetic_library(FLAGS.n_clips))
+    buffers = env.buffers
+    rngs = jax.random.split(jax.random.PRNGKey(0), FLAGS.num_envs)
+    actions = FLAGS.action_scale * jax.random.uniform(
+        jax.random.PRNGKey(1),
+        (FLAGS.n, FLAGS.num_envs, env.action_size),
+        minval=-1.0,
+        maxval=1.0,
+    )
+    for lean in [False, True]:
+        reset, step = wrapped_fns(
+            env, episode_length=FLAGS.episode_length, lean_auto_reset=lean
+        )
+        step = jax.jit(step)
+
+        state = jax.jit(reset)(buffers, rngs)
+        # Compile outside the timed loop
+        jax.block_until_ready(step(buffers, state, actions[0]))
+
+        done = []
+        t = time.time()
+        for action in actions:
+            state = step(buffers, state, action)
+            done.append(state.done)
+        jax.block_until_ready(state)
+        step_time = (time.time() - t) / FLAGS.n
+
+        # Envs done on a step are reset within that step
+        done = np.asarray(done)
+        print(
+            f"{'lean' if lean else 'stored first state'}: "
+            f"{custom_wrappers.state_nbytes(state) / 1e3:.1f} kB state per env, "
+            f"{step_time * 1e3:.2f} ms/step, resets on "
+            f"{np.mean(done.any(axis=1)):.0%} of steps, "
+            f"{np.mean(done.sum(axis=1)):.1f} envs reset per step"
+        )
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,86 @@
+"""Shared helpers for the CPU benchmarks.
+
+Run the benchmarks from the repository root (the env loads ./models/rodent.xml),
+e.g. `python -m benchmarks.step_ops`.
+"""
+
+import re
+import time
+from typing import Callable, Optional, Tuple
+
+import jax
+import mujoco
+from jax import numpy as jp
+
+import custom_wrappers
+import model_cache
+from preprocessing.mjx_preprocess import ReferenceClip
+from Rodent_Env_Brax import _XML_PATH, RodentMultiClipTracking
+
+_HLO_INSTRUCTION = re.compile(r"^\s*(ROOT\s+)?%?[\w.\-]+ = ", re.MULTILINE)
+
+
+def walker_model() -> mujoco.MjModel:
+    """The compiled single-walker model of the tracking envs (scaled by 0.9,
+    as RodentTracking loads it) from the model cache, without building an env."""
+    mj_model, _ = model_cache.load_model(_XML_PATH, 0.9, torque_actuators=True)
+    return mj_model
+
+
+def synthetic_reference_clip(
+    model, n_frames: int = 250, n_clips: Optional[int] = None
+) -> ReferenceClip:
+    """A standing-still ReferenceClip shaped for `model` (a mujoco.MjModel or a
+    brax System, e.g. env.sys), for when no mocap clips are available. Stacked
+    along a leading clip axis if `n_clips` is given."""
+    qpos0 = jp.array(model.qpos0)
+    clip = ReferenceClip(
+        position=jp.tile(qpos0[:3], (n_frames, 1)),
+        quaternion=jp.tile(qpos0[3:7], (n_frames, 1)),
+        joints=jp.tile(qpos0[7:], (n_frames, 1)),
+        body_positions=jp.zeros((n_frames, model.nbody, 3)),
+        velocity=jp.zeros((n_frames, 3)),
+        joints_velocity=jp.zeros((n_frames, model.nv - 6)),
+        angular_velocity=jp.zeros((n_frames, 3)),
+        body_quaternions=jp.tile(
+            jp.array([1.0, 0.0, 0.0, 0.0]), (n_frames, model.nbody, 1)
+        ),
+    )
+    if n_clips is not None:
+        clip = jax.tree.map(lambda x: jp.stack([x] * n_clips), clip)
+    return clip
+
+
+def synthetic_library(n_clips: int, n_frames: int = 250) -> ReferenceClip:
+    """`n_clips` standing-still clips for the walker model."""
+    return synthetic_reference_clip(walker_model(), n_frames, n_clips)
+
+
+def make_env(clips: ReferenceClip, **kwargs) -> RodentMultiClipTracking:
+    """RodentMultiClipTracking on `clips` with torque actuators and 5 physics
+    steps per control step, unless overridden in `kwargs`."""
+    kwargs = {"torque_actuators": True, "physics_steps_per_control_step": 5, **kwargs}
+    return RodentMultiClipTracking(clips, **kwargs)
+
+
+def wrapped_fns(env, **wrap_kwargs) -> Tuple[Callable, Callable]:
+    """reset and step of custom_wrappers.wrap(env, **wrap_kwargs), both taking
+    env.buffers as their first argument, as in training."""
+    wrapped = custom_wrappers.wrap(env, **wrap_kwargs)
+    return env.with_buffers(wrapped.reset), env.with_buffers(wrapped.step)
+
+
+def count_hlo_ops(fn: Callable, *args) -> int:
+    """Number of instructions in the optimized HLO of jax.jit(fn)(*args)."""
+    hlo = jax.jit(fn).lower(*args).compile().as_text()
+    return len(_HLO_INSTRUCTION.findall(hlo))
+
+
+def time_fn(fn: Callable, *args, n: int = 100) -> float:
+    """Mean wall time in seconds of a jitted call, excluding compilation."""
+    jax.block_until_ready(fn(*args))
+    t = time.time()
+    for _ in range(n):
+        out = fn(*args)
+    jax.block_until_ready(out)
+    return (time.time() - t) / n
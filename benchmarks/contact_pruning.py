@@ -0,0 +1,50 @@
+"""Collision pair count and pipeline_step time with and without contact pruning.
+
+Builds RodentTracking with the model's default contype/conaffinity collisions
+and with each contact policy, and times a jitted pipeline_step on CPU from a
+standing pose.
+"""
+
+import jax
+from absl import app
+from absl import flags
+from jax import numpy as jp
+
+import model_cache
+from benchmarks.common import count_hlo_ops, time_fn
+from Rodent_Env_Brax import RodentTracking, _CONTACT_POLICIES
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer("n", 20, "number of timed steps per policy")
+
+
+def main(argv):
+    del argv
+    for policy in [None, *_CONTACT_POLICIES]:
+        env = RodentTracking(
+            None,
+            torque_actuators=True,
+            physics_steps_per_control_step=5,
+            contact_policy=policy,
+        )
+        mj_model, _ = model_cache.load_model(
+            "./models/rodent.xml",
+            0.9,
+            True,
+            contact_pairs=None if policy is None else _CONTACT_POLICIES[policy],
+        )
+        data = jax.jit(env.pipeline_init)(
+            jp.array(env.sys.qpos0), jp.zeros(env.sys.nv)
+        )
+        action = jp.zeros(env.action_size)
+        n_ops = count_hlo_ops(env.pipeline_step, data, action)
+        step_time = time_fn(jax.jit(env.pipeline_step), data, action, n=FLAGS.n)
+        print(
+            f"{policy or 'default'}: "
+            f"{model_cache.count_collision_pairs(mj_model)} collision pairs, "
+            f"{n_ops} HLO ops, {step_time * 1e3:.2f} ms/pipeline_step"
+        )
+
+
+if __name__ == "__main__":
+    app.run(main)
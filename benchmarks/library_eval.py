@@ -0,0 +1,69 @@
+"""Wall time of a whole-library evaluation against per-clip Python rollouts.
+
+Evaluates a zero-action policy on every clip of a synthetic library with
+library_eval.make_library_eval (one compiled call), and with the pattern of
+render_rollout.ipynb: a jitted reset at frame 0 of each clip followed by a
+Python loop of jitted steps.
+"""
+
+import time
+
+import jax
+import numpy as np
+from absl import app
+from absl import flags
+from jax import numpy as jp
+
+from benchmarks.common import make_env, synthetic_library
+from library_eval import make_library_eval
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer("n_clips", 16, "clips in the synthetic library")
+flags.DEFINE_integer("n_steps", 100, "control steps per rollout")
+flags.DEFINE_integer("chunk_size", 8, "clips rolled out in parallel")
+
+
+def main(argv):
+    del argv
+    env = make_env(synthetic_library(FLAGS.n_clips), metrics_level="off")
+    zero_policy = lambda params: lambda obs, key: (jp.zeros(env.action_size), {})
+    key = jax.random.PRNGKey(0)
+
+    library_eval = make_library_eval(
+        env, zero_policy, chunk_size=FLAGS.chunk_size, n_steps=FLAGS.n_steps
+    )
+    t = time.time()
+    jax.block_until_ready(library_eval(env.reference_clips, None, key))
+    compile_time = time.time() - t
+    t = time.time()
+    table = jax.block_until_ready(library_eval(env.reference_clips, None, key))
+    library_time = time.time() - t
+
+    reset = jax.jit(
+        env.with_reference_clips(
+            lambda rng, clip_idx: env.reset_from_clip(
+                rng, env._reset_info(clip_idx, 0), noise=False
+            )
+        )
+    )
+    step = jax.jit(env.with_reference_clips(env.step))
+    action = jp.zeros(env.action_size)
+    t = time.time()
+    for clip_idx in range(FLAGS.n_clips):
+        state = reset(env.reference_clips, key, clip_idx)
+        for _ in range(FLAGS.n_steps):
+            state = step(env.reference_clips, state, action)
+        jax.block_until_ready(state)
+    loop_time = time.time() - t
+
+    print(
+        f"{FLAGS.n_clips} clips x {FLAGS.n_steps} steps: library eval "
+        f"{library_time:.2f} s (compile {compile_time:.1f} s), "
+        f"per-clip loop {loop_time:.2f} s (including compile)"
+    )
+    print(f"mean episode length: {np.mean(table.episode_length):.1f}")
+    print(f"mean errors of the first clip: {np.nanmean(table.errors[0], 0)}")
+
+
+if __name__ == "__main__":
+    app.run(main)
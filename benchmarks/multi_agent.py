@@ -0,0 +1,49 @@
+"""Agent-steps/sec of RodentMultiAgentTracking against the number of agents.
+
+Builds the env for each K in --agents (K = 1 uses RodentMultiClipTracking),
+vmaps it over --num_worlds worlds and times a jitted env.step on CPU with
+zero actions on a standing-still clip library.
+"""
+
+import jax
+from absl import app
+from absl import flags
+from jax import numpy as jp
+
+from benchmarks.common import make_env, synthetic_library, time_fn
+from Rodent_Env_Brax import RodentMultiAgentTracking
+
+FLAGS = flags.FLAGS
+flags.DEFINE_list("agents", ["1", "2", "4", "8"], "agents per world to benchmark")
+flags.DEFINE_integer("num_worlds", 16, "worlds stepped in parallel")
+flags.DEFINE_integer("n_clips", 4, "clips in the synthetic library")
+flags.DEFINE_integer("n", 20, "number of timed steps per K")
+
+
+def main(argv):
+    del argv
+    clips = synthetic_library(FLAGS.n_clips)
+    for n_agents in map(int, FLAGS.agents):
+        if n_agents == 1:
+            env = make_env(clips)
+        else:
+            env = RodentMultiAgentTracking(
+                clips,
+                n_agents=n_agents,
+                torque_actuators=True,
+                physics_steps_per_control_step=5,
+            )
+
+        rngs = jax.random.split(jax.random.PRNGKey(0), FLAGS.num_worlds)
+        state = jax.jit(jax.vmap(env.reset))(rngs)
+        action_shape = (() if n_agents == 1 else (n_agents,)) + (env.action_size,)
+        action = jp.zeros((FLAGS.num_worlds, *action_shape))
+        step_time = time_fn(jax.jit(jax.vmap(env.step)), state, action, n=FLAGS.n)
+        print(
+            f"{n_agents} agents/world: {step_time * 1e3:.2f} ms/step, "
+            f"{n_agents * FLAGS.num_worlds / step_time:.0f} agent-steps/s"
+        )
+
+
+if __name__ == "__main__":
+    app.run(main)
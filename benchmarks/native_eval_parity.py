@@ -0,0 +1,133 @@
+"""Parity and speed of the native MuJoCo eval backend against the MJX env.
+
+Resets RodentMultiClipTracking and a NativeTrackingEnv to the same reference
+frames, then steps both with the same random actions. Before every step the
+native envs are synced to the MJX state, so the differences reported are those
+of a single control step: qpos after the physics, reward, observation and
+done. Also times a control step of each backend on CPU. Exits with status 1 if
+a difference exceeds its tolerance.
+
+    python -m benchmarks.native_eval_parity --clip_path=./clips/coltrane_21_07_28.p
+"""
+
+import pickle
+import time
+
+import jax
+import numpy as np
+from absl import app
+from absl import flags
+from jax import numpy as jp
+
+from benchmarks.common import make_env, synthetic_library
+from native_eval import NativeTrackingEnv
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string("clip_path", None, "pickled ReferenceClip; synthetic if unset")
+flags.DEFINE_integer("num_envs", 16, "envs stepped in parallel")
+flags.DEFINE_integer("n_clips", 4, "clips in the synthetic library")
+flags.DEFINE_integer("n_steps", 50, "control steps compared")
+flags.DEFINE_integer("num_threads", None, "native physics threads")
+flags.DEFINE_float("action_scale", 0.2, "bound of the random actions")
+flags.DEFINE_float("qpos_tol", 1e-3, "allowed qpos difference per step")
+flags.DEFINE_float("reward_tol", 1e-2, "allowed reward difference per step")
+flags.DEFINE_float("obs_tol", 1e-2, "allowed observation difference per step")
+
+
+def _load_clips():
+    if FLAGS.clip_path is None:
+        return synthetic_library(FLAGS.n_clips)
+    with open(FLAGS.clip_path, "rb") as file:
+        clips = pickle.load(file)
+    if clips.position.ndim == 2:
+        clips = jax.tree.map(lambda x: x[None], clips)
+    return clips
+
+
+def main(argv):
+    del argv
+    clips = _load_clips()
+    env = make_env(clips, metrics_level="full")
+    num_envs = FLAGS.num_envs
+    clip_idx = jp.arange(num_envs) % env.n_clips
+    info = jax.vmap(env._reset_info)(clip_idx, jp.zeros(num_envs, jp.int32))
+    rngs = jax.random.split(jax.random.PRNGKey(0), num_envs)
+
+    reset = jax.jit(
+        env.with_reference_clips(
+            jax.vmap(lambda rng, info: env.reset_from_clip(rng, info, noise=False))
+        )
+    )
+    step = jax.jit(env.with_reference_clips(jax.vmap(env.step)))
+    state = reset(env.reference_clips, rngs, info)
+
+    native = NativeTrackingEnv(env, num_envs, FLAGS.num_threads)
+    native_obs, _ = native.reset_from_clip(rngs, info, noise=False)
+    diffs = {"reset obs": [np.max(np.abs(native_obs - np.asarray(state.obs)))]}
+
+    # Compile the MJX step outside the timed loop
+    jax.block_until_ready(
+        step(env.reference_clips, state, jp.zeros((num_envs, env.action_size)))
+    )
+
+    action_rng = jax.random.PRNGKey(1)
+    mjx_time, native_time = 0.0, 0.0
+    for _ in range(FLAGS.n_steps):
+        action_rng, rng = jax.random.split(action_rng)
+        action = jax.random.uniform(
+            rng,
+            (num_envs, env.action_size),
+            minval=-FLAGS.action_scale,
+            maxval=FLAGS.action_scale,
+        )
+        native.set_state(
+            np.asarray(state.pipeline_state.qpos), np.asarray(state.pipeline_state.qvel)
+        )
+        native.info = jax.device_put(state.info, jax.devices("cpu")[0])
+
+        t = time.time()
+        state = jax.block_until_ready(step(env.reference_clips, state, action))
+        mjx_time += time.time() - t
+        t = time.time()
+        obs, reward, done, _ = native.step(np.asarray(action))
+        native_time += time.time() - t
+
+        qpos = native.data().qpos
+        diffs.setdefault("qpos", []).append(
+            np.max(np.abs(qpos - np.asarray(state.pipeline_state.qpos)))
+        )
+        diffs.setdefault("reward", []).append(
+            np.max(np.abs(reward - np.asarray(state.reward)))
+        )
+        diffs.setdefault("obs", []).append(
+            np.max(np.abs(obs - np.asarray(state.obs)))
+        )
+        diffs.setdefault("done", []).append(
+            np.mean(done != np.asarray(state.done))
+        )
+
+    print(
+        f"control step for {num_envs} envs: "
+        f"MJX {mjx_time / FLAGS.n_steps * 1e3:.2f} ms, "
+        f"native {native_time / FLAGS.n_steps * 1e3:.2f} ms"
+    )
+    for name, values in diffs.items():
+        print(f"{name}: max {np.max(values):.2e}, mean {np.mean(values):.2e}")
+
+    tolerances = {
+        "reset obs": FLAGS.obs_tol,
+        "qpos": FLAGS.qpos_tol,
+        "reward": FLAGS.reward_tol,
+        "obs": FLAGS.obs_tol,
+        "done": 0.0,
+    }
+    failed = [name for name, tol in tolerances.items() if np.max(diffs[name]) > tol]
+    if failed:
+        print(f"FAIL: {', '.join(failed)} above tolerance")
+        return 1
+    print("PASS")
+    return 0
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,225 @@
+"""Sweeps MJX physics settings against speed, tracking drift and NaN rate.
+
+Every combination of solver, iterations, ls_iterations,
+physics_steps_per_control_step, jacobian and cone is built on CPU. For each,
+the reference clips are replayed from frame 0 under a PD controller that tracks
+the reference joint angles with the torque actuators. The tool reports
+simulated seconds per wall-clock second, the mean position and joint drift
+from the reference, and the fraction of rollouts that hit a NaN/Inf. The
+physics health metrics (mean active contacts and solver iterations, deepest
+penetration) are reported alongside, for reference only. Settings MJX rejects
+are recorded as unsupported and left out of the comparison.
+
+The Pareto-optimal settings are printed. The recommended one is written as a
+JSON file that load_physics_config (and the training script's
+"physics_config") reads: the fastest Pareto setting with the lowest NaN rate
+whose drift is within --drift_tolerance of the best drift.
+
+    python -m benchmarks.physics_autotune --clip_path=./clips/coltrane_21_07_28.p
+"""
+
+import csv
+import itertools
+import json
+import pickle
+import time
+
+import jax
+import numpy as np
+from absl import app
+from absl import flags
+from jax import numpy as jp
+
+from benchmarks.common import make_env, synthetic_library
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string("clip_path", None, "pickled ReferenceClip; synthetic if unset")
+flags.DEFINE_integer("n_clips", 8, "clips replayed per setting")
+flags.DEFINE_list("solver", ["cg", "newton"], "solvers to sweep")
+flags.DEFINE_list("iterations", ["4", "8"], "solver iterations to sweep")
+flags.DEFINE_list("ls_iterations", ["4", "8"], "linesearch iterations to sweep")
+flags.DEFINE_list("physics_steps_per_control_step", ["5", "10"], "substeps to sweep")
+flags.DEFINE_list("jacobian", ["dense", "sparse"], "jacobian types to sweep")
+flags.DEFINE_list("cone", ["pyramidal", "elliptic"], "friction cones to sweep")
+flags.DEFINE_float("kp", 1.0, "PD position gain")
+flags.DEFINE_float("kd", 0.05, "PD velocity gain")
+flags.DEFINE_float("drift_tolerance", 0.1, "allowed relative drift over the best")
+flags.DEFINE_string("output_path", "physics_config.json", "recommended settings")
+flags.DEFINE_string("results_path", None, "optional CSV of every setting")
+
+
+def _load_clips():
+    if FLAGS.clip_path is None:
+        return synthetic_library(FLAGS.n_clips)
+    with open(FLAGS.clip_path, "rb") as file:
+        clips = pickle.load(file)
+    if clips.position.ndim == 2:
+        clips = jax.tree.map(lambda x: x[None], clips)
+    return jax.tree.map(lambda x: x[: FLAGS.n_clips], clips)
+
+
+def _pd_controller(env):
+    """PD control of the actuated joints towards the tracked reference frame,
+    normalized by the torque actuator gains."""
+    sys = env.sys
+    joints = np.array(sys.actuator_trnid[:, 0])
+    qpos_adr = jp.array(sys.jnt_qposadr[joints])
+    dof_adr = jp.array(sys.jnt_dofadr[joints])
+    gains = jp.array(sys.actuator_gainprm[:, 0])
+
+    def act(state):
+        ref = jax.tree.map(lambda x: x[0], env._get_reference_window(state.info))
+        ref_qpos = jp.concatenate([ref.position, ref.quaternion, ref.joints])
+        data = state.pipeline_state
+        torque = FLAGS.kp * (
+            ref_qpos[qpos_adr] - data.qpos[qpos_adr]
+        ) - FLAGS.kd * (data.qvel[dof_adr])
+        return jp.clip(torque / gains, -1.0, 1.0)
+
+    return act
+
+
+def _benchmark(settings, clips):
+    env = make_env(clips, physics_metrics=True, **settings)
+    act = _pd_controller(env)
+    n_steps = env.max_episode_length
+
+    def rollout(clip_idx):
+        info = env._reset_info(clip_idx, 0)
+        state = env.reset_from_clip(jax.random.PRNGKey(0), info, noise=False)
+
+        def f(state, _):
+            state = env.step(state, act(state))
+            nonfinite = jp.max(
+                jp.array(
+                    [v for k, v in state.metrics.items() if k.startswith("nonfinite")]
+                )
+            )
+            return state, (
+                state.info["summed_pos_distance"],
+                state.info["joint_distance"],
+                nonfinite,
+                state.metrics["physics_contacts"],
+                state.metrics["physics_penetration"],
+                state.metrics["physics_solver_iterations"],
+            )
+
+        _, out = jax.lax.scan(f, state, None, length=n_steps)
+        return out
+
+    run = jax.jit(env.with_reference_clips(jax.vmap(rollout)))
+    clip_idxs = jp.arange(clips.position.shape[0])
+    jax.block_until_ready(run(env.reference_clips, clip_idxs))
+
+    t = time.time()
+    (
+        pos_drift,
+        joint_drift,
+        nonfinite,
+        contacts,
+        penetration,
+        solver_iterations,
+    ) = jax.block_until_ready(run(env.reference_clips, clip_idxs))
+    wall_time = time.time() - t
+
+    failed = np.asarray(jp.max(nonfinite, axis=1)) > 0
+    pos_drift, joint_drift = np.asarray(pos_drift), np.asarray(joint_drift)
+    healthy = ~failed
+    return {
+        "sim_sec_per_sec": len(clip_idxs) * n_steps * env.dt / wall_time,
+        "pos_drift": float(np.mean(pos_drift[healthy])) if healthy.any() else np.inf,
+        "joint_drift": (
+            float(np.mean(joint_drift[healthy])) if healthy.any() else np.inf
+        ),
+        "nan_rate": float(np.mean(failed)),
+        "contacts": float(np.mean(contacts)),
+        "max_penetration": float(np.max(penetration)),
+        "solver_iterations": float(np.mean(solver_iterations)),
+    }
+
+
+def _dominates(a, b):
+    """a is no worse than b in every objective and better in one."""
+    no_worse = (
+        a["sim_sec_per_sec"] >= b["sim_sec_per_sec"]
+        and a["pos_drift"] <= b["pos_drift"]
+        and a["joint_drift"] <= b["joint_drift"]
+        and a["nan_rate"] <= b["nan_rate"]
+    )
+    better = (
+        a["sim_sec_per_sec"] > b["sim_sec_per_sec"]
+        or a["pos_drift"] < b["pos_drift"]
+        or a["joint_drift"] < b["joint_drift"]
+        or a["nan_rate"] < b["nan_rate"]
+    )
+    return no_worse and better
+
+
+def _recommend(pareto):
+    min_nan_rate = min(r["nan_rate"] for r in pareto)
+    candidates = [r for r in pareto if r["nan_rate"] == min_nan_rate]
+    best_pos = min(r["pos_drift"] for r in candidates)
+    best_joint = min(r["joint_drift"] for r in candidates)
+    tolerance = 1.0 + FLAGS.drift_tolerance
+    accurate = [
+        r
+        for r in candidates
+        if r["pos_drift"] <= best_pos * tolerance
+        and r["joint_drift"] <= best_joint * tolerance
+    ]
+    if accurate:
+        return max(accurate, key=lambda r: r["sim_sec_per_sec"])
+    return min(
+        candidates,
+        key=lambda r: r["pos_drift"] / best_pos + r["joint_drift"] / best_joint,
+    )
+
+
+def main(argv):
+    del argv
+    clips = _load_clips()
+    sweep = {
+        "solver": FLAGS.solver,
+        "iterations": [int(x) for x in FLAGS.iterations],
+        "ls_iterations": [int(x) for x in FLAGS.ls_iterations],
+        "physics_steps_per_control_step": [
+            int(x) for x in FLAGS.physics_steps_per_control_step
+        ],
+        "jacobian": FLAGS.jacobian,
+        "cone": FLAGS.cone,
+    }
+
+    results = []
+    for values in itertools.product(*sweep.values()):
+        settings = dict(zip(sweep.keys(), values))
+        try:
+            metrics = {**_benchmark(settings, clips), "supported": True}
+        except (ValueError, NotImplementedError) as e:
+            print(f"unsupported {settings}: {e}")
+            metrics = {"supported": False}
+        results.append({**settings, **metrics})
+        print(results[-1])
+
+    supported = [r for r in results if r["supported"]]
+    if not supported:
+        raise ValueError("No swept setting is supported")
+    pareto = [r for r in supported if not any(_dominates(o, r) for o in supported)]
+    print("Pareto-optimal settings:")
+    for r in pareto:
+        print(r)
+
+    recommended = _recommend(pareto)
+    with open(FLAGS.output_path, "w") as f:
+        json.dump({key: recommended[key] for key in sweep}, f, indent=2)
+    print(f"Recommended {recommended}, saved to {FLAGS.output_path}")
+
+    if FLAGS.results_path is not None:
+        with open(FLAGS.results_path, "w", newline="") as f:
+            # Unsupported settings leave their metric columns empty
+            writer = csv.DictWriter(f, fieldnames=list(supported[0]))
+            writer.writeheader()
+            writer.writerows(results)
+
+
+if __name__ == "__main__":
+    app.run(main)
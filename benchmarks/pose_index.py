@@ -0,0 +1,69 @@
+"""Query time and recall of the pose index against a brute-force library scan.
+
+Builds RodentMultiClipTracking's pose index over a synthetic library whose body
+positions follow random walks, then times a batch of jitted nearest-frame
+queries (noisy library poses) through the index and through a scan of every
+descriptor, on CPU.
+"""
+
+import jax
+from absl import app
+from absl import flags
+from jax import numpy as jp
+
+from benchmarks.common import make_env, synthetic_library, time_fn
+from pose_index import pose_descriptor, query_pose_index
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer("num_envs", 1024, "poses queried in parallel")
+flags.DEFINE_integer("n_clips", 64, "clips in the synthetic library")
+flags.DEFINE_integer("n_probe", 4, "cells scanned per query")
+flags.DEFINE_float("noise", 0.002, "std of the noise added to the query poses")
+flags.DEFINE_integer("n", 20, "number of timed queries per method")
+
+
+def main(argv):
+    del argv
+    clips = synthetic_library(FLAGS.n_clips)
+    walk_rng, query_rng, noise_rng = jax.random.split(jax.random.PRNGKey(0), 3)
+    walk = jp.cumsum(
+        0.002 * jax.random.normal(walk_rng, clips.body_positions.shape), axis=1
+    )
+    clips = clips.replace(body_positions=clips.position[..., None, :] + walk)
+
+    env = make_env(clips)
+    env.build_pose_index()
+
+    body_pos = clips.body_positions[..., env._feature_body_idxs, :]
+    library = pose_descriptor(clips.position, clips.quaternion, body_pos)
+    # Only start frames are indexed
+    num_starts = clips.position.shape[1] - env._ref_len
+    library = library[:, :num_starts].reshape(-1, library.shape[-1])
+
+    rows = jax.random.randint(query_rng, (FLAGS.num_envs,), 0, library.shape[0])
+    queries = library[rows] + FLAGS.noise * jax.random.normal(
+        noise_rng, (FLAGS.num_envs, library.shape[-1])
+    )
+
+    @jax.jit
+    def brute_force(queries):
+        dist = jp.sum((library[None] - queries[:, None]) ** 2, axis=-1)
+        return jp.argmin(dist, axis=-1)
+
+    @jax.jit
+    def indexed(index, queries):
+        query = lambda x: query_pose_index(index, x, FLAGS.n_probe)
+        clip_idx, frame, _ = jax.vmap(query)(queries)
+        return clip_idx * num_starts + frame
+
+    recall = jp.mean(brute_force(queries) == indexed(env.pose_index, queries))
+    print(
+        f"brute force: {time_fn(brute_force, queries, n=FLAGS.n) * 1e3:.2f} ms, "
+        f"index: {time_fn(indexed, env.pose_index, queries, n=FLAGS.n) * 1e3:.2f} ms "
+        f"for {FLAGS.num_envs} queries over {library.shape[0]} frames, "
+        f"recall {float(recall):.3f}"
+    )
+
+
+if __name__ == "__main__":
+    app.run(main)
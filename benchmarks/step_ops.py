@@ -0,0 +1,52 @@
+"""Per-step op count of RodentTracking.step for different reward configs.
+
+Reports the optimized HLO instruction count and CPU step time of a single env
+step with every reward term enabled and with the training config, where the
+zero-weight terms (angvel, bodypos) are dropped at trace time.
+"""
+
+import jax
+from absl import app
+from absl import flags
+from jax import numpy as jp
+
+from benchmarks.common import count_hlo_ops, synthetic_reference_clip, time_fn
+from Rodent_Env_Brax import RodentTracking
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer("n", 20, "number of timed steps per config")
+
+_CONFIGS = {
+    "all terms": {},
+    "training": {"angvel_reward_weight": 0.0, "bodypos_reward_weight": 0.0},
+}
+
+
+def main(argv):
+    del argv
+    for name, reward_weights in _CONFIGS.items():
+        env = RodentTracking(
+            None,
+            torque_actuators=True,
+            physics_steps_per_control_step=5,
+            **reward_weights,
+        )
+        env.reference_clips = synthetic_reference_clip(env.sys)
+        # The clip library is an argument, as in training
+        reset = env.with_reference_clips(env.reset)
+        step = env.with_reference_clips(env.step)
+
+        state = jax.jit(reset)(env.reference_clips, jax.random.PRNGKey(0))
+        action = jp.zeros(env.action_size)
+        n_ops = count_hlo_ops(step, env.reference_clips, state, action)
+        step_time = time_fn(
+            jax.jit(step), env.reference_clips, state, action, n=FLAGS.n
+        )
+        print(
+            f"{name}: {len(env._reward_terms)} reward terms, {n_ops} HLO ops, "
+            f"{step_time * 1e3:.2f} ms/step"
+        )
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -5,20 +5,27 @@ import wandb
 import imageio
 import mujoco
 from brax import envs
-from dm_control import mjcf as mjcf_dm
-from dm_control.locomotion.walkers import rescale
 
 # from brax.training.agents.ppo import train as ppo
 import custom_ppo as ppo
 import custom_wrappers
+import model_cache
 from custom_losses import PPONetworkParams
+from domain_randomization import randomize_rodent
+from clip_metrics import CLIP_METRIC_NAMES
+from clip_sampler import AdaptiveClipSampler
+from rollout import make_rollout_fn
 
 from brax.io import model
 import numpy as np
-from Rodent_Env_Brax import RodentMultiClipTracking, RodentTracking
+from Rodent_Env_Brax import (
+    RodentMultiClipTracking,
+    RodentTracking,
+    load_physics_config,
+)
 import pickle
 import warnings
-from preprocessing.mjx_preprocess import process_clip_to_train
+from preprocessing.mjx_preprocess import pad_reference_clips, process_clip_to_train
 from jax import numpy as jp
 import orbax.checkpoint as ocp
 
@@ -82,8 +89,53 @@ config = {
     "solver": "cg",
     "iterations": 8,
     "ls_iterations": 8,
+    "compact_reference_clips": True,
+    # Storage dtype of the compacted clips; "bfloat16" halves their memory but
+    # changes the tracking targets slightly
+    "reference_dtype": "float32",
+    # mjx.Data fields checked for NaN/Inf each step, each with its own
+    # nonfinite_<field> counter; "all" scans the full state (for debugging)
+    "health_check_fields": ("qpos", "qvel"),
+    # Optional physics settings file from benchmarks/physics_autotune.py;
+    # overrides solver, iterations, ls_iterations, physics_steps_per_control_step,
+    # jacobian and cone
+    "physics_config": None,
+    # Index the reference by fractional time so any control rate works
+    "interpolate_reference": False,
+    # Keyword arguments of domain_randomization.randomize_rodent (mass,
+    # friction and gain ranges), or None to train without domain randomization
+    "domain_randomization": None,
+    # Pre-initialized reset states drawn by reset and auto-reset, or None to
+    # run pipeline_init on every reset
+    "reset_bank_size": None,
+    # Rebuild the first state of done episodes from their reset key instead of
+    # storing a copy of it in every env's state
+    "lean_auto_reset": False,
+    # One TrackingTrainingWrapper instead of the episode/vmap/auto-reset stack
+    "fused_wrapper": False,
+    # Metrics carried in the training state besides the health flags: "off",
+    # "summary" (reward terms, control costs and termination flags) or "full";
+    # the rollout plots always trace at "full"
+    "metrics_level": "summary",
+    # Record contacts, penetration, active constraints and solver iterations
+    # as step metrics, reported per step by the evaluator
+    "physics_metrics": False,
+    # Keyword arguments of clip_sampler.AdaptiveClipSampler (temperature,
+    # uniform_mix, decay) to restart done envs on clips weighted by their
+    # recent terminations, or None to sample clips uniformly ("multi clip" only)
+    "clip_sampler": None,
+    # Per-clip statistics of the training episodes, summed on device and
+    # exported at each eval (needs fused_wrapper); evals always report theirs
+    "clip_metrics": False,
+    # Threads of the native MuJoCo CPU eval backend, or None to eval the MJX env;
+    # the native evals skip the reset bank, domain randomization and the
+    # physics metrics
+    "native_eval_threads": None,
 }
 
+if config["physics_config"] is not None:
+    config.update(load_physics_config(config["physics_config"]))
+
 envs.register_environment("single clip", RodentTracking)
 envs.register_environment("multi clip", RodentMultiClipTracking)
 
@@ -92,6 +144,13 @@ with open("./clips/coltrane_21_07_28.p", "rb") as file:
     # Use pickle.load() to load the data from the file
     reference_clip = pickle.load(file)
 
+# A list of single clips of different lengths is padded into one library, and
+# the multi clip env samples start frames within each clip's own length
+clip_kwargs = {}
+if isinstance(reference_clip, (list, tuple)):
+    reference_clip, clip_lengths = pad_reference_clips(reference_clip)
+    clip_kwargs["clip_lengths"] = clip_lengths
+
 # instantiate the environment
 env = envs.get_environment(
     config["env_name"],
@@ -113,11 +172,23 @@ env = envs.get_environment(
     endeff_reward_weight=config["endeff_reward_weight"],
     healthy_z_range=config["healthy_z_range"],
     physics_steps_per_control_step=config["physics_steps_per_control_step"],
+    compact_reference_clips=config["compact_reference_clips"],
+    reference_dtype=jp.dtype(config["reference_dtype"]),
+    health_check_fields=config["health_check_fields"],
+    jacobian=config.get("jacobian", "dense"),
+    cone=config.get("cone", "pyramidal"),
+    interpolate_reference=config["interpolate_reference"],
+    metrics_level=config["metrics_level"],
+    physics_metrics=config["physics_metrics"],
+    **clip_kwargs,
 )
 
-# Episode length is equal to (clip length - random init range - traj length) * steps per cur frame
-# Will work on not hardcoding these values later
-episode_length = (250 - 50 - 5) * env._steps_for_cur_frame
+if config["reset_bank_size"] is not None:
+    env.build_reset_bank(jax.random.PRNGKey(0), config["reset_bank_size"])
+
+# Episodes are truncated by the env when the reference clip runs out; this is
+# the upper bound for an episode starting at frame 0 of the longest clip
+episode_length = env.max_episode_length
 print(f"episode_length {episode_length}")
 
 # Define mask for freezing weights
@@ -153,6 +224,20 @@ train_fn = functools.partial(
     ),
     freeze_mask=None,
     restore_checkpoint_path=None,
+    lean_auto_reset=config["lean_auto_reset"],
+    fused_wrapper=config["fused_wrapper"],
+    randomization_fn=(
+        None
+        if config["domain_randomization"] is None
+        else functools.partial(randomize_rodent, **config["domain_randomization"])
+    ),
+    clip_sampler=(
+        None
+        if config["clip_sampler"] is None
+        else AdaptiveClipSampler(env.n_clips, **config["clip_sampler"])
+    ),
+    clip_metrics=config["clip_metrics"],
+    native_eval_threads=config["native_eval_threads"],
 )
 
 import uuid
@@ -174,34 +259,45 @@ wandb.run.name = (
 
 def wandb_progress(num_steps, metrics):
     metrics["num_steps"] = num_steps
+    # Per-clip statistics arrive as one (n_clips, n_stats) array
+    for name in ["eval/clip_metrics", "training/clip_metrics"]:
+        if name in metrics:
+            metrics[name] = wandb.Table(
+                columns=list(CLIP_METRIC_NAMES), data=metrics[name].tolist()
+            )
     wandb.log(metrics, commit=False)
 
 
 # Wrap the env in the brax autoreset and episode wrappers
 # rollout_env = custom_wrappers.AutoResetWrapperTracking(env)
 rollout_env = custom_wrappers.RenderRolloutWrapperTracking(env)
-# define the jit reset/step functions
-jit_reset = jax.jit(rollout_env.reset)
-jit_step = jax.jit(rollout_env.step)
+# the clip library and reset bank are passed to the rollout as an argument
+buffers = jax.device_put(env.buffers)
+
+
+@functools.cache
+def make_rollout(make_policy):
+    """The compiled rollout of policy_params_fn, built once per make_policy."""
+    return make_rollout_fn(
+        rollout_env,
+        functools.partial(make_policy, deterministic=True),
+        n_steps=rollout_env.max_episode_length,
+        info_keys=("summed_pos_distance", "joint_distance")
+        + (("clip_idx",) if isinstance(env, RodentMultiClipTracking) else ()),
+        fields_fn=lambda state: {
+            "torso_height": state.pipeline_state.xpos[env._torso_idx][2]
+        },
+        metrics_level="full",
+    )
 
 
 def policy_params_fn(
     num_steps, make_policy, params, rollout_key, checkpoint_dir=checkpoint_dir
 ):
-    jit_inference_fn = jax.jit(make_policy(params, deterministic=True))
-    rollout_key, reset_rng, act_rng = jax.random.split(rollout_key, 3)
-
-    state = jit_reset(reset_rng)
+    rollout = make_rollout(make_policy)(buffers, params, rollout_key)
+    rollout = jax.tree.map(np.asarray, rollout)
 
-    rollout = [state]
-    for i in range(int(250 * rollout_env._steps_for_cur_frame)):
-        _, act_rng = jax.random.split(act_rng)
-        obs = state.obs
-        ctrl, extras = jit_inference_fn(obs, act_rng)
-        state = jit_step(state, ctrl)
-        rollout.append(state)
-
-    pos_rewards = [state.metrics["pos_reward"] for state in rollout]
+    pos_rewards = rollout["metrics"]["pos_reward"]
     table = wandb.Table(
         data=[[x, y] for (x, y) in zip(range(len(pos_rewards)), pos_rewards)],
         columns=["frame", "pos_rewards"],
@@ -218,7 +314,7 @@ def policy_params_fn(
         commit=False,
     )
 
-    endeff_rewards = [state.metrics["endeff_reward"] for state in rollout]
+    endeff_rewards = rollout["metrics"]["endeff_reward"]
     table = wandb.Table(
         data=[[x, y] for (x, y) in zip(range(len(endeff_rewards)), endeff_rewards)],
         columns=["frame", "endeff_rewards"],
@@ -235,7 +331,7 @@ def policy_params_fn(
         commit=False,
     )
 
-    quat_rewards = [state.metrics["quat_reward"] for state in rollout]
+    quat_rewards = rollout["metrics"]["quat_reward"]
     table = wandb.Table(
         data=[[x, y] for (x, y) in zip(range(len(quat_rewards)), quat_rewards)],
         columns=["frame", "quat_rewards"],
@@ -252,7 +348,7 @@ def policy_params_fn(
         commit=False,
     )
 
-    angvel_rewards = [state.metrics["angvel_reward"] for state in rollout]
+    angvel_rewards = rollout["metrics"]["angvel_reward"]
     table = wandb.Table(
         data=[[x, y] for (x, y) in zip(range(len(angvel_rewards)), angvel_rewards)],
         columns=["frame", "angvel_rewards"],
@@ -269,7 +365,7 @@ def policy_params_fn(
         commit=False,
     )
 
-    bodypos_rewards = [state.metrics["bodypos_reward"] for state in rollout]
+    bodypos_rewards = rollout["metrics"]["bodypos_reward"]
     table = wandb.Table(
         data=[[x, y] for (x, y) in zip(range(len(bodypos_rewards)), bodypos_rewards)],
         columns=["frame", "bodypos_rewards"],
@@ -286,7 +382,7 @@ def policy_params_fn(
         commit=False,
     )
 
-    joint_rewards = [state.metrics["joint_reward"] for state in rollout]
+    joint_rewards = rollout["metrics"]["joint_reward"]
     table = wandb.Table(
         data=[[x, y] for (x, y) in zip(range(len(joint_rewards)), joint_rewards)],
         columns=["frame", "joint_rewards"],
@@ -303,7 +399,7 @@ def policy_params_fn(
         commit=False,
     )
 
-    summed_pos_distances = [state.info["summed_pos_distance"] for state in rollout]
+    summed_pos_distances = rollout["info"]["summed_pos_distance"]
     table = wandb.Table(
         data=[
             [x, y]
@@ -323,7 +419,7 @@ def policy_params_fn(
         commit=False,
     )
 
-    joint_distances = [state.info["joint_distance"] for state in rollout]
+    joint_distances = rollout["info"]["joint_distance"]
     table = wandb.Table(
         data=[[x, y] for (x, y) in zip(range(len(joint_distances)), joint_distances)],
         columns=["frame", "joint_distances"],
@@ -340,7 +436,7 @@ def policy_params_fn(
         commit=False,
     )
 
-    torso_heights = [state.pipeline_state.xpos[env._torso_idx][2] for state in rollout]
+    torso_heights = rollout["torso_height"]
     table = wandb.Table(
         data=[[x, y] for (x, y) in zip(range(len(torso_heights)), torso_heights)],
         columns=["frame", "torso_heights"],
@@ -359,24 +455,24 @@ def policy_params_fn(
 
     # Render the walker with the reference expert demonstration trajectory
     os.environ["MUJOCO_GL"] = "osmesa"
-    qposes_rollout = np.array([state.pipeline_state.qpos for state in rollout])
+    qposes_rollout = rollout["qpos"]
 
-    ref_traj = rollout_env._get_reference_clip(rollout[0].info)
-    print(f"clip_id:{rollout[0].info}")
+    first_info = jax.tree.map(lambda x: x[0], rollout["info"])
+    # Compacted clips may be stored in bfloat16; render from float32 qpos
+    ref_traj = jax.tree.map(
+        lambda x: np.asarray(x, np.float32),
+        rollout_env._get_reference_clip(first_info),
+    )
+    print(f"clip_id:{first_info}")
     qposes_ref = np.repeat(
         np.hstack([ref_traj.position, ref_traj.quaternion, ref_traj.joints]),
         env._steps_for_cur_frame,
         axis=0,
     )
 
-    root = mjcf_dm.from_path(f"./models/rodent_ghostpair_scale080.xml")
-    rescale.rescale_subtree(
-        root,
-        0.9 / 0.8,
-        0.9 / 0.8,
+    mj_model, _ = model_cache.load_model(
+        "./models/rodent_ghostpair_scale080.xml", 0.9 / 0.8
     )
-
-    mj_model = mjcf_dm.Physics.from_mjcf_model(root).model.ptr
     mj_model.opt.solver = {
         "cg": mujoco.mjtSolver.mjSOL_CG,
         "newton": mujoco.mjtSolver.mjSOL_NEWTON,
@@ -0,0 +1,106 @@
+"""Per-clip episode statistics, reduced on device by clip index.
+
+Finished episodes are summed into one row per clip of a (n_clips,
+len(CLIP_METRIC_NAMES)) array with a segment sum, so the statistics of a
+whole library cost a single small transfer instead of per-env host copies.
+clip_metrics_means turns the sums into the exported per-clip means.
+"""
+
+from typing import Dict
+
+import jax
+from jax import numpy as jp
+import numpy as np
+
+# Columns of the per-clip arrays
+CLIP_METRIC_NAMES = (
+    "episodes",
+    "length",
+    "terminated",
+    "fall",
+    "too_far",
+    "bad_pose",
+    "bad_quat",
+    "pos_reward",
+    "quat_reward",
+    "joint_reward",
+    "endeff_reward",
+)
+
+# Step metrics that flag a termination, besides the nonfinite_* health flags
+_TERMINATION_METRICS = ("fall", "too_far", "bad_pose", "bad_quat")
+
+# Columns averaged over episodes and over steps by clip_metrics_means
+_PER_EPISODE = ("length", "terminated", "fall", "too_far", "bad_pose", "bad_quat")
+_PER_STEP = ("pos_reward", "quat_reward", "joint_reward", "endeff_reward")
+
+
+def clip_metric_sums(
+    n_clips: int,
+    clip_idx: jp.ndarray,
+    done: jp.ndarray,
+    length: jp.ndarray,
+    terminated: jp.ndarray,
+    episode_metrics: Dict[str, jp.ndarray],
+) -> jp.ndarray:
+    """Sums the episodes of a batch of envs that are done by clip.
+
+    Args:
+        n_clips (int): number of clips in the library.
+        clip_idx (jp.ndarray): (batch, ...) clip of each env, with a trailing
+            axis per agent in multi-agent envs.
+        done (jp.ndarray): (batch,) envs whose episode is counted.
+        length (jp.ndarray): (batch,) episode lengths.
+        terminated (jp.ndarray): (batch,) episodes that ended in a termination.
+        episode_metrics (Dict[str, jp.ndarray]): episode sums of the step
+            metrics, shaped like clip_idx; columns without a metric are 0.
+
+    Returns:
+        jp.ndarray: (n_clips, len(CLIP_METRIC_NAMES)) sums.
+    """
+    per_env = lambda x: jp.broadcast_to(
+        jp.reshape(x, x.shape + (1,) * (clip_idx.ndim - x.ndim)), clip_idx.shape
+    )
+    zeros = jp.zeros(clip_idx.shape)
+    columns = {
+        "episodes": jp.ones(clip_idx.shape),
+        "length": per_env(length),
+        "terminated": per_env(terminated),
+    }
+    values = jp.stack(
+        [
+            columns[name] if name in columns else episode_metrics.get(name, zeros)
+            for name in CLIP_METRIC_NAMES
+        ],
+        axis=-1,
+    )
+    values = values * per_env(done)[..., None]
+    return jax.ops.segment_sum(
+        values.reshape(-1, len(CLIP_METRIC_NAMES)), clip_idx.ravel(), n_clips
+    )
+
+
+def terminated_from_metrics(episode_metrics: Dict[str, jp.ndarray]) -> jp.ndarray:
+    """Whether each episode hit a termination flag, from its episode sums of
+    the step metrics (at metrics_level "off" only the nonfinite_* health
+    flags)."""
+    flags = [
+        value
+        for name, value in episode_metrics.items()
+        if name in _TERMINATION_METRICS or name.startswith("nonfinite")
+    ]
+    return jp.minimum(jp.asarray(sum(flags, 0.0)), 1.0)
+
+
+def clip_metrics_means(sums: np.ndarray) -> np.ndarray:
+    """Per-clip episode counts, mean length, termination rates (overall and per
+    cause) and per-step mean reward terms, in CLIP_METRIC_NAMES order."""
+    sums = np.asarray(sums, dtype=np.float64)
+    episodes = sums[:, CLIP_METRIC_NAMES.index("episodes")]
+    steps = sums[:, CLIP_METRIC_NAMES.index("length")]
+    means = sums.copy()
+    for name in _PER_EPISODE:
+        means[:, CLIP_METRIC_NAMES.index(name)] /= np.maximum(episodes, 1)
+    for name in _PER_STEP:
+        means[:, CLIP_METRIC_NAMES.index(name)] /= np.maximum(steps, 1)
+    return means.astype(np.float32)
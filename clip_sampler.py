@@ -0,0 +1,136 @@
+"""Adaptive clip sampling weighted by recent tracking failures.
+
+The sampler's per-clip statistics live on device, in the info of the training
+env state, and the auto-reset wrappers update them from the episodes that
+finish on each step. Done envs then restart on a clip drawn from a tempered
+distribution over those statistics, so clips the policy keeps failing on get
+more of the experience than clips it already tracks.
+"""
+
+from typing import Dict, NamedTuple, Optional
+
+import jax
+from jax import numpy as jp
+import numpy as np
+
+
+class ClipSamplerState(NamedTuple):
+    """Per-clip statistics of finished training episodes."""
+
+    termination_rate: jp.ndarray  # fraction of episodes ending in a termination
+    episode_length: jp.ndarray  # mean episode length, in env steps
+    episodes: jp.ndarray  # finished episodes seen
+
+
+class AdaptiveClipSampler:
+    """Samples clips in proportion to their tempered termination hazard.
+
+    A clip's hazard is its termination rate divided by its mean episode length,
+    i.e. terminations per env step. Clips start with a hazard of 1, above any
+    observed one, so every clip is visited early on. The statistics are a
+    running mean over a clip's first 1 / (1 - decay) episodes and an
+    exponential moving average after that, so they follow the policy as it
+    improves.
+    """
+
+    def __init__(
+        self,
+        n_clips: int,
+        temperature: float = 1.0,
+        uniform_mix: float = 0.1,
+        decay: float = 0.99,
+        axis_name: Optional[str] = None,
+    ):
+        """
+        Args:
+            n_clips (int): number of clips in the library.
+            temperature (float): weights are hazard ** (1 / temperature); higher
+                is closer to uniform.
+            uniform_mix (float): probability mass spread uniformly over all
+                clips, so none stops being sampled.
+            decay (float): per-episode decay of the moving averages.
+            axis_name (Optional[str]): pmap axis the env batch is split over;
+                each update then sums the episodes of every device, so all
+                devices keep the same statistics of the whole batch.
+        """
+        self.n_clips = n_clips
+        self.temperature = temperature
+        self.uniform_mix = uniform_mix
+        self.decay = decay
+        self.axis_name = axis_name
+
+    def with_axis_name(self, axis_name: str) -> "AdaptiveClipSampler":
+        """This sampler, updated across the devices of pmap axis `axis_name`."""
+        return AdaptiveClipSampler(
+            self.n_clips, self.temperature, self.uniform_mix, self.decay, axis_name
+        )
+
+    def init(self) -> ClipSamplerState:
+        return ClipSamplerState(
+            termination_rate=jp.ones(self.n_clips),
+            episode_length=jp.ones(self.n_clips),
+            episodes=jp.zeros(self.n_clips),
+        )
+
+    def update(
+        self,
+        state: ClipSamplerState,
+        clip_idx: jp.ndarray,
+        done: jp.ndarray,
+        terminated: jp.ndarray,
+        length: jp.ndarray,
+    ) -> ClipSamplerState:
+        """Folds the episodes of a batch of envs that are done into `state`.
+
+        clip_idx may have trailing axes (one clip per agent); done, terminated
+        and length are either per env or shaped like clip_idx.
+        """
+
+        def per_env(x):
+            x = jp.reshape(x, x.shape + (1,) * (clip_idx.ndim - x.ndim))
+            return jp.broadcast_to(x, clip_idx.shape)
+
+        def per_clip(x):
+            total = jax.ops.segment_sum(
+                (per_env(done) * per_env(x)).ravel(), clip_idx.ravel(), self.n_clips
+            )
+            if self.axis_name is not None:
+                total = jax.lax.psum(total, self.axis_name)
+            return total
+
+        n = per_clip(jp.ones_like(done))
+        episodes = state.episodes + n
+        rate = jp.maximum(1 - self.decay**n, n / jp.maximum(episodes, 1))
+        safe_n = jp.maximum(n, 1)
+
+        def average(old, total):
+            return old + rate * (total / safe_n - old)
+
+        return ClipSamplerState(
+            termination_rate=average(state.termination_rate, per_clip(terminated)),
+            episode_length=average(state.episode_length, per_clip(length)),
+            episodes=episodes,
+        )
+
+    def probs(self, state: ClipSamplerState) -> jp.ndarray:
+        """Probability of each clip being drawn by a reset."""
+        hazard = state.termination_rate / jp.maximum(state.episode_length, 1.0)
+        probs = jax.nn.softmax(jp.log(hazard + 1e-6) / self.temperature)
+        return (1 - self.uniform_mix) * probs + self.uniform_mix / self.n_clips
+
+    def logits(self, state: ClipSamplerState) -> jp.ndarray:
+        """Log-probabilities for RodentTracking.bind_clip_logits."""
+        return jp.log(self.probs(state))
+
+    def metrics(self, state: ClipSamplerState) -> Dict[str, np.ndarray]:
+        """Per-clip weights and statistics, exported with the eval metrics."""
+        probs = self.probs(state)
+        return {
+            "clip_sampler/weights": np.asarray(probs),
+            "clip_sampler/termination_rate": np.asarray(state.termination_rate),
+            "clip_sampler/episode_length": np.asarray(state.episode_length),
+            "clip_sampler/episodes": np.asarray(state.episodes),
+            "clip_sampler/effective_clips": float(
+                jp.exp(-jp.sum(probs * jp.log(probs)))
+            ),
+        }
@@ -0,0 +1,147 @@
+# Copyright 2024 The Brax Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Brax training acting functions.
+
+Evaluator is adapted to take the reference clip library (and the other env
+buffers) as a runtime argument instead of capturing it as a constant in the
+compiled eval unroll, and to sum the eval episodes by clip on device (see
+clip_metrics).
+"""
+
+import time
+from typing import Callable
+
+from brax import envs
+from brax.training.acting import generate_unroll
+from brax.training.types import Metrics
+from brax.training.types import Policy
+from brax.training.types import PolicyParams
+from brax.training.types import PRNGKey
+import jax
+from jax import numpy as jp
+import numpy as np
+
+from clip_metrics import clip_metric_sums, clip_metrics_means, terminated_from_metrics
+from Rodent_Env_Brax import EnvBuffers
+
+
+class Evaluator:
+    """Class to run evaluations."""
+
+    def __init__(
+        self,
+        eval_env: envs.Env,
+        eval_policy_fn: Callable[[PolicyParams], Policy],
+        num_eval_envs: int,
+        episode_length: int,
+        action_repeat: int,
+        key: PRNGKey,
+        buffers: EnvBuffers,
+    ):
+        """Init.
+
+        Args:
+          eval_env: Batched environment to run evals on.
+          eval_policy_fn: Function returning the policy from the policy parameters.
+          num_eval_envs: Each env will run 1 episode in parallel for each eval.
+          episode_length: Maximum length of an episode.
+          action_repeat: Number of physics steps per env step.
+          key: RNG key.
+          buffers: Device copy of the env buffers (clip library, reset bank),
+            passed to the eval unroll as an argument.
+        """
+        self._key = key
+        self._eval_walltime = 0.0
+        self._buffers = buffers
+
+        eval_env = envs.training.EvalWrapper(eval_env)
+
+        def generate_eval_unroll(policy_params: PolicyParams, key: PRNGKey):
+            reset_keys = jax.random.split(key, num_eval_envs)
+            eval_first_state = eval_env.reset(reset_keys)
+            eval_state = generate_unroll(
+                eval_env,
+                eval_first_state,
+                eval_policy_fn(policy_params),
+                key,
+                unroll_length=episode_length // action_repeat,
+            )[0]
+
+            # Each env runs one episode, on the clip it was reset to
+            eval_metrics = eval_state.info["eval_metrics"]
+            clip_sums = clip_metric_sums(
+                eval_env.n_clips,
+                eval_first_state.info.get(
+                    "clip_idx", jp.zeros(num_eval_envs, jp.int32)
+                ),
+                jp.ones(num_eval_envs),
+                eval_metrics.episode_steps,
+                terminated_from_metrics(eval_metrics.episode_metrics),
+                eval_metrics.episode_metrics,
+            )
+            return eval_state, clip_sums
+
+        self._generate_eval_unroll = jax.jit(
+            eval_env.with_buffers(generate_eval_unroll)
+        )
+        self._steps_per_unroll = episode_length * num_eval_envs
+
+    def run_evaluation(
+        self,
+        policy_params: PolicyParams,
+        training_metrics: Metrics,
+        aggregate_episodes: bool = True,
+    ) -> Metrics:
+        """Run one epoch of evaluation."""
+        self._key, unroll_key = jax.random.split(self._key)
+
+        t = time.time()
+        eval_state, clip_sums = self._generate_eval_unroll(
+            self._buffers, policy_params, unroll_key
+        )
+        eval_metrics = eval_state.info["eval_metrics"]
+        eval_metrics.active_episodes.block_until_ready()
+        epoch_eval_time = time.time() - t
+        metrics = {}
+        for fn in [np.mean, np.std]:
+            suffix = "_std" if fn == np.std else ""
+            metrics.update(
+                {
+                    f"eval/episode_{name}{suffix}": (
+                        fn(value) if aggregate_episodes else value
+                    )
+                    for name, value in eval_metrics.episode_metrics.items()
+                }
+            )
+        metrics["eval/avg_episode_length"] = np.mean(eval_metrics.episode_steps)
+        # Physics health metrics (RodentTracking physics_metrics) are episode
+        # sums; per step they compare across episode lengths
+        episode_steps = np.maximum(eval_metrics.episode_steps, 1)
+        for name, value in eval_metrics.episode_metrics.items():
+            if name.startswith("physics_"):
+                per_step = value / episode_steps
+                metrics[f"eval/{name}_per_step"] = np.mean(per_step)
+                metrics[f"eval/{name}_per_step_max"] = np.max(per_step)
+        metrics["eval/clip_metrics"] = clip_metrics_means(clip_sums)
+        metrics["eval/epoch_eval_time"] = epoch_eval_time
+        metrics["eval/sps"] = self._steps_per_unroll / epoch_eval_time
+        self._eval_walltime = self._eval_walltime + epoch_eval_time
+        metrics = {
+            "eval/walltime": self._eval_walltime,
+            **training_metrics,
+            **metrics,
+        }
+
+        return metrics  # pytype: disable=bad-return-type  # jax-ndarray
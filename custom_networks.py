@@ -16,6 +16,8 @@ from jax import random
 import flax
 from flax import linen as nn
 
+from observation_layout import ObservationLayout
+
 
 class VariationalLayer(nn.Module):
     latent_size: int
@@ -63,7 +65,7 @@ class IntentionNetwork(nn.Module):
 
     encoder_layers: Sequence[int]
     decoder_layers: Sequence[int]
-    reference_obs_size: int
+    observation_layout: ObservationLayout
     latents: int = 60
 
     def setup(self):
@@ -73,11 +75,13 @@ class IntentionNetwork(nn.Module):
 
     def __call__(self, obs, key):
         _, encoder_rng = jax.random.split(key)
-        traj = obs[..., : self.reference_obs_size]
+        traj = self.observation_layout.reference(obs)
         latent_mean, latent_logvar = self.latent(self.encoder(traj))
         z = reparameterize(encoder_rng, latent_mean, latent_logvar)
         action = self.decoder(
-            jnp.concatenate([z, obs[..., self.reference_obs_size :]], axis=-1)
+            jnp.concatenate(
+                [z, self.observation_layout.proprioceptive(obs)], axis=-1
+            )
         )
 
         return action, (latent_mean, latent_logvar)
@@ -88,7 +92,7 @@ class EncoderDecoderNetwork(nn.Module):
 
     encoder_layers: Sequence[int]
     decoder_layers: Sequence[int]
-    reference_obs_size: int
+    observation_layout: ObservationLayout
     latents: int = 60
 
     def setup(self):
@@ -96,10 +100,12 @@ class EncoderDecoderNetwork(nn.Module):
         self.decoder = MLP(layer_sizes=self.decoder_layers)
 
     def __call__(self, obs, key):
-        traj = obs[..., : self.reference_obs_size]
+        traj = self.observation_layout.reference(obs)
         z = nn.Dense(self.latents, name="bottleneck")(self.encoder(traj))
         action = self.decoder(
-            jnp.concatenate([z, obs[..., self.reference_obs_size :]], axis=-1)
+            jnp.concatenate(
+                [z, self.observation_layout.proprioceptive(obs)], axis=-1
+            )
         )
 
         return action, z
@@ -109,7 +115,7 @@ def make_intention_policy(
     param_size: int,
     latent_size: int,
     total_obs_size: int,
-    reference_obs_size: int,
+    observation_layout: ObservationLayout,
     preprocess_observations_fn: types.PreprocessObservationFn = types.identity_observation_preprocessor,
     encoder_hidden_layer_sizes: Sequence[int] = (1024, 1024),
     decoder_hidden_layer_sizes: Sequence[int] = (1024, 1024),
@@ -119,7 +125,7 @@ def make_intention_policy(
     policy_module = IntentionNetwork(
         encoder_layers=list(encoder_hidden_layer_sizes),
         decoder_layers=list(decoder_hidden_layer_sizes) + [param_size],
-        reference_obs_size=reference_obs_size,
+        observation_layout=observation_layout,
         latents=latent_size,
     )
 
@@ -140,7 +146,7 @@ def make_encoderdecoder_policy(
     param_size: int,
     latent_size: int,
     total_obs_size: int,
-    reference_obs_size: int,
+    observation_layout: ObservationLayout,
     preprocess_observations_fn: types.PreprocessObservationFn = types.identity_observation_preprocessor,
     encoder_hidden_layer_sizes: Sequence[int] = (1024, 1024),
     decoder_hidden_layer_sizes: Sequence[int] = (1024, 1024),
@@ -150,7 +156,7 @@ def make_encoderdecoder_policy(
     policy_module = EncoderDecoderNetwork(
         encoder_layers=list(encoder_hidden_layer_sizes),
         decoder_layers=list(decoder_hidden_layer_sizes) + [param_size],
-        reference_obs_size=reference_obs_size,
+        observation_layout=observation_layout,
         latents=latent_size,
     )
 
@@ -47,6 +47,10 @@ import numpy as np
 import optax
 import orbax
 import custom_wrappers
+import custom_acting
+import native_eval
+from clip_metrics import clip_metrics_means
+from clip_sampler import AdaptiveClipSampler
 from etils import epath
 
 
@@ -117,6 +121,11 @@ def train(
     ] = None,
     restore_checkpoint_path: Optional[str] = None,
     freeze_mask=None,
+    lean_auto_reset: bool = False,
+    fused_wrapper: bool = False,
+    clip_sampler: Optional[AdaptiveClipSampler] = None,
+    clip_metrics: bool = False,
+    native_eval_threads: Optional[int] = None,
 ):
     """PPO training.
 
@@ -165,6 +174,19 @@ def train(
         saving policy checkpoints
       randomization_fn: a user-defined callback function that generates randomized
         environments
+      lean_auto_reset: rebuild the first state of done episodes from their reset
+        key instead of keeping a copy of it in every env's state
+      fused_wrapper: wrap the env in a single TrackingTrainingWrapper instead
+        of the episode, vmap and auto-reset wrapper stack
+      clip_sampler: restart done training envs on clips drawn by this sampler;
+        its per-clip weights and statistics are added to each eval's metrics
+      clip_metrics: sum the training episodes by clip on device (needs
+        `fused_wrapper`); each eval adds their per-clip means since the previous
+        eval as "training/clip_metrics", next to the eval's "eval/clip_metrics"
+      native_eval_threads: run evals with native MuJoCo on the host CPU across
+        this many threads (see native_eval) instead of the MJX env; needs
+        action_repeat 1, and skips the reset bank, domain randomization and
+        the physics metrics
 
     Returns:
       Tuple of (make_policy function, network params, metrics)
@@ -226,21 +248,47 @@ def train(
         v_randomization_fn = functools.partial(randomization_fn, rng=randomization_rng)
 
     if isinstance(environment, envs.Env):
-        wrap_for_training = custom_wrappers.wrap
+        wrap_for_training = functools.partial(
+            custom_wrappers.wrap,
+            lean_auto_reset=lean_auto_reset,
+            fused=fused_wrapper,
+        )
     else:
         wrap_for_training = envs_v1.wrappers.wrap_for_training
 
+    # Only the training env samples clips adaptively and keeps per-clip sums;
+    # evals stay uniform and sum their episodes by clip in the evaluator
+    sampler_kwargs = {}
+    if clip_sampler is not None:
+        # Every device folds in the finished episodes of the whole batch
+        clip_sampler = clip_sampler.with_axis_name(_PMAP_AXIS_NAME)
+        sampler_kwargs["clip_sampler"] = clip_sampler
+    if clip_metrics:
+        sampler_kwargs["clip_metrics"] = True
     env = wrap_for_training(
         environment,
         episode_length=episode_length,
         action_repeat=action_repeat,
         randomization_fn=v_randomization_fn,
+        **sampler_kwargs,
+    )
+
+    # The clip library (and reset bank, if built) is passed to every compiled
+    # function as an argument so it is not embedded as a constant; each device
+    # holds a single shared copy. The resets and the evals run on device 0 and
+    # read its shard of the replicated copy.
+    replicated_buffers = jax.device_put_replicated(
+        environment.buffers, jax.local_devices()[:local_devices_to_use]
     )
+    buffers = jax.tree.map(lambda x: x.addressable_shards[0].data, replicated_buffers)
 
-    reset_fn = jax.jit(jax.vmap(env.reset))
+    reset_fn = jax.jit(env.with_buffers(jax.vmap(env.reset)))
     key_envs = jax.random.split(key_env, num_envs // process_count)
     key_envs = jnp.reshape(key_envs, (local_devices_to_use, -1) + key_envs.shape[1:])
-    env_state = reset_fn(key_envs)
+    env_state = reset_fn(buffers, key_envs)
+    logging.info(
+        "env state: %.1f kB per env", custom_wrappers.state_nbytes(env_state) / 1e3
+    )
 
     normalize = lambda x, y: x
     if normalize_observations:
@@ -248,7 +296,7 @@ def train(
 
     ppo_network = network_factory(
         env_state.obs.shape[-1],
-        int(_unpmap(env_state.info["reference_obs_size"])[0]),
+        environment.observation_layout,
         env.action_size,
         preprocess_observations_fn=normalize,
     )
@@ -389,7 +437,9 @@ def train(
         loss_metrics = jax.tree_util.tree_map(jnp.mean, loss_metrics)
         return training_state, state, loss_metrics
 
-    training_epoch = jax.pmap(training_epoch, axis_name=_PMAP_AXIS_NAME)
+    training_epoch = jax.pmap(
+        env.with_buffers(training_epoch), axis_name=_PMAP_AXIS_NAME
+    )
 
     # Note that this is NOT a pure jittable method.
     def training_epoch_with_timing(
@@ -398,7 +448,9 @@ def train(
         nonlocal training_walltime
         t = time.time()
         training_state, env_state = _strip_weak_type((training_state, env_state))
-        result = training_epoch(training_state, env_state, key)
+        result = training_epoch(
+            replicated_buffers, training_state, env_state, key
+        )
         training_state, env_state, metrics = _strip_weak_type(result)
 
         metrics = jax.tree_util.tree_map(jnp.mean, metrics)
@@ -482,6 +534,9 @@ def train(
 
     if not eval_env:
         eval_env = environment
+    eval_buffers = (
+        buffers if eval_env is environment else jax.device_put(eval_env.buffers)
+    )
     if randomization_fn is not None:
         v_randomization_fn = functools.partial(
             randomization_fn, rng=jax.random.split(eval_key, num_eval_envs)
@@ -493,14 +548,27 @@ def train(
         randomization_fn=v_randomization_fn,
     )
 
-    evaluator = acting.Evaluator(
-        eval_env,
-        functools.partial(make_policy, deterministic=deterministic_eval),
-        num_eval_envs=num_eval_envs,
-        episode_length=episode_length,
-        action_repeat=action_repeat,
-        key=eval_key,
-    )
+    if native_eval_threads is None:
+        evaluator = custom_acting.Evaluator(
+            eval_env,
+            functools.partial(make_policy, deterministic=deterministic_eval),
+            num_eval_envs=num_eval_envs,
+            episode_length=episode_length,
+            action_repeat=action_repeat,
+            key=eval_key,
+            buffers=eval_buffers,
+        )
+    else:
+        if action_repeat != 1:
+            raise ValueError("native_eval_threads needs action_repeat 1")
+        evaluator = native_eval.NativeEvaluator(
+            eval_env.unwrapped,
+            functools.partial(make_policy, deterministic=deterministic_eval),
+            num_eval_envs=num_eval_envs,
+            episode_length=episode_length,
+            key=eval_key,
+            num_threads=native_eval_threads,
+        )
 
     # Run initial eval
     metrics = {}
@@ -531,7 +599,15 @@ def train(
                 lambda x, s: jax.random.split(x[0], s), in_axes=(0, None)
             )(key_envs, key_envs.shape[1])
             # TODO: move extra reset logic to the AutoResetWrapper.
-            env_state = reset_fn(key_envs) if num_resets_per_eval > 0 else env_state
+            if num_resets_per_eval > 0:
+                # The clip statistics outlive the episodes they came from
+                kept = {
+                    key: env_state.info[key]
+                    for key in ("clip_sampler", "clip_metrics")
+                    if key in env_state.info
+                }
+                env_state = reset_fn(buffers, key_envs)
+                env_state.info.update(kept)
 
         if process_id == 0:
             # Run evals.
@@ -541,6 +617,15 @@ def train(
                 ),
                 training_metrics,
             )
+            if clip_sampler is not None:
+                metrics.update(
+                    clip_sampler.metrics(_unpmap(env_state.info["clip_sampler"]))
+                )
+            if clip_metrics:
+                # One (n_clips, n_stats) transfer per device
+                metrics["training/clip_metrics"] = clip_metrics_means(
+                    np.sum(np.asarray(env_state.info["clip_metrics"]), axis=0)
+                )
             logging.info(metrics)
             progress_fn(current_step, metrics)
             params = _unpmap(
@@ -557,6 +642,12 @@ def train(
             _, policy_params_fn_key = jax.random.split(policy_params_fn_key)
             policy_params_fn(current_step, make_policy, params, policy_params_fn_key)
 
+        if clip_metrics:
+            # Every process starts the next epoch's sums over
+            env_state.info["clip_metrics"] = jnp.zeros_like(
+                env_state.info["clip_metrics"]
+            )
+
     total_steps = current_step
     assert total_steps >= num_timesteps
 
@@ -1,3 +1,5 @@
+import contextlib
+import functools
 from typing import Callable, Dict, Optional, Tuple
 
 from brax.base import System
@@ -11,12 +13,20 @@ import jax
 from jax import numpy as jp
 from mujoco import mjx
 
+from clip_metrics import CLIP_METRIC_NAMES, clip_metric_sums
+from clip_sampler import AdaptiveClipSampler, ClipSamplerState
+from domain_randomization import system_nbytes
+
 
 def wrap(
     env: Env,
     episode_length: int = 1000,
     action_repeat: int = 1,
     randomization_fn: Optional[Callable[[System], Tuple[System, System]]] = None,
+    lean_auto_reset: bool = False,
+    fused: bool = False,
+    clip_sampler: Optional[AdaptiveClipSampler] = None,
+    clip_metrics: bool = False,
 ) -> Wrapper:
     """Common wrapper pattern for all training agents.
 
@@ -26,54 +36,92 @@ def wrap(
       action_repeat: how many repeated actions to take per step
       randomization_fn: randomization function that produces a vectorized system
         and in_axes to vmap over
+      lean_auto_reset: rebuild the first state of done episodes from the reset
+        key instead of storing it (see AutoResetWrapperTracking)
+      fused: do all of the above in one TrackingTrainingWrapper
+      clip_sampler: restart done envs on clips drawn by this sampler, from
+        statistics kept in info["clip_sampler"]
+      clip_metrics: sum per-clip episode statistics in info["clip_metrics"];
+        needs `fused`, which keeps the episode sums they are made of
 
     Returns:
       An environment that is wrapped with Episode and AutoReset wrappers.  If the
       environment did not already have batch dimensions, it is additional Vmap
       wrapped.
+
+    Raises:
+      ValueError: for multi-agent envs, whose dones and metrics are per agent
+        while the wrappers keep one episode per env.
     """
-    env = EpisodeWrapper(env, episode_length, action_repeat)
+    if hasattr(env.unwrapped, "n_agents"):
+        raise ValueError("The training wrappers do not support multi-agent envs")
+    if fused:
+        return TrackingTrainingWrapper(
+            env,
+            episode_length,
+            action_repeat,
+            randomization_fn,
+            lean_auto_reset,
+            clip_sampler,
+            clip_metrics,
+        )
+    if clip_metrics:
+        raise ValueError("clip_metrics needs the fused TrackingTrainingWrapper")
+    env = EpisodeWrapperTracking(env, episode_length, action_repeat)
     if randomization_fn is None:
         env = VmapWrapper(env)
     else:
-        env = DomainRandomizationVmapWrapper(env, randomization_fn)
-    env = AutoResetWrapperTracking(env)
+        env = DomainRandomizationVmapWrapperTracking(env, randomization_fn)
+    env = AutoResetWrapperTracking(
+        env, lean=lean_auto_reset, clip_sampler=clip_sampler
+    )
     return env
 
 
-# class AutoResetWrapperTracking(Wrapper):
-#     """Automatically resets RodentMultiClipTracking envs that are done.
+class DomainRandomizationVmapWrapperTracking(DomainRandomizationVmapWrapper):
+    """DomainRandomizationVmapWrapper that reports the System memory it holds.
 
-#     Each reset selects a new random clip_idx to ensure varied initial conditions.
-#     """
-
-#     def reset(self, rng: jax.Array) -> State:
-#         """Resets the environment and initializes the 'first_' info."""
-#         state = self.env.reset(rng)
-#         # Save rng
-#         state.info["reset_rng"] = rng
-#         return state
+    Leaves with in_axes None are shared by every env (see
+    domain_randomization.randomize_rodent).
+    """
 
-#     def step(self, state: State, action: jax.Array) -> State:
-#         if "steps" in state.info:
-#             steps = state.info["steps"]
-#             steps = jp.where(state.done, jp.zeros_like(steps), steps)
-#             state.info.update(steps=steps)
-#         state = state.replace(done=jp.zeros_like(state.done))
-#         state = self.env.step(state, action)
+    def __init__(
+        self,
+        env: Env,
+        randomization_fn: Callable[[System], Tuple[System, System]],
+    ):
+        super().__init__(env, randomization_fn)
+        per_env, shared = system_nbytes(self._sys_v, self._in_axes)
+        print(
+            f"domain randomization: {per_env / 1e3:.1f} kB System per env, "
+            f"{shared / 1e6:.2f} MB shared"
+        )
 
 
-#         def where_done(x, y):
-#             done = state.done
-#             if done.shape:
-#                 done = jp.reshape(done, [x.shape[0]] + [1] * (len(x.shape) - 1))  # type: ignore
-#             return jp.where(done, x, y)
+class EpisodeWrapperTracking(EpisodeWrapper):
+    """Maintains episode step count and sets done at episode end.
 
-#         info = state.info
-#         def f():
-#             new_state = self.env.reset(state.info["reset_rng"])
+    Unlike EpisodeWrapper, keeps the truncation raised by the env when the
+    reference clip runs out, instead of overwriting it.
+    """
 
-#         return where_done(, state)
+    def step(self, state: State, action: jax.Array) -> State:
+        def f(state, _):
+            nstate = self.env.step(state, action)
+            return nstate, nstate.reward
+
+        state, rewards = jax.lax.scan(f, state, (), self.action_repeat)
+        state = state.replace(reward=jp.sum(rewards, axis=0))
+        steps = state.info["steps"] + self.action_repeat
+        one = jp.ones_like(state.done)
+        episode_length = jp.array(self.episode_length, dtype=jp.int32)
+        done = jp.where(steps >= episode_length, one, state.done)
+        terminated = state.done * (1 - state.info["truncation"])
+        state.info["truncation"] = jp.where(
+            steps >= episode_length, 1 - terminated, state.info["truncation"]
+        )
+        state.info["steps"] = steps
+        return state.replace(done=done)
 
 
 class RenderRolloutWrapperTracking(Wrapper):
@@ -83,25 +131,55 @@ class RenderRolloutWrapperTracking(Wrapper):
         _, clip_rng, rng = jax.random.split(rng, 3)
 
         clip_idx = jax.random.randint(clip_rng, (), 0, self._n_clips)
-        info = {
-            "clip_idx": clip_idx,
-            "cur_frame": 0,
-            "steps_taken_cur_frame": 0,
-            "summed_pos_distance": 0.0,
-            "quat_distance": 0.0,
-            "joint_distance": 0.0,
-            "prev_ctrl": jp.zeros((self.sys.nu,)),
-        }
+        info = self._reset_info(clip_idx, 0)
 
         return self.reset_from_clip(rng, info, noise=False)
 
 
+# info entries restored when an env auto-resets
+_RESET_INFO_KEYS = ("clip_idx", "cur_frame", "steps_taken_cur_frame", "prev_ctrl")
+
+
 # Single clip
 class AutoResetWrapperTracking(Wrapper):
-    """Automatically resets Brax envs that are done."""
+    """Automatically resets Brax envs that are done.
+
+    If the env has a reset bank (RodentTracking.build_reset_bank), done envs
+    restart from a freshly drawn bank entry, i.e. a new clip and start frame.
+    Otherwise they replay the first state of the episode: stored in info, or
+    with `lean` rebuilt by re-running reset from the stored reset key, which is
+    deterministic in it (clip, start frame and noise alike).
+
+    With a `clip_sampler`, done envs also restart fresh, on a clip drawn from
+    the sampler's statistics, which are updated here from every finished
+    episode and kept unbatched in info["clip_sampler"].
+
+    Without stored first states, only the done envs are reset, in chunks of
+    a fraction of the batch (see _rebuild_done_rows), and not at all on steps
+    where no env is done.
+    """
+
+    def __init__(
+        self,
+        env: Env,
+        lean: bool = False,
+        clip_sampler: Optional[AdaptiveClipSampler] = None,
+    ):
+        super().__init__(env)
+        self._clip_sampler = clip_sampler
+        self._fresh_resets = (
+            getattr(env.unwrapped, "reset_bank", None) is not None
+            or clip_sampler is not None
+        )
+        self._lean = lean
 
     def reset(self, rng: jax.Array) -> State:
         state = self.env.reset(rng)
+        if self._clip_sampler is not None:
+            state.info["clip_sampler"] = self._clip_sampler.init()
+        if self._fresh_resets or self._lean:
+            state.info["reset_rng"] = rng
+            return state
         state.info["first_pipeline_state"] = state.pipeline_state
         state.info["first_obs"] = state.obs
         state.info["first_cur_frame"] = state.info["cur_frame"]
@@ -110,37 +188,321 @@ class AutoResetWrapperTracking(Wrapper):
         return state
 
     def step(self, state: State, action: jax.Array) -> State:
-        if "steps" in state.info:
-            steps = state.info["steps"]
-            steps = jp.where(state.done, jp.zeros_like(steps), steps)
-            state.info.update(steps=steps)
-        state = state.replace(done=jp.zeros_like(state.done))
+        # The sampler statistics are not batched, so they skip the vmapped env
+        info = dict(state.info)
+        sampler_state = info.pop("clip_sampler", None)
+        if "steps" in info:
+            info["steps"] = jp.where(
+                state.done, jp.zeros_like(info["steps"]), info["steps"]
+            )
+        state = state.replace(done=jp.zeros_like(state.done), info=info)
         state = self.env.step(state, action)
 
-        def where_done(x, y):
-            done = state.done
-            if done.shape:
-                done = jp.reshape(done, [x.shape[0]] + [1] * (len(x.shape) - 1))  # type: ignore
-            return jp.where(done, x, y)
+        if sampler_state is not None:
+            terminated = state.done * (1 - state.info["truncation"])
+            sampler_state = self._clip_sampler.update(
+                sampler_state,
+                state.info["clip_idx"],
+                state.done,
+                terminated,
+                state.info["steps"],
+            )
+
+        if self._fresh_resets or self._lean:
+            with _sampling_clips(self.env, self._clip_sampler, sampler_state):
+                state = _rebuild_done_rows(
+                    self._reset_rows, state, self._fresh_resets
+                )
+            if sampler_state is not None:
+                state.info["clip_sampler"] = sampler_state
+            return state
 
         pipeline_state = jax.tree.map(
-            where_done, state.info["first_pipeline_state"], state.pipeline_state
+            functools.partial(_where_done, state.done),
+            state.info["first_pipeline_state"],
+            state.pipeline_state,
         )
-        obs = where_done(state.info["first_obs"], state.obs)
-        state.info["cur_frame"] = where_done(
+        obs = _where_done(state.done, state.info["first_obs"], state.obs)
+        state.info["cur_frame"] = _where_done(
+            state.done,
             state.info["first_cur_frame"],
             state.info["cur_frame"],
         )
-        state.info["steps_taken_cur_frame"] = where_done(
+        state.info["steps_taken_cur_frame"] = _where_done(
+            state.done,
             state.info["first_steps_taken_cur_frame"],
             state.info["steps_taken_cur_frame"],
         )
-        state.info["prev_ctrl"] = where_done(
+        state.info["prev_ctrl"] = _where_done(
+            state.done,
             state.info["first_prev_ctrl"],
             state.info["prev_ctrl"],
         )
         return state.replace(pipeline_state=pipeline_state, obs=obs)
 
+    def _reset_rows(self, rng: jax.Array, rows: jax.Array) -> State:
+        """Resets the envs at `rows` of the batch, one key each."""
+        if not isinstance(self.env, DomainRandomizationVmapWrapper):
+            return self.env.reset(rng)
+        # Each row resets with its own randomized System
+        sys_rows = _gather_sys_rows(self.env._sys_v, self.env._in_axes, rows)
+        reset = lambda sys, rng: self.env._env_fn(sys=sys).reset(rng)
+        return jax.vmap(reset, in_axes=(self.env._in_axes, 0))(sys_rows, rng)
+
+
+# Done envs are reset in chunks of batch size // _REBUILD_CHUNK_DIVISOR rows
+_REBUILD_CHUNK_DIVISOR = 16
+
+
+def _rebuild_done_rows(
+    reset_rows: Callable[[jax.Array, jax.Array], State],
+    state: State,
+    fresh_resets: bool,
+) -> State:
+    """Replaces the done envs of a batched state with a state rebuilt by
+    reset: a fresh draw, or the episode's first state.
+
+    The done rows are gathered in fixed-size chunks, reset with
+    `reset_rows(rng, rows)` and scattered back, in a while loop that runs once
+    per chunk of done envs and not at all when no env is done. With
+    `fresh_resets` every env's reset key is advanced first, so each reset
+    draws anew; otherwise the stored key replays the episode's first state.
+    """
+    info = dict(state.info)
+    reset_rng = info["reset_rng"]
+    if fresh_resets:
+        keys = jax.vmap(jax.random.split)(reset_rng)
+        info["reset_rng"] = keys[:, 0]
+        reset_rng = keys[:, 1]
+    state = state.replace(info=info)
+
+    batch = state.done.shape[0]
+    chunk = max(1, batch // _REBUILD_CHUNK_DIVISOR)
+
+    def rebuild_chunk(carry):
+        state, remaining = carry
+        # Rows past the done ones point out of the batch: their gathers are
+        # clamped and their scatters dropped
+        (rows,) = jp.nonzero(remaining, size=chunk, fill_value=batch)
+        reset_state = reset_rows(reset_rng[rows], rows)
+        scatter = lambda x, y: x.at[rows].set(y, mode="drop")
+
+        info = dict(state.info)
+        for key in _RESET_INFO_KEYS:
+            if key in info:
+                info[key] = scatter(info[key], reset_state.info[key])
+        state = state.replace(
+            pipeline_state=jax.tree.map(
+                scatter, state.pipeline_state, reset_state.pipeline_state
+            ),
+            obs=scatter(state.obs, reset_state.obs),
+            info=info,
+        )
+        return state, remaining.at[rows].set(False, mode="drop")
+
+    state, _ = jax.lax.while_loop(
+        lambda carry: jp.any(carry[1]), rebuild_chunk, (state, state.done > 0)
+    )
+    return state
+
+
+def _gather_sys_rows(sys_v: System, in_axes: System, rows: jax.Array) -> System:
+    """The randomized Systems of `rows`; shared leaves are kept whole."""
+    return jax.tree.map(
+        lambda x, axis: x if axis is None else x[rows], sys_v, in_axes
+    )
+
+
+def _sampling_clips(
+    env: Env,
+    clip_sampler: Optional[AdaptiveClipSampler],
+    sampler_state: Optional[ClipSamplerState],
+):
+    """Binds the sampler's clip logits to `env` while resets are traced."""
+    if sampler_state is None:
+        return contextlib.nullcontext()
+    return env.bind_clip_logits(clip_sampler.logits(sampler_state))
+
+
+def _where_done(done, x, y):
+    if done.shape:
+        done = jp.reshape(done, [x.shape[0]] + [1] * (len(x.shape) - 1))  # type: ignore
+    return jp.where(done, x, y)
+
+
+def state_nbytes(state: State) -> float:
+    """Bytes of a batched env state (pipeline state, obs, metrics and info)
+    per env. Works on traced states too."""
+    leaves = jax.tree.leaves(state)
+    return sum(x.size * x.dtype.itemsize for x in leaves) / state.done.size
+
+
+class TrackingTrainingWrapper(Wrapper):
+    """Episode, vmap and auto-reset bookkeeping of `wrap` in a single pass.
+
+    Step counting, truncation, done handling, episode metric sums and reset
+    selection share one copy of info. With stored first states, the only
+    tree-wide where is the reset selection of the pipeline state; with a reset
+    bank, a `clip_sampler` or `lean_auto_reset` only the done envs are reset
+    (see AutoResetWrapperTracking). Episode
+    sums of reward, length and every metric are kept in info["episode_metrics"]
+    and restart with each episode. With `clip_metrics`, the finished episodes
+    are also summed by clip into info["clip_metrics"] (see clip_metrics), which
+    like info["clip_sampler"] is not batched.
+    """
+
+    def __init__(
+        self,
+        env: Env,
+        episode_length: int,
+        action_repeat: int,
+        randomization_fn: Optional[
+            Callable[[System], Tuple[System, System]]
+        ] = None,
+        lean_auto_reset: bool = False,
+        clip_sampler: Optional[AdaptiveClipSampler] = None,
+        clip_metrics: bool = False,
+    ):
+        super().__init__(env)
+        self.episode_length = episode_length
+        self.action_repeat = action_repeat
+        self._sys_v, self._in_axes = None, None
+        if randomization_fn is not None:
+            self._sys_v, self._in_axes = randomization_fn(self.sys)
+            per_env, shared = system_nbytes(self._sys_v, self._in_axes)
+            print(
+                f"domain randomization: {per_env / 1e3:.1f} kB System per env, "
+                f"{shared / 1e6:.2f} MB shared"
+            )
+        self._clip_sampler = clip_sampler
+        self._fresh_resets = (
+            getattr(env.unwrapped, "reset_bank", None) is not None
+            or clip_sampler is not None
+        )
+        self._lean = lean_auto_reset
+        self._clip_metrics = clip_metrics
+
+    def _vmap(self, fn: Callable, *args, rows: Optional[jax.Array] = None):
+        """vmaps `fn` over the env batch, with each env's randomized System;
+        over the envs at `rows` of the batch if given."""
+        if self._sys_v is None:
+            return jax.vmap(fn)(*args)
+        sys_v = self._sys_v
+        if rows is not None:
+            sys_v = _gather_sys_rows(sys_v, self._in_axes, rows)
+
+        def fn_with_sys(sys, *args):
+            unwrapped = self.env.unwrapped
+            stored, unwrapped.sys = unwrapped.sys, sys
+            try:
+                return fn(*args)
+            finally:
+                unwrapped.sys = stored
+
+        in_axes = (self._in_axes,) + (0,) * len(args)
+        return jax.vmap(fn_with_sys, in_axes=in_axes)(sys_v, *args)
+
+    def reset(self, rng: jax.Array) -> State:
+        state = self._vmap(self.env.reset, rng)
+        zeros = jp.zeros(rng.shape[:-1])
+        info = state.info
+        info["steps"] = zeros
+        info["truncation"] = zeros
+        info["episode_metrics"] = {
+            "sum_reward": zeros,
+            "length": zeros,
+            **{name: zeros for name in state.metrics},
+        }
+        if self._clip_sampler is not None:
+            info["clip_sampler"] = self._clip_sampler.init()
+        if self._clip_metrics:
+            info["clip_metrics"] = jp.zeros(
+                (self.env.n_clips, len(CLIP_METRIC_NAMES))
+            )
+        if self._fresh_resets or self._lean:
+            info["reset_rng"] = rng
+        else:
+            info["first_pipeline_state"] = state.pipeline_state
+            info["first_obs"] = state.obs
+            info["first_info"] = {
+                key: info[key] for key in _RESET_INFO_KEYS if key in info
+            }
+        return state
+
+    def step(self, state: State, action: jax.Array) -> State:
+        # Episodes that ended on the previous step start over here
+        keep = 1.0 - state.done
+        steps = state.info["steps"] * keep
+        info = dict(state.info, steps=steps)
+        # Unbatched entries skip the vmapped env
+        sampler_state = info.pop("clip_sampler", None)
+        clip_sums = info.pop("clip_metrics", None)
+        state = state.replace(done=jp.zeros_like(state.done), info=info)
+
+        def f(state, _):
+            nstate = self._vmap(self.env.step, state, action)
+            return nstate, nstate.reward
+
+        state, rewards = jax.lax.scan(f, state, (), self.action_repeat)
+        reward = jp.sum(rewards, axis=0)
+
+        info = state.info
+        info["steps"] = steps + self.action_repeat
+        timeout = info["steps"] >= self.episode_length
+        terminated = state.done * (1 - info["truncation"])
+        info["truncation"] = jp.where(timeout, 1 - terminated, info["truncation"])
+        done = jp.where(timeout, 1.0, state.done)
+
+        episode_metrics = info["episode_metrics"]
+        info["episode_metrics"] = {
+            "sum_reward": episode_metrics["sum_reward"] * keep + reward,
+            "length": episode_metrics["length"] * keep + self.action_repeat,
+            **{
+                name: episode_metrics[name] * keep + value
+                for name, value in state.metrics.items()
+            },
+        }
+        state = state.replace(reward=reward, done=done, info=info)
+
+        if sampler_state is not None:
+            sampler_state = self._clip_sampler.update(
+                sampler_state, info["clip_idx"], done, terminated, info["steps"]
+            )
+        if clip_sums is not None:
+            clip_sums = clip_sums + clip_metric_sums(
+                self.env.n_clips,
+                info.get("clip_idx", jp.zeros(done.shape, jp.int32)),
+                done,
+                info["steps"],
+                terminated,
+                info["episode_metrics"],
+            )
+
+        if self._fresh_resets or self._lean:
+            with _sampling_clips(self.env, self._clip_sampler, sampler_state):
+                state = _rebuild_done_rows(
+                    self._reset_rows, state, self._fresh_resets
+                )
+        else:
+            where_done = functools.partial(_where_done, done)
+            pipeline_state = jax.tree.map(
+                where_done, info["first_pipeline_state"], state.pipeline_state
+            )
+            obs = where_done(info["first_obs"], state.obs)
+            for key, first in info["first_info"].items():
+                info[key] = where_done(first, info[key])
+            state = state.replace(pipeline_state=pipeline_state, obs=obs)
+
+        if sampler_state is not None:
+            state.info["clip_sampler"] = sampler_state
+        if clip_sums is not None:
+            state.info["clip_metrics"] = clip_sums
+        return state
+
+    def _reset_rows(self, rng: jax.Array, rows: jax.Array) -> State:
+        """Resets the envs at `rows` of the batch, one key each."""
+        return self._vmap(self.env.reset, rng, rows=rows)
+
 
 class EvalClipWrapperTracking(Wrapper):
     """Always resets to 0, at a specific clip"""
@@ -148,15 +510,7 @@ class EvalClipWrapperTracking(Wrapper):
     def reset(self, rng: jax.Array, clip_idx=0) -> State:
         _, rng = jax.random.split(rng)
 
-        info = {
-            "clip_idx": clip_idx,
-            "cur_frame": 0,
-            "steps_taken_cur_frame": 0,
-            "summed_pos_distance": 0.0,
-            "quat_distance": 0.0,
-            "joint_distance": 0.0,
-            "prev_ctrl": jp.zeros((self.sys.nu,)),
-        }
+        info = self._reset_info(clip_idx, 0)
 
         return self.reset_from_clip(rng, info, noise=False)
 
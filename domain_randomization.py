@@ -0,0 +1,91 @@
+"""Domain randomization of the rodent's body masses, friction and actuator gains.
+
+`randomize_rodent` follows the randomization_fn interface of
+DomainRandomizationVmapWrapper: given the System and a batch of rngs it returns
+the batched System and the in_axes to vmap it with. Only the randomized leaves
+carry the batch axis; every other leaf is shared by all envs.
+"""
+
+from typing import Tuple
+
+import jax
+from jax import numpy as jp
+from brax.base import System
+
+
+def randomize_rodent(
+    sys: System,
+    rng: jax.Array,
+    mass_range=(0.9, 1.1),
+    friction_range=(0.8, 1.2),
+    gain_range=(0.9, 1.1),
+) -> Tuple[System, System]:
+    """Samples per-env body masses, contact friction and actuator gains.
+
+    Args:
+        sys (System): the rodent system.
+        rng (jax.Array): one key per env.
+        mass_range: bounds of the scale applied to each body's mass (and its
+            inertia, so the mass distribution within a body is kept).
+        friction_range: bounds of the scale applied to the sliding friction
+            of every contact, one scale per env: that of every geom, and with
+            explicit contact pairs (the env's contact_policy) that of every
+            pair, which overrides the geoms' for the pair's contacts.
+        gain_range: bounds of the scale applied to each actuator's force
+            (its gain and bias terms together, so position-like actuators
+            keep their setpoint).
+
+    Returns:
+        Tuple[System, System]: the batched System and its in_axes.
+    """
+
+    @jax.vmap
+    def sample(rng):
+        mass_rng, friction_rng, gain_rng = jax.random.split(rng, 3)
+        mass_scale = jax.random.uniform(
+            mass_rng, (sys.nbody,), minval=mass_range[0], maxval=mass_range[1]
+        )
+        friction_scale = jax.random.uniform(
+            friction_rng, (), minval=friction_range[0], maxval=friction_range[1]
+        )
+        gain_scale = jax.random.uniform(
+            gain_rng, (sys.nu,), minval=gain_range[0], maxval=gain_range[1]
+        )
+        randomized = {
+            "body_mass": sys.body_mass * mass_scale,
+            "body_inertia": sys.body_inertia * mass_scale[:, None],
+            "geom_friction": sys.geom_friction.at[:, 0].multiply(friction_scale),
+            "actuator_gainprm": sys.actuator_gainprm.at[:, 0].multiply(gain_scale),
+            "actuator_biasprm": sys.actuator_biasprm.at[:, :3].multiply(
+                gain_scale[:, None]
+            ),
+        }
+        if sys.npair > 0:
+            # Both tangential directions of each pair's sliding friction
+            randomized["pair_friction"] = sys.pair_friction.at[:, :2].multiply(
+                friction_scale
+            )
+        return randomized
+
+    randomized = sample(rng)
+    in_axes = jax.tree.map(lambda x: None, sys)
+    in_axes = in_axes.tree_replace({field: 0 for field in randomized})
+    return sys.tree_replace(randomized), in_axes
+
+
+def system_nbytes(sys_v: System, in_axes: System) -> Tuple[float, int]:
+    """Bytes of a batched System held per env and shared once by all envs."""
+    is_leaf = lambda x: x is None
+    batched, shared, batch_size = 0, 0, 1
+    for x, axis in zip(
+        jax.tree.leaves(sys_v, is_leaf=is_leaf),
+        jax.tree.leaves(in_axes, is_leaf=is_leaf),
+    ):
+        if not hasattr(x, "nbytes"):
+            continue
+        if axis is None:
+            shared += x.nbytes
+        else:
+            batched += x.nbytes
+            batch_size = x.shape[axis]
+    return batched / batch_size, shared
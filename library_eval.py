@@ -0,0 +1,123 @@
+"""Deterministic evaluation of a policy on every clip of the library at once.
+
+Each clip is rolled out from frame 0 without reset noise; the rollouts of a
+chunk of clips are vmapped, the steps run in one lax.scan, and the chunks run
+in a lax.map, so a whole-library report is a single compiled call instead of
+one Python-driven rollout per clip (cf. EvalClipWrapperTracking).
+"""
+
+import functools
+from typing import Callable, NamedTuple, Optional
+
+import jax
+from jax import numpy as jp
+from brax.training.types import Policy, PolicyParams, PRNGKey
+
+from preprocessing.mjx_preprocess import ReferenceClip
+from Rodent_Env_Brax import RodentTracking
+
+# Columns of LibraryEvalTable.errors; the distances are those the env compares
+# against its termination thresholds
+LIBRARY_ERROR_NAMES = (
+    "pos_distance",
+    "quat_distance",
+    "joint_distance",
+    "bodypos_distance",
+    "reward",
+)
+
+
+class LibraryEvalTable(NamedTuple):
+    """Per-clip, per-step tracking errors of a library evaluation."""
+
+    errors: jp.ndarray  # (n_clips, n_steps, len(LIBRARY_ERROR_NAMES)), nan once done
+    frame: jp.ndarray  # (n_clips, n_steps) reference frame tracked at each step
+    episode_length: jp.ndarray  # (n_clips,) steps before the episode ended
+
+
+def _tracking_errors(env: RodentTracking, state) -> jp.ndarray:
+    """The LIBRARY_ERROR_NAMES of one walker's state."""
+    reference_window = env._get_reference_window(state.info)
+    features = env._get_tracking_features(state.pipeline_state, reference_window)
+    return jp.stack(
+        [
+            jp.sum((features["position"] * jp.array([1.0, 1.0, 0.2])) ** 2),
+            jp.sum(features["quaternion"] ** 2),
+            jp.sum(features["joints"] ** 2),
+            jp.sum(features["body_positions"][env._feature_tracked_idxs] ** 2),
+            state.reward,
+        ]
+    )
+
+
+def make_library_eval(
+    env: RodentTracking,
+    eval_policy_fn: Callable[[PolicyParams], Policy],
+    chunk_size: int = 256,
+    n_steps: Optional[int] = None,
+) -> Callable[[ReferenceClip, PolicyParams, PRNGKey], LibraryEvalTable]:
+    """Builds a jitted whole-library evaluation of `env`.
+
+    Args:
+        env (RodentTracking): unwrapped single-walker env holding the library.
+        eval_policy_fn (Callable): returns the policy from the policy
+            parameters, e.g. functools.partial(make_policy, deterministic=True).
+        chunk_size (int): clips rolled out in parallel; bounds the memory of
+            the vmapped physics states.
+        n_steps (Optional[int]): control steps per rollout; defaults to the
+            env's max_episode_length, enough to finish the longest clip.
+
+    Returns:
+        Callable: (reference_clips, policy_params, key) -> LibraryEvalTable,
+        with reference_clips the env's library (env.reference_clips).
+    """
+    if hasattr(env, "n_agents"):
+        raise NotImplementedError("Library evaluation rolls out a single walker")
+    n_clips = env.n_clips
+    n_steps = env.max_episode_length if n_steps is None else n_steps
+    chunk_size = min(chunk_size, n_clips)
+    n_chunks = -(-n_clips // chunk_size)
+
+    def rollout(policy, clip_idx, key):
+        reset_rng, key = jax.random.split(key)
+        info = env._reset_info(clip_idx, 0)
+        state = env.reset_from_clip(reset_rng, info, noise=False)
+
+        def step(carry, key):
+            state, active = carry
+            action, _ = policy(state.obs, key)
+            state = env.step(state, action)
+            errors = jp.where(active > 0, _tracking_errors(env, state), jp.nan)
+            frame = state.info["cur_frame"]
+            active = active * (1.0 - state.done)
+            return (state, active), (errors, frame, active)
+
+        _, (errors, frame, active) = jax.lax.scan(
+            step, (state, jp.ones(())), jax.random.split(key, n_steps)
+        )
+        # A step counts toward the episode if it was taken while active,
+        # including the one that ended it
+        episode_length = 1 + jp.sum(active[:-1])
+        return errors, frame, episode_length
+
+    def library_eval(policy_params, key):
+        policy = eval_policy_fn(policy_params)
+        # Pads the last chunk by repeating the last clip; the rows are dropped
+        clip_idx = jp.minimum(jp.arange(n_chunks * chunk_size), n_clips - 1)
+        keys = jax.random.split(key, n_chunks * chunk_size)
+        chunks = jax.tree.map(
+            lambda x: x.reshape(n_chunks, chunk_size, *x.shape[1:]), (clip_idx, keys)
+        )
+        errors, frame, episode_length = jax.lax.map(
+            lambda chunk: jax.vmap(functools.partial(rollout, policy))(*chunk),
+            chunks,
+        )
+        return LibraryEvalTable(
+            errors=errors.reshape(-1, *errors.shape[2:])[:n_clips],
+            frame=frame.reshape(-1, n_steps)[:n_clips],
+            episode_length=episode_length.reshape(-1)[:n_clips],
+        )
+
+    return jax.jit(
+        env.with_reference_clips(env.with_metrics_level("off", library_eval))
+    )
@@ -0,0 +1,377 @@
+"""Cache of compiled MuJoCo models for the rodent envs and renderer.
+
+Building the rodent model goes through dm_control (MJCF parsing, actuator
+conversion, rescale.rescale_subtree, Physics construction), which dominates env
+construction time. The compiled model is saved as .mjb together with the
+name -> id index tables derived from it, keyed by a hash of the XML content,
+the files it includes or loads, the scale, the actuator mode and the MuJoCo
+version, so later constructions skip dm_control.
+
+With n_walkers > 1 the model holds several copies of the walker in one world;
+copy k > 0 is attached under the name prefix walker_prefix(k).
+"""
+
+import hashlib
+import json
+import os
+import xml.etree.ElementTree as ElementTree
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import mujoco
+import numpy as np
+
+CACHE_DIR = os.environ.get(
+    "RODENT_MODEL_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "rodent_mjb")
+)
+
+# Declarative contact policy: pairs of (names, names), where each name is a geom
+# or a body (selecting the colliding geoms attached to it). Every geom in the
+# first list may collide with every geom in the second; nothing else collides.
+ContactPairs = Sequence[Tuple[Sequence[str], Sequence[str]]]
+
+
+def _asset_files(xml_path: str) -> List[str]:
+    """Paths of the files an MJCF file includes or loads (meshes, textures,
+    skins, height fields), following includes. Paths are resolved against
+    the compiler's meshdir/texturedir/assetdir like MuJoCo does."""
+    root = ElementTree.parse(xml_path).getroot()
+    base = os.path.dirname(xml_path)
+    dirs = {}
+    for compiler in root.iter("compiler"):
+        for attr in ("assetdir", "meshdir", "texturedir"):
+            if attr in compiler.attrib:
+                dirs[attr] = compiler.attrib[attr]
+    asset_dir = dirs.get("assetdir", "")
+    tag_dirs = {
+        "mesh": dirs.get("meshdir", asset_dir),
+        "skin": dirs.get("meshdir", asset_dir),
+        "hfield": dirs.get("meshdir", asset_dir),
+        "texture": dirs.get("texturedir", asset_dir),
+    }
+
+    files = []
+    for element in root.iter():
+        if "file" not in element.attrib:
+            continue
+        if element.tag == "include":
+            path = os.path.join(base, element.attrib["file"])
+            files.append(path)
+            if os.path.exists(path):
+                files.extend(_asset_files(path))
+        else:
+            tag_dir = tag_dirs.get(element.tag, asset_dir)
+            files.append(os.path.join(base, tag_dir, element.attrib["file"]))
+    return files
+
+
+def _cache_key(
+    xml_path: str,
+    scale: float,
+    torque_actuators: bool,
+    contact_pairs: Optional[ContactPairs] = None,
+    n_walkers: int = 1,
+) -> str:
+    """Hash of the XML content, the files it includes or loads, the MuJoCo
+    version and the build options of the compiled model."""
+    digest = hashlib.sha256()
+    with open(xml_path, "rb") as f:
+        digest.update(f.read())
+    for path in _asset_files(xml_path):
+        digest.update(path.encode())
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    options = {
+        "scale": scale,
+        "torque_actuators": torque_actuators,
+        "mujoco": mujoco.__version__,
+    }
+    if contact_pairs is not None:
+        options["contact_pairs"] = [[list(a), list(b)] for a, b in contact_pairs]
+    if n_walkers > 1:
+        options["n_walkers"] = n_walkers
+    digest.update(json.dumps(options).encode())
+    return digest.hexdigest()[:32]
+
+
+def _select_geoms(mj_model: mujoco.MjModel, names: Sequence[str]) -> List[int]:
+    """Geom ids for a list of geom or body names. A body name selects the
+    colliding geoms attached directly to that body."""
+    geoms = []
+    for name in names:
+        geom = mujoco.mj_name2id(mj_model, mujoco.mjtObj.mjOBJ_GEOM, name)
+        if geom >= 0:
+            geoms.append(geom)
+            continue
+        body = mujoco.mj_name2id(mj_model, mujoco.mjtObj.mjOBJ_BODY, name)
+        if body < 0:
+            raise ValueError(f"No geom or body named {name}")
+        geoms.extend(
+            g
+            for g in range(mj_model.ngeom)
+            if mj_model.geom_bodyid[g] == body
+            and (mj_model.geom_contype[g] or mj_model.geom_conaffinity[g])
+        )
+    return geoms
+
+
+def _add_contact_pairs(root, mj_model: mujoco.MjModel, contact_pairs: ContactPairs):
+    """Replaces contype/conaffinity collisions with explicit contact pairs.
+
+    Pair parameters are mixed from the two geoms the way MuJoCo does for
+    dynamically generated contacts (priority, then max condim/friction and
+    solmix-weighted solref/solimp).
+    """
+    pairs = set()
+    for names1, names2 in contact_pairs:
+        for g1 in _select_geoms(mj_model, names1):
+            for g2 in _select_geoms(mj_model, names2):
+                if g1 != g2:
+                    pairs.add((min(g1, g2), max(g1, g2)))
+
+    for geom in root.find_all("geom"):
+        geom.contype = 0
+        geom.conaffinity = 0
+
+    for g1, g2 in sorted(pairs):
+        p1, p2 = mj_model.geom_priority[g1], mj_model.geom_priority[g2]
+        if p1 != p2:
+            g = g1 if p1 > p2 else g2
+            condim = mj_model.geom_condim[g]
+            friction = mj_model.geom_friction[g]
+        else:
+            condim = max(mj_model.geom_condim[g1], mj_model.geom_condim[g2])
+            friction = np.maximum(mj_model.geom_friction[g1], mj_model.geom_friction[g2])
+        solmix1, solmix2 = mj_model.geom_solmix[g1], mj_model.geom_solmix[g2]
+        mix = solmix1 / (solmix1 + solmix2) if solmix1 + solmix2 > 0 else 0.5
+        root.contact.add(
+            "pair",
+            geom1=mujoco.mj_id2name(mj_model, mujoco.mjtObj.mjOBJ_GEOM, g1),
+            geom2=mujoco.mj_id2name(mj_model, mujoco.mjtObj.mjOBJ_GEOM, g2),
+            condim=int(condim),
+            friction=[friction[0], friction[0], friction[1], friction[2], friction[2]],
+            solref=mix * mj_model.geom_solref[g1] + (1 - mix) * mj_model.geom_solref[g2],
+            solimp=mix * mj_model.geom_solimp[g1] + (1 - mix) * mj_model.geom_solimp[g2],
+        )
+
+
+def count_collision_pairs(mj_model: mujoco.MjModel) -> int:
+    """Number of geom pairs the collision pipeline has to test.
+
+    Counts the dynamic pairs allowed by contype/conaffinity (skipping geoms on
+    the same body and, unless disabled, parent-child bodies) plus the explicit
+    contact pairs, minus excluded body pairs.
+    """
+    filter_parent = not (
+        mj_model.opt.disableflags & mujoco.mjtDisableBit.mjDSBL_FILTERPARENT
+    )
+    excluded = {
+        frozenset((b1, b2))
+        for b1, b2 in zip(
+            (mj_model.exclude_signature >> 16) & 0xFFFF,
+            mj_model.exclude_signature & 0xFFFF,
+        )
+    }
+    weld = mj_model.body_weldid
+    n_pairs = mj_model.npair
+    for g1 in range(mj_model.ngeom):
+        for g2 in range(g1 + 1, mj_model.ngeom):
+            if not (
+                mj_model.geom_contype[g1] & mj_model.geom_conaffinity[g2]
+                or mj_model.geom_contype[g2] & mj_model.geom_conaffinity[g1]
+            ):
+                continue
+            b1, b2 = mj_model.geom_bodyid[g1], mj_model.geom_bodyid[g2]
+            w1, w2 = weld[b1], weld[b2]
+            if w1 == w2:
+                continue
+            if filter_parent and w1 != 0 and w2 != 0:
+                if weld[mj_model.body_parentid[w1]] == w2 or (
+                    weld[mj_model.body_parentid[w2]] == w1
+                ):
+                    continue
+            if frozenset((b1, b2)) in excluded:
+                continue
+            n_pairs += 1
+    return n_pairs
+
+
+def walker_prefix(k: int) -> str:
+    """Name prefix of walker k in a model built with n_walkers > 1."""
+    return "" if k == 0 else f"rodent_{k}/"
+
+
+def _isolate_walkers(root, physics):
+    """Lets walker geoms collide with the floor only: walker conaffinity is
+    cleared and the floor accepts every walker contype."""
+    floor = root.find("geom", "floor")
+    walker_contype = 0
+    for geom in root.find_all("geom"):
+        if geom is floor:
+            continue
+        walker_contype |= int(physics.bind(geom).contype)
+        geom.conaffinity = 0
+    floor.conaffinity = int(physics.bind(floor).conaffinity) | walker_contype
+
+
+def _build_model(
+    xml_path: str,
+    scale: float,
+    torque_actuators: bool,
+    contact_pairs: Optional[ContactPairs] = None,
+    n_walkers: int = 1,
+) -> mujoco.MjModel:
+    """Compiles the model through dm_control (the uncached path)."""
+    # Imported here so cached constructions never load dm_control
+    from dm_control import mjcf as mjcf_dm
+    from dm_control.locomotion.walkers import rescale
+
+    def load_walker():
+        walker = mjcf_dm.from_path(xml_path)
+
+        # Convert to torque actuators
+        if torque_actuators:
+            for actuator in walker.find_all("actuator"):
+                actuator.gainprm = [actuator.forcerange[1]]
+                del actuator.biastype
+                del actuator.biasprm
+
+        rescale.rescale_subtree(
+            walker,
+            scale,
+            scale,
+        )
+        return walker
+
+    root = load_walker()
+
+    # Further walkers share the first one's floor and options. The free joint
+    # moves to the attachment frame, the only body that can carry it there.
+    for k in range(1, n_walkers):
+        walker = load_walker()
+        walker.model = walker_prefix(k)[:-1]
+        walker.find("geom", "floor").remove()
+        walker.find("joint", "root").remove()
+        root.attach(walker).add("freejoint")
+
+    if n_walkers > 1 and contact_pairs is None:
+        _isolate_walkers(root, mjcf_dm.Physics.from_mjcf_model(root))
+    mj_model = mjcf_dm.Physics.from_mjcf_model(root).model.ptr
+
+    if contact_pairs is not None:
+        _add_contact_pairs(root, mj_model, contact_pairs)
+        mj_model = mjcf_dm.Physics.from_mjcf_model(root).model.ptr
+    return mj_model
+
+
+def _index_table(
+    mj_model: mujoco.MjModel, obj_type: str, names: Sequence[str]
+) -> np.ndarray:
+    return np.array(
+        [
+            mujoco.mj_name2id(mj_model, mujoco.mju_str2Type(obj_type), name)
+            for name in names
+        ]
+    )
+
+
+def load_model(
+    xml_path: str,
+    scale: float,
+    torque_actuators: bool = False,
+    index_names: Optional[Dict[str, Tuple[str, Sequence[str]]]] = None,
+    cache_dir: Optional[str] = CACHE_DIR,
+    contact_pairs: Optional[ContactPairs] = None,
+    n_walkers: int = 1,
+) -> Tuple[mujoco.MjModel, Dict[str, np.ndarray]]:
+    """Loads the compiled model, building and caching it on a miss.
+
+    Args:
+        xml_path (str): MJCF file of the model.
+        scale (float): factor passed to rescale.rescale_subtree.
+        torque_actuators (bool): convert the actuators to torque actuators.
+        index_names (Optional[Dict[str, Tuple[str, Sequence[str]]]]): index
+            tables to derive, as {table: (object type, names)}, e.g.
+            {"body_idxs": ("body", ["torso", "pelvis"])}.
+        cache_dir (Optional[str]): where compiled models are stored. Defaults
+            to $RODENT_MODEL_CACHE or ~/.cache/rodent_mjb; None disables the
+            cache.
+        contact_pairs (Optional[ContactPairs]): if set, the only pairs that
+            may collide; see ContactPairs. Defaults to the model's own
+            contype/conaffinity filtering.
+        n_walkers (int): copies of the walker in the world. Walkers only
+            collide with the floor (or as given by contact_pairs).
+
+    Returns:
+        Tuple[mujoco.MjModel, Dict[str, np.ndarray]]: the compiled model and
+            the requested index tables.
+    """
+    index_names = index_names or {}
+    if cache_dir is None:
+        mj_model = _build_model(
+            xml_path, scale, torque_actuators, contact_pairs, n_walkers
+        )
+        return mj_model, {
+            table: _index_table(mj_model, obj_type, names)
+            for table, (obj_type, names) in index_names.items()
+        }
+
+    key = _cache_key(xml_path, scale, torque_actuators, contact_pairs, n_walkers)
+    mjb_path = os.path.join(cache_dir, f"{key}.mjb")
+    tables_path = os.path.join(cache_dir, f"{key}.npz")
+
+    mj_model = None
+    if os.path.exists(mjb_path):
+        try:
+            mj_model = mujoco.MjModel.from_binary_path(mjb_path)
+        except Exception as e:
+            # e.g. an unreadable or truncated file; rebuilt and overwritten
+            print(f"Rebuilding {mjb_path}, which failed to load: {e}")
+    if mj_model is None:
+        mj_model = _build_model(
+            xml_path, scale, torque_actuators, contact_pairs, n_walkers
+        )
+        _save(mjb_path, lambda path: mujoco.mj_saveModel(mj_model, path, None))
+
+    tables = {}
+    if os.path.exists(tables_path):
+        with np.load(tables_path) as cached:
+            tables = dict(cached)
+
+    # Index tables are keyed by their name list too, so changed names rebuild
+    missing = {
+        table: spec
+        for table, spec in index_names.items()
+        if _table_key(table, spec) not in tables
+    }
+    if missing:
+        for table, (obj_type, names) in missing.items():
+            tables[_table_key(table, (obj_type, names))] = _index_table(
+                mj_model, obj_type, names
+            )
+        _save(tables_path, lambda path: np.savez(path, **tables))
+
+    return mj_model, {
+        table: tables[_table_key(table, spec)] for table, spec in index_names.items()
+    }
+
+
+def _table_key(table: str, spec: Tuple[str, Sequence[str]]) -> str:
+    obj_type, names = spec
+    digest = hashlib.sha256(json.dumps([obj_type, list(names)]).encode())
+    return f"{table}_{digest.hexdigest()[:8]}"
+
+
+def _save(path: str, write):
+    """Writes through a temporary file so concurrent jobs never read a partial
+    cache entry. Failures (e.g. a read-only cache dir) only skip caching."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write(tmp_path)
+        # np.savez appends .npz to names without it
+        if not os.path.exists(tmp_path) and os.path.exists(f"{tmp_path}.npz"):
+            tmp_path = f"{tmp_path}.npz"
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not cache compiled model at {path}: {e}")
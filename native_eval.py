@@ -0,0 +1,268 @@
+"""Native MuJoCo evaluation of the tracking envs on CPU.
+
+The physics runs in MuJoCo C: one MjData per env, stepped across a thread pool
+(mj_step releases the GIL). Resets, rewards, observations, terminations and
+metrics come from the env's own helpers (_reference_qpos_qvel, _reset_tracking
+and _tracking_step), jitted over the batch on the host CPU, so they match the
+MJX env for the same physics state. The policy runs batched on the host as
+well, which leaves the accelerator to training.
+
+benchmarks/native_eval_parity.py checks the results against the MJX env.
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+
+import jax
+from jax import numpy as jp
+import mujoco
+import numpy as np
+from brax.training.types import Metrics, Policy, PolicyParams, PRNGKey
+
+from clip_metrics import clip_metric_sums, clip_metrics_means, terminated_from_metrics
+from Rodent_Env_Brax import RodentTracking, _AgentData
+
+
+class NativeTrackingEnv:
+    """A batch of single-walker tracking envs with MuJoCo C physics.
+
+    Steps the walker model of `env` (same solver and physics settings) for
+    env's physics steps per control step. The info of the batch is kept on the
+    host CPU between calls; reset and step return numpy arrays.
+    """
+
+    def __init__(
+        self, env: RodentTracking, num_envs: int, num_threads: Optional[int] = None
+    ):
+        if hasattr(env, "n_agents"):
+            raise NotImplementedError("Native envs step a single walker per MjData")
+        self._env = env
+        self._model = env._walker_mj_model
+        self._n_frames = env._n_frames
+        self.num_envs = num_envs
+        self._datas = [mujoco.MjData(self._model) for _ in range(num_envs)]
+        num_threads = min(num_threads or os.cpu_count(), num_envs)
+        self._pool = ThreadPoolExecutor(num_threads)
+        self._num_threads = num_threads
+
+        self._cpu = jax.devices("cpu")[0]
+        self._reference_clips = jax.device_put(env.reference_clips, self._cpu)
+        self.info = None
+
+        def sample_reset(rng):
+            _, start_rng, rng = jax.random.split(rng, 3)
+            return rng, env._sample_reset_info(start_rng)
+
+        self._sample_reset = jax.jit(env.with_reference_clips(jax.vmap(sample_reset)))
+        self._reference_qpos_qvel = jax.jit(
+            env.with_reference_clips(
+                jax.vmap(env._reference_qpos_qvel, in_axes=(0, 0, None))
+            ),
+            static_argnums=3,
+        )
+        self._reset_tracking = jax.jit(
+            env.with_reference_clips(jax.vmap(env._reset_tracking))
+        )
+        self._tracking_step = jax.jit(
+            env.with_reference_clips(jax.vmap(env._tracking_step))
+        )
+
+    def reset(self, rng: PRNGKey) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Resets every env at a random clip and start frame, like env.reset
+        without a reset bank. Returns the observations and zeroed metrics."""
+        rngs = jax.device_put(jax.random.split(rng, self.num_envs), self._cpu)
+        rngs, info = self._sample_reset(self._reference_clips, rngs)
+        return self.reset_from_clip(rngs, info)
+
+    def reset_from_clip(
+        self, rngs: PRNGKey, info, noise: bool = True
+    ) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Resets env i at the reference frame of info[i] (see
+        RodentTracking.reset_from_clip), with one key per env."""
+        info = dict(info)
+        if self._env._interpolate_reference:
+            info["cur_frame"] = jp.asarray(info["cur_frame"], jp.float32)
+        qpos, qvel, reference_window = self._reference_qpos_qvel(
+            self._reference_clips, rngs, info, noise
+        )
+        self.set_state(np.asarray(qpos), np.asarray(qvel))
+        obs, metrics, self.info = self._reset_tracking(
+            self._reference_clips, self.data(), info, reference_window
+        )
+        return np.asarray(obs), jax.tree.map(np.asarray, metrics)
+
+    def set_state(self, qpos: np.ndarray, qvel: np.ndarray):
+        """Sets every env's qpos and qvel and recomputes the derived state."""
+
+        def set_one(i):
+            data = self._datas[i]
+            mujoco.mj_resetData(self._model, data)
+            data.qpos[:] = qpos[i]
+            data.qvel[:] = qvel[i]
+            mujoco.mj_forward(self._model, data)
+
+        self._map(set_one, np.arange(self.num_envs))
+
+    def step(
+        self, action: np.ndarray, active: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
+        """Steps every env (or only the `active` ones) with `action`.
+
+        Returns obs, reward, done and metrics as in RodentTracking.step.
+        Inactive envs keep their physics state.
+        """
+        action = np.asarray(action)
+
+        def step_one(i):
+            data = self._datas[i]
+            data.ctrl[:] = action[i]
+            for _ in range(self._n_frames):
+                mujoco.mj_step(self._model, data)
+
+        idxs = np.arange(self.num_envs) if active is None else np.flatnonzero(active)
+        self._map(step_one, idxs)
+
+        obs, reward, done, metrics, self.info = self._tracking_step(
+            self._reference_clips, self.data(), self.info, action
+        )
+        return (
+            np.asarray(obs),
+            np.asarray(reward),
+            np.asarray(done),
+            jax.tree.map(np.asarray, metrics),
+        )
+
+    def data(self) -> _AgentData:
+        """qpos, qvel and xpos of every env, stacked along axis 0."""
+        return _AgentData(
+            qpos=np.stack([d.qpos for d in self._datas]).astype(np.float32),
+            qvel=np.stack([d.qvel for d in self._datas]).astype(np.float32),
+            xpos=np.stack([d.xpos for d in self._datas]).astype(np.float32),
+        )
+
+    def _map(self, fn: Callable[[int], None], idxs: np.ndarray):
+        """Runs fn over idxs, one contiguous chunk per thread."""
+
+        def run(chunk):
+            for i in chunk:
+                fn(i)
+
+        chunks = np.array_split(idxs, self._num_threads)
+        list(self._pool.map(run, [chunk for chunk in chunks if len(chunk)]))
+
+
+class NativeEvaluator:
+    """Runs evaluations on a NativeTrackingEnv; a drop-in for
+    custom_acting.Evaluator, with the same tracking and per-clip metrics.
+
+    Each env runs one episode per evaluation, on a random clip and start frame
+    drawn like env.reset without a reset bank, even if the env has one. Takes
+    the unwrapped env; action_repeat is 1 and domain randomization is not
+    applied. The physics metrics (contacts, penetration, solver iterations) are
+    not reported, and with health_check_fields="all" the health flag only
+    checks qpos, qvel and xpos.
+    """
+
+    def __init__(
+        self,
+        eval_env: RodentTracking,
+        eval_policy_fn: Callable[[PolicyParams], Policy],
+        num_eval_envs: int,
+        episode_length: int,
+        key: PRNGKey,
+        num_threads: Optional[int] = None,
+    ):
+        """Init.
+
+        Args:
+          eval_env: Unwrapped environment to run evals on.
+          eval_policy_fn: Function returning the policy from the policy parameters.
+          num_eval_envs: Each env will run 1 episode in parallel for each eval.
+          episode_length: Maximum length of an episode.
+          key: RNG key.
+          num_threads: Threads stepping the physics; defaults to the CPU count.
+        """
+        self._env = NativeTrackingEnv(eval_env, num_eval_envs, num_threads)
+        self._n_clips = eval_env.n_clips
+        self._episode_length = episode_length
+        self._key = key
+        self._eval_walltime = 0.0
+        self._cpu = jax.devices("cpu")[0]
+
+        self._policy = jax.jit(
+            lambda params, obs, key: eval_policy_fn(params)(obs, key)[0]
+        )
+        self._clip_metric_sums = jax.jit(clip_metric_sums, static_argnums=0)
+
+    def run_evaluation(
+        self,
+        policy_params: PolicyParams,
+        training_metrics: Metrics,
+        aggregate_episodes: bool = True,
+    ) -> Metrics:
+        """Run one epoch of evaluation."""
+        self._key, reset_key, policy_key = jax.random.split(self._key, 3)
+        policy_params, policy_key = jax.device_put(
+            (policy_params, policy_key), self._cpu
+        )
+
+        t = time.time()
+        obs, metrics = self._env.reset(reset_key)
+        clip_idx = np.asarray(
+            self._env.info.get("clip_idx", np.zeros(self._env.num_envs, np.int32))
+        )
+        num_envs = self._env.num_envs
+        active = np.ones(num_envs, dtype=bool)
+        episode_steps = np.zeros(num_envs)
+        episode_metrics = {
+            name: np.zeros(num_envs) for name in ["reward", *metrics.keys()]
+        }
+        num_steps = 0
+        for _ in range(self._episode_length):
+            policy_key, act_key = jax.random.split(policy_key)
+            action = self._policy(policy_params, obs, act_key)
+            obs, reward, done, metrics = self._env.step(action, active)
+            num_steps += int(active.sum())
+
+            episode_metrics["reward"] += reward * active
+            for name, value in metrics.items():
+                episode_metrics[name] += value * active
+            episode_steps += active
+            active &= done == 0
+            if not active.any():
+                break
+        clip_sums = self._clip_metric_sums(
+            self._n_clips,
+            clip_idx,
+            np.ones(num_envs),
+            episode_steps,
+            terminated_from_metrics(episode_metrics),
+            episode_metrics,
+        )
+        epoch_eval_time = time.time() - t
+
+        metrics = {}
+        for fn in [np.mean, np.std]:
+            suffix = "_std" if fn == np.std else ""
+            metrics.update(
+                {
+                    f"eval/episode_{name}{suffix}": (
+                        fn(value) if aggregate_episodes else value
+                    )
+                    for name, value in episode_metrics.items()
+                }
+            )
+        metrics["eval/avg_episode_length"] = np.mean(episode_steps)
+        metrics["eval/clip_metrics"] = clip_metrics_means(clip_sums)
+        metrics["eval/epoch_eval_time"] = epoch_eval_time
+        metrics["eval/sps"] = num_steps / epoch_eval_time
+        self._eval_walltime = self._eval_walltime + epoch_eval_time
+        metrics = {
+            "eval/walltime": self._eval_walltime,
+            **training_metrics,
+            **metrics,
+        }
+
+        return metrics  # pytype: disable=bad-return-type  # jax-ndarray
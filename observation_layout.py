@@ -0,0 +1,71 @@
+"""Static layout of the tracking observation vector.
+
+The env builds its ObservationLayout once at construction, and the intention
+networks use it to route the reference part of the observation to the encoder
+and the proprioceptive part to the decoder with static slices.
+"""
+
+from typing import Dict, NamedTuple, Sequence, Tuple
+
+import jax
+
+
+class ObservationSegment(NamedTuple):
+    """A named, contiguous segment of the observation vector."""
+
+    name: str
+    offset: int
+    size: int
+
+    def __call__(self, obs: jax.Array) -> jax.Array:
+        """Slices this segment out of the last axis of `obs`."""
+        return obs[..., self.offset : self.offset + self.size]
+
+
+class ObservationLayout(NamedTuple):
+    """Ordered observation segments; the reference segments come first."""
+
+    segments: Tuple[ObservationSegment, ...]
+    num_reference_segments: int
+
+    @classmethod
+    def from_sizes(
+        cls,
+        reference_sizes: Sequence[Tuple[str, int]],
+        proprioceptive_sizes: Sequence[Tuple[str, int]],
+    ) -> "ObservationLayout":
+        segments = []
+        offset = 0
+        for name, size in list(reference_sizes) + list(proprioceptive_sizes):
+            segments.append(ObservationSegment(name, offset, size))
+            offset += size
+        return cls(tuple(segments), len(reference_sizes))
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self.segments)
+
+    @property
+    def reference_obs_size(self) -> int:
+        return sum(
+            segment.size for segment in self.segments[: self.num_reference_segments]
+        )
+
+    def segment(self, name: str) -> ObservationSegment:
+        """The segment called `name`."""
+        for segment in self.segments:
+            if segment.name == name:
+                return segment
+        raise KeyError(name)
+
+    def reference(self, obs: jax.Array) -> jax.Array:
+        """The reference (trajectory) part of `obs`."""
+        return obs[..., : self.reference_obs_size]
+
+    def proprioceptive(self, obs: jax.Array) -> jax.Array:
+        """The proprioceptive part of `obs`."""
+        return obs[..., self.reference_obs_size :]
+
+    def split(self, obs: jax.Array) -> Dict[str, jax.Array]:
+        """Every segment of `obs` by name."""
+        return {segment.name: segment(obs) for segment in self.segments}
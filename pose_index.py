@@ -0,0 +1,181 @@
+"""Nearest-reference-pose index over a clip library.
+
+Each (clip, frame) of the library is described by its egocentric body
+positions (pose_descriptor), projected onto the leading principal components
+and grouped into cells by k-means. The index is built once with numpy; a query
+runs inside jit, compares the pose against the cell centroids and only scans
+the entries of the `n_probe` nearest cells, instead of the whole library.
+"""
+
+from typing import NamedTuple, Optional, Tuple
+
+import jax
+from jax import numpy as jp
+import numpy as np
+
+# Rows of the library compared with the centroids at once while building
+_BUILD_CHUNK = 16384
+
+
+class PoseIndex(NamedTuple):
+    """Projection and cells of the index; padded cell slots have inf codes."""
+
+    mean: jp.ndarray  # (descriptor_size,)
+    projection: jp.ndarray  # (descriptor_size, n_dims)
+    centroids: jp.ndarray  # (n_cells, n_dims)
+    cell_codes: jp.ndarray  # (n_cells, cell_size, n_dims)
+    cell_clip_idx: jp.ndarray  # (n_cells, cell_size)
+    cell_frame: jp.ndarray  # (n_cells, cell_size)
+
+
+def pose_descriptor(
+    root_pos: jp.ndarray, root_quat: jp.ndarray, body_pos: jp.ndarray
+) -> jp.ndarray:
+    """Body offsets from the root, rotated into the root's heading frame.
+
+    Only the yaw is removed, so the descriptor does not depend on where the
+    rodent stands or faces, but still tells upright from fallen poses. Works on
+    any leading batch axes.
+
+    Args:
+        root_pos: (..., 3) root position.
+        root_quat: (..., 4) root orientation, scalar first.
+        body_pos: (..., n_bodies, 3) body positions.
+
+    Returns:
+        jp.ndarray: (..., n_bodies * 3) descriptor.
+    """
+    w, x, y, z = jp.moveaxis(root_quat, -1, 0)
+    yaw = jp.arctan2(2 * (w * z + x * y), 1 - 2 * (y**2 + z**2))
+    cos, sin = jp.cos(yaw)[..., None], jp.sin(yaw)[..., None]
+    offset = body_pos - root_pos[..., None, :]
+    ego = jp.stack(
+        [
+            cos * offset[..., 0] + sin * offset[..., 1],
+            cos * offset[..., 1] - sin * offset[..., 0],
+            offset[..., 2],
+        ],
+        axis=-1,
+    )
+    return jp.reshape(ego, ego.shape[:-2] + (-1,))
+
+
+def _nearest_centroid(codes: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assign = np.empty(len(codes), dtype=np.int64)
+    for start in range(0, len(codes), _BUILD_CHUNK):
+        chunk = codes[start : start + _BUILD_CHUNK]
+        dist = (
+            np.sum(chunk**2, axis=1)[:, None]
+            - 2 * chunk @ centroids.T
+            + np.sum(centroids**2, axis=1)[None]
+        )
+        assign[start : start + _BUILD_CHUNK] = np.argmin(dist, axis=1)
+    return assign
+
+
+def build_pose_index(
+    descriptors: np.ndarray,
+    clip_idx: np.ndarray,
+    frames: np.ndarray,
+    n_cells: Optional[int] = None,
+    n_dims: int = 16,
+    n_iters: int = 10,
+    seed: int = 0,
+) -> PoseIndex:
+    """Builds a PoseIndex over one descriptor per (clip, frame).
+
+    Args:
+        descriptors (np.ndarray): (n, descriptor_size) pose descriptors.
+        clip_idx (np.ndarray): (n,) clip of each descriptor.
+        frames (np.ndarray): (n,) frame of each descriptor.
+        n_cells (int): number of k-means cells; defaults to sqrt(n).
+        n_dims (int): principal components kept.
+        n_iters (int): k-means iterations.
+        seed (int): seed of the initial centroids.
+
+    Returns:
+        PoseIndex: the index, on device.
+    """
+    descriptors = np.asarray(descriptors, dtype=np.float32)
+    n = len(descriptors)
+    n_cells = min(n_cells or int(np.ceil(np.sqrt(n))), n)
+    n_dims = min(n_dims, descriptors.shape[1])
+
+    mean = descriptors.mean(axis=0)
+    centered = descriptors - mean
+    _, _, vt = np.linalg.svd(centered, full_matrices=False)
+    projection = vt[:n_dims].T
+    codes = centered @ projection
+
+    rng = np.random.default_rng(seed)
+    centroids = codes[rng.choice(n, n_cells, replace=False)]
+    for _ in range(n_iters):
+        assign = _nearest_centroid(codes, centroids)
+        counts = np.bincount(assign, minlength=n_cells)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, codes)
+        centroids = np.where(
+            counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centroids
+        )
+    assign = _nearest_centroid(codes, centroids)
+
+    # Pack each cell's entries into a fixed number of slots
+    counts = np.bincount(assign, minlength=n_cells)
+    order = np.argsort(assign, kind="stable")
+    slots = np.arange(n) - np.concatenate([[0], np.cumsum(counts)[:-1]])[
+        assign[order]
+    ]
+    cell_codes = np.full((n_cells, counts.max(), n_dims), np.inf, np.float32)
+    cell_clip_idx = np.zeros((n_cells, counts.max()), np.int32)
+    cell_frame = np.zeros((n_cells, counts.max()), np.int32)
+    cell_codes[assign[order], slots] = codes[order]
+    cell_clip_idx[assign[order], slots] = clip_idx[order]
+    cell_frame[assign[order], slots] = frames[order]
+
+    return PoseIndex(
+        mean=jp.asarray(mean),
+        projection=jp.asarray(projection),
+        centroids=jp.asarray(centroids),
+        cell_codes=jp.asarray(cell_codes),
+        cell_clip_idx=jp.asarray(cell_clip_idx),
+        cell_frame=jp.asarray(cell_frame),
+    )
+
+
+def query_pose_index(
+    index: PoseIndex,
+    descriptor: jp.ndarray,
+    n_probe: int = 4,
+    clip_idx: Optional[jp.ndarray] = None,
+) -> Tuple[jp.ndarray, jp.ndarray, jp.ndarray]:
+    """Nearest indexed (clip, frame) to a single descriptor; vmap for a batch.
+
+    Args:
+        index (PoseIndex): the index.
+        descriptor (jp.ndarray): (descriptor_size,) pose descriptor.
+        n_probe (int): nearest cells scanned.
+        clip_idx (jp.ndarray): only consider frames of this clip.
+
+    Returns:
+        Tuple[jp.ndarray, jp.ndarray, jp.ndarray]: clip index, frame and squared
+        distance in the projected space; the distance is inf if no frame of
+        `clip_idx` lies in the probed cells.
+    """
+    code = (descriptor - index.mean) @ index.projection
+    cell_dist = jp.sum((index.centroids - code) ** 2, axis=-1)
+    _, cells = jax.lax.top_k(-cell_dist, min(n_probe, len(index.centroids)))
+
+    candidates = index.cell_codes[cells].reshape(-1, code.shape[-1])
+    candidate_clip_idx = index.cell_clip_idx[cells].ravel()
+    candidate_frame = index.cell_frame[cells].ravel()
+    dist = jp.sum((candidates - code) ** 2, axis=-1)
+    if clip_idx is not None:
+        dist = jp.where(candidate_clip_idx == clip_idx, dist, jp.inf)
+
+    best = jp.argmin(dist)
+    return candidate_clip_idx[best], candidate_frame[best], dist[best]
+
+
+def pose_index_nbytes(index: PoseIndex) -> int:
+    """Total number of bytes held by the arrays of a PoseIndex."""
+    return sum(x.nbytes for x in index)
@@ -15,7 +15,7 @@ from mujoco.mjx._src import smooth
 import preprocessing.transformations as tr
 
 from collections import defaultdict
-from typing import Text, Union, List
+from typing import Optional, Sequence, Text, Tuple, Union, List
 import h5py
 import pickle
 
@@ -41,6 +41,95 @@ class ReferenceClip:
     body_quaternions: jp.ndarray = None
 
 
+# Fields of ReferenceClip that are indexed by body along axis -2
+_PER_BODY_FIELDS = ("body_positions", "body_quaternions")
+
+
+def reference_clip_nbytes(reference_clip: ReferenceClip) -> int:
+    """Total number of bytes held by the arrays of a ReferenceClip."""
+    return sum(x.nbytes for x in jax.tree_util.tree_leaves(reference_clip))
+
+
+def compact_reference_clip(
+    reference_clip: ReferenceClip,
+    fields: Sequence[str],
+    body_idxs: Optional[Sequence[int]] = None,
+    dtype=None,
+) -> Tuple[ReferenceClip, int]:
+    """Keeps only the fields and bodies of a ReferenceClip that are used.
+
+    Works on a single clip or a stacked library, since only the trailing
+    axes are touched.
+
+    Args:
+        reference_clip (ReferenceClip): clip or stacked clips to compact.
+        fields (Sequence[str]): names of the fields to keep; all others are
+            dropped (set to None).
+        body_idxs (Optional[Sequence[int]]): body indices to keep for the
+            per-body fields. The kept bodies are stored in this order, so
+            callers must index the compacted arrays by position in body_idxs.
+            Defaults to keeping every body.
+        dtype (optional): storage dtype for the kept fields, e.g. jp.bfloat16
+            or jp.float16. Defaults to the original dtype.
+
+    Returns:
+        Tuple[ReferenceClip, int]: the compacted clip and the number of bytes
+            saved.
+    """
+    unknown = set(fields) - set(reference_clip.__dict__.keys())
+    if unknown:
+        raise ValueError(f"Unknown ReferenceClip fields: {sorted(unknown)}")
+
+    compacted = {}
+    for attr, value in reference_clip.__dict__.items():
+        if attr not in fields or value is None:
+            compacted[attr] = None
+            continue
+        value = jp.asarray(value)
+        if attr in _PER_BODY_FIELDS and body_idxs is not None:
+            value = jp.take(value, jp.asarray(body_idxs), axis=-2)
+        if dtype is not None:
+            value = value.astype(dtype)
+        compacted[attr] = value
+
+    compact_clip = ReferenceClip(**compacted)
+    saved = reference_clip_nbytes(reference_clip) - reference_clip_nbytes(compact_clip)
+    return compact_clip, saved
+
+
+def pad_reference_clips(
+    reference_clips: Sequence[ReferenceClip],
+) -> Tuple[ReferenceClip, jp.ndarray]:
+    """Stacks clips of different lengths into one padded clip library.
+
+    Shorter clips are padded to the longest one by repeating their last frame,
+    so clamped lookups past the end stay on a valid pose. Every field of a clip
+    is padded by the same number of frames, so fields that are longer than
+    position (e.g. the velocities of process_clip) keep their extra rows.
+
+    Args:
+        reference_clips (Sequence[ReferenceClip]): single (unstacked) clips.
+
+    Returns:
+        Tuple[ReferenceClip, jp.ndarray]: the stacked library and the number
+            of valid frames of each clip, to pass as clip_lengths to
+            RodentMultiClipTracking.
+    """
+    clip_lengths = jp.array([clip.position.shape[0] for clip in reference_clips])
+    max_length = int(jp.max(clip_lengths))
+
+    def pad(clip):
+        # Relative to position, whose length is the clip length
+        n_pad = max_length - clip.position.shape[0]
+        return jax.tree.map(
+            lambda x: jp.concatenate([x, jp.repeat(x[-1:], n_pad, axis=0)], axis=0),
+            clip,
+        )
+
+    padded = [pad(clip) for clip in reference_clips]
+    return jax.tree.map(lambda *x: jp.stack(x), *padded), clip_lengths
+
+
 def process_clip_to_train(
     stac_path: Text,
     mjcf_path: str = "./assets/rodent.xml",
@@ -0,0 +1,82 @@
+"""Policy rollouts compiled into one lax.scan.
+
+Replaces stepping a jitted policy and a jitted env.step from Python and
+keeping every State: the policy and the env run inside one scan, and only the
+requested fields of each state are stacked and returned, so a rollout is a
+single dispatch and no mjx.Data outlives it.
+"""
+
+from typing import Callable, Dict, Optional, Sequence
+
+import jax
+from jax import numpy as jp
+from brax.envs.base import Env, State
+from brax.training.types import Policy, PolicyParams
+
+
+def make_rollout_fn(
+    env: Env,
+    eval_policy_fn: Callable[[PolicyParams], Policy],
+    n_steps: int,
+    metric_names: Optional[Sequence[str]] = None,
+    info_keys: Sequence[str] = (),
+    fields_fn: Optional[Callable[[State], Dict[str, jp.ndarray]]] = None,
+    metrics_level: Optional[str] = None,
+) -> Callable[..., Dict[str, jp.ndarray]]:
+    """Builds a jitted rollout of `n_steps` steps from env.reset.
+
+    Args:
+        env (Env): a single (unbatched) tracking env, possibly wrapped, e.g.
+            custom_wrappers.RenderRolloutWrapperTracking.
+        eval_policy_fn (Callable): returns the policy from the policy
+            parameters, e.g. functools.partial(make_policy, deterministic=True).
+        n_steps (int): env steps after the reset.
+        metric_names (Optional[Sequence[str]]): step metrics to keep; all of
+            them if None.
+        info_keys (Sequence[str]): info entries to keep.
+        fields_fn (Optional[Callable]): extra per-step fields, computed from
+            each State (e.g. the torso height).
+        metrics_level (Optional[str]): level the rollout is traced at (see
+            RodentTracking.bind_metrics_level); the env's own if None.
+
+    Returns:
+        Callable: (buffers, policy_params, key, *reset_args) -> dict with
+        "qpos", "reward", "done", "metrics" and "info" (dicts) and the
+        fields_fn entries, each stacked over the n_steps + 1 states of the
+        rollout, starting with the reset state. reset_args are passed on to
+        env.reset, e.g. the clip_idx of custom_wrappers.EvalClipWrapperTracking.
+    """
+
+    def fields(state: State) -> Dict[str, jp.ndarray]:
+        metrics = state.metrics
+        if metric_names is not None:
+            metrics = {name: metrics[name] for name in metric_names}
+        return {
+            "qpos": state.pipeline_state.qpos,
+            "reward": state.reward,
+            "done": state.done,
+            "metrics": metrics,
+            "info": {key: state.info[key] for key in info_keys},
+            **(fields_fn(state) if fields_fn is not None else {}),
+        }
+
+    def rollout(policy_params, key, *reset_args):
+        policy = eval_policy_fn(policy_params)
+        reset_rng, key = jax.random.split(key)
+        state = env.reset(reset_rng, *reset_args)
+
+        def step(state, key):
+            action, _ = policy(state.obs, key)
+            state = env.step(state, action)
+            return state, fields(state)
+
+        _, stacked = jax.lax.scan(step, state, jax.random.split(key, n_steps))
+        return jax.tree.map(
+            lambda first, rest: jp.concatenate([first[None], rest]),
+            fields(state),
+            stacked,
+        )
+
+    if metrics_level is not None:
+        rollout = env.with_metrics_level(metrics_level, rollout)
+    return jax.jit(env.with_buffers(rollout))
@@ -0,0 +1,59 @@
+"""Tests of the reference clip preprocessing.
+
+Run from the repository root: `python -m pytest tests`.
+"""
+
+import mujoco
+import numpy as np
+from jax import numpy as jp
+from mujoco import mjx
+
+from preprocessing.mjx_preprocess import pad_reference_clips, process_clip
+
+# A free-floating body with one hinge, enough for process_clip's features
+_XML = """
+<mujoco>
+  <worldbody>
+    <body name="torso">
+      <freejoint/>
+      <geom size="0.1"/>
+      <body name="leg" pos="0 0 -0.1">
+        <joint name="knee" type="hinge" axis="0 1 0"/>
+        <geom size="0.05"/>
+      </body>
+    </body>
+  </worldbody>
+</mujoco>
+"""
+
+
+def _processed_clip(n_frames):
+    """process_clip of a walk forward while bending the knee."""
+    mj_model = mujoco.MjModel.from_xml_string(_XML)
+    qpos = np.tile(mj_model.qpos0, (n_frames, 1))
+    qpos[:, 0] = np.linspace(0.0, 0.1, n_frames)
+    qpos[:, 7] = np.linspace(0.0, 0.5, n_frames)
+    return process_clip(
+        jp.array(qpos),
+        mjx.put_model(mj_model),
+        mjx.put_data(mj_model, mujoco.MjData(mj_model)),
+    )
+
+
+def test_pad_reference_clips_of_processed_clips():
+    clips = [_processed_clip(n_frames) for n_frames in (6, 10)]
+    library, clip_lengths = pad_reference_clips(clips)
+
+    np.testing.assert_array_equal(clip_lengths, [6, 10])
+    for name, value in library.__dict__.items():
+        if value is None:
+            continue
+        short, longest = getattr(clips[0], name), getattr(clips[1], name)
+        assert value.shape == (2, *longest.shape), name
+        np.testing.assert_allclose(value[1], longest, err_msg=name)
+        # The short clip keeps its frames, then repeats its last one
+        n = short.shape[0]
+        np.testing.assert_allclose(value[0, :n], short, err_msg=name)
+        np.testing.assert_allclose(
+            value[0, n:], np.broadcast_to(short[-1], value[0, n:].shape), err_msg=name
+        )
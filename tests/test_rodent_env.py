@@ -0,0 +1,24 @@
+"""Tests of the tracking envs on a standing-still synthetic clip.
+
+Run from the repository root (the envs load ./models/rodent.xml):
+`python -m pytest tests`.
+"""
+
+import jax
+from jax import numpy as jp
+
+from benchmarks.common import synthetic_reference_clip
+from Rodent_Env_Brax import RodentTracking
+
+
+def test_single_clip_step():
+    env = RodentTracking(None, torque_actuators=True, physics_steps_per_control_step=5)
+    env.reference_clips = synthetic_reference_clip(env.sys)
+
+    state = jax.jit(env.reset)(jax.random.PRNGKey(0))
+    assert state.info["prev_ctrl"].shape == (env.action_size,)
+    state = jax.jit(env.step)(state, jp.zeros(env.action_size))
+
+    assert state.obs.shape == (env.observation_size,)
+    assert state.info["prev_ctrl"].shape == (env.action_size,)
+    assert bool(jp.isfinite(state.reward))